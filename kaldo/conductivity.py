@@ -4,9 +4,11 @@ Anharmonic Lattice Dynamics
 """
 from opt_einsum import contract
 import numpy as np
+from scipy.sparse import diags, issparse
+from scipy.sparse.linalg import spsolve
 from kaldo.controllers.dirac_kernel import lorentz_delta, gaussian_delta, triangular_delta
 from kaldo.helpers.storage import lazy_property
-from kaldo.observables.harmonic_with_q_temp import HarmonicWithQTemp
+import kaldo.controllers.harmonic as hmc
 from kaldo.helpers.logger import get_logger, log_size
 logging = get_logger()
 
@@ -45,6 +47,42 @@ def calculate_diffusivity(omega, sij_left, sij_right, diffusivity_bandwidth, phy
     return diffusivity
 
 
+def calculate_conductivity_qhgk_at_q_points(second, q_points, eigenvectors, frequency, population, heat_capacity,
+                                            diffusivity_bandwidth, physical_mode, temperature, hbar, curve,
+                                            is_diffusivity_including_antiresonant=False, diffusivity_threshold=None,
+                                            distance_threshold=None, is_unfolding=False, is_sparse=False):
+    """Calculate the QHGK conductivity and diffusivity for a chunk of q points, before normalizing by the volume
+    and the number of k points.
+
+    Returns
+    -------
+    conductivity : np.array(n_k_points, n_modes, 3, 3)
+    diffusivity_with_axis : np.array(n_k_points, n_modes, 3, 3)
+    """
+    n_k_points, n_modes = frequency.shape
+    omega = frequency * 2 * np.pi
+    sij = hmc.calculate_sij_at_q_points(second, q_points, eigenvectors, distance_threshold=distance_threshold,
+                                        is_unfolding=is_unfolding, is_sparse=is_sparse)
+    heat_capacity_2d = hmc.calculate_heat_capacity_2d(frequency, population, heat_capacity, temperature, hbar,
+                                                      physical_mode)
+    conductivity = np.zeros((n_k_points, n_modes, 3, 3))
+    diffusivity_with_axis = np.zeros_like(conductivity)
+    for ik in range(n_k_points):
+        if n_modes > 100:
+            logging.info('calculating conductivity for q = ' + str(q_points[ik]))
+        for alpha in range(3):
+            for beta in range(3):
+                diffusivity = calculate_diffusivity(omega[ik], sij[ik, alpha], sij[ik, beta],
+                                                    diffusivity_bandwidth[ik],
+                                                    physical_mode[ik],
+                                                    curve,
+                                                    is_diffusivity_including_antiresonant,
+                                                    diffusivity_threshold)
+                conductivity[ik, :, alpha, beta] = np.sum(heat_capacity_2d[ik] * diffusivity, axis=-1).real
+                diffusivity_with_axis[ik, :, alpha, beta] = np.sum(diffusivity, axis=-1).real
+    return conductivity, diffusivity_with_axis
+
+
 def gamma_with_matthiessen(gamma, velocity, length):
     gamma = gamma + 2 * np.abs(velocity) / length
     return gamma
@@ -78,7 +116,8 @@ class Conductivity:
     phonons : Phonons
         Contains all the information about the calculated phononic properties of the system
     method : 'rta', 'sc', 'qhgk', 'inverse'
-        Specifies the method used to calculate the conductivity.
+        Specifies the method used to calculate the conductivity. When the bandwidth of the phonons is interpolated
+        from bandwidth_kpts, the methods using the scattering tensor, 'sc', 'inverse' and 'full', are not available.
     diffusivity_bandwidth : float, optional
         (QHGK) Specifies the bandwidth to use in the calculation of the flux operator in the Allen-Feldman model of the
         thermal conductivity in amorphous systems. Units: rad/ps
@@ -141,6 +180,10 @@ class Conductivity:
         self.temperature = self.phonons.temperature
         self.is_classic = self.phonons.is_classic
         self.third_bandwidth = self.phonons.third_bandwidth
+        self.bandwidth_kpts = self.phonons.bandwidth_kpts
+        if self.bandwidth_kpts is not None and self.method in ('sc', 'inverse', 'full'):
+            raise ValueError('The ' + str(self.method) + ' method needs the scattering tensor on the full k mesh, '
+                             'which is not calculated when bandwidth_kpts is defined. Use the rta method.')
 
         self.diffusivity_bandwidth = kwargs.pop('diffusivity_bandwidth', None)
         self.diffusivity_threshold = kwargs.pop('diffusivity_threshold', None)
@@ -234,6 +277,10 @@ class Conductivity:
                                     is_including_diagonal,
                                     is_rescaling_omega,
                                     is_rescaling_population):
+        if self.phonons.is_using_sparse_gamma_tensor:
+            return self._calculate_sparse_scattering_matrix(is_including_diagonal,
+                                                            is_rescaling_omega,
+                                                            is_rescaling_population)
         physical_mode = self.phonons.physical_mode.reshape((self.n_phonons))
         frequency = self.phonons.frequency.reshape((self.n_phonons))[physical_mode]
         gamma_tensor = -1 * self.phonons._ps_gamma_and_gamma_tensor[:, 2:]
@@ -254,6 +301,28 @@ class Conductivity:
         return gamma_tensor
 
 
+    def _calculate_sparse_scattering_matrix(self,
+                                            is_including_diagonal,
+                                            is_rescaling_omega,
+                                            is_rescaling_population):
+        """Same as calculate_scattering_matrix, as a scipy.sparse.csr_matrix, from the sparse scattering tensor."""
+        physical_mode = self.phonons.physical_mode.reshape((self.n_phonons))
+        frequency = self.phonons.frequency.reshape((self.n_phonons))[physical_mode]
+        gamma_tensor = -1 * self.phonons._sparse_ps_gamma_and_gamma_tensor[:, 2:].tocsr()
+        gamma_tensor = gamma_tensor[physical_mode][:, physical_mode]
+        logging.info('Sparse scattering matrix with ' + str(gamma_tensor.nnz) + ' nonzero elements')
+        if is_rescaling_population:
+            n = self.phonons.population.reshape((self.n_phonons))[physical_mode]
+            gamma_tensor = diags(((n * (n + 1))) ** (1/2)).dot(gamma_tensor).dot(diags(1 / ((n * (n + 1)) ** (1/2))))
+            logging.info('Asymmetry of gamma_tensor: ' + str(abs(gamma_tensor - gamma_tensor.T).sum()))
+        if is_including_diagonal:
+            gamma = self.phonons.bandwidth.reshape((self.n_phonons))[physical_mode]
+            gamma_tensor = gamma_tensor + diags(gamma)
+        if is_rescaling_omega:
+            gamma_tensor = diags(1 / frequency).dot(gamma_tensor).dot(diags(frequency))
+        return gamma_tensor.tocsr()
+
+
     def calculate_conductivity_qhgk(self):
         """Calculates the conductivity of each mode using the :ref:'Quasi-Harmonic-Green-Kubo Model'.
         The tensor is returned individual modes along the first axis and has units of W/m/K.
@@ -264,9 +333,7 @@ class Conductivity:
             (n_phonons, 3, 3) W/m/K
         """
         phonons = self.phonons
-        omega = phonons.omega.reshape((phonons.n_k_points, phonons.n_modes))
         volume = np.linalg.det(phonons.atoms.cell)
-        q_points = phonons._reciprocal_grid.unitary_grid(is_wrapping=False)
         physical_mode = phonons.physical_mode
         conductivity_per_mode = np.zeros((self.phonons.n_k_points, self.phonons.n_modes, 3, 3))
         diffusivity_with_axis = np.zeros_like(conductivity_per_mode)
@@ -293,44 +360,25 @@ class Conductivity:
         # if self.diffusivity_threshold is None:
         logging.info('Start calculation diffusivity')
 
-        for k_index in range(len(q_points)):
-
-            phonon = HarmonicWithQTemp(q_point=q_points[k_index],
-                                       second=self.phonons.forceconstants.second,
-                                       distance_threshold=self.phonons.forceconstants.distance_threshold,
-                                       folder=self.folder,
-                                       storage=self.storage,
+        population = phonons.population.reshape((phonons.n_k_points, phonons.n_modes))
+        heat_capacity = phonons.heat_capacity.reshape((phonons.n_k_points, phonons.n_modes))
+        chunks = phonons._map_k_chunks(calculate_conductivity_qhgk_at_q_points,
+                                       phonons.eigenvectors,
+                                       phonons.frequency,
+                                       population,
+                                       heat_capacity,
+                                       diffusivity_bandwidth,
+                                       physical_mode,
+                                       n_arrays=8,
                                        temperature=self.temperature,
-                                       is_classic=self.is_classic,
-                                       is_nw=self.phonons.is_nw,
-                                       is_unfolding=self.is_unfolding)
-            heat_capacity_2d = phonon.heat_capacity_2d
-            if phonons.n_modes > 100:
-                logging.info('calculating conductivity for q = ' + str(q_points[k_index]))
-            for alpha in range(3):
-                if alpha == 0:
-                    sij_left = phonon._sij_x
-                if alpha == 1:
-                    sij_left = phonon._sij_y
-                if alpha == 2:
-                    sij_left = phonon._sij_z
-                for beta in range(3):
-                    if beta == 0:
-                        sij_right = phonon._sij_x
-                    if beta == 1:
-                        sij_right = phonon._sij_y
-                    if beta == 2:
-                        sij_right = phonon._sij_z
-                    diffusivity = calculate_diffusivity(omega[k_index], sij_left, sij_right,
-                                                        diffusivity_bandwidth[k_index],
-                                                        physical_mode[k_index],
-                                                        curve,
-                                                        is_diffusivity_including_antiresonant,
-                                                        self.diffusivity_threshold)
-                    conductivity_per_mode[k_index, :, alpha, beta] = (np.sum(heat_capacity_2d *
-                                                                            diffusivity, axis=-1) \
-                                                                     / (volume * phonons.n_k_points)).real
-                    diffusivity_with_axis[k_index, :, alpha, beta] = np.sum(diffusivity, axis=-1).real
+                                       hbar=phonons.hbar,
+                                       curve=curve,
+                                       is_diffusivity_including_antiresonant=is_diffusivity_including_antiresonant,
+                                       diffusivity_threshold=self.diffusivity_threshold,
+                                       is_sparse=phonons.is_using_sparse_dynmat)
+        for k_chunk, (conductivity_chunk, diffusivity_chunk) in chunks:
+            conductivity_per_mode[k_chunk] = conductivity_chunk / (volume * phonons.n_k_points)
+            diffusivity_with_axis[k_chunk] = diffusivity_chunk
         self._diffusivity = 1 / 3 * 1 / 100 * contract('knaa->kn', diffusivity_with_axis)
         return conductivity_per_mode * 1e22
 
@@ -362,9 +410,14 @@ class Conductivity:
                         gamma = gamma + 2 * np.abs(velocity[:, alpha]) / length[alpha]
 
 
-            scattering_matrix += np.diag(gamma[physical_mode])
-            scattering_inverse = np.linalg.inv(scattering_matrix)
-            lambd[physical_mode, alpha] = scattering_inverse.dot(velocity[physical_mode, alpha])
+            if issparse(scattering_matrix):
+                # Solve the linear system instead of inverting, to keep the scattering matrix sparse
+                scattering_matrix = scattering_matrix + diags(gamma[physical_mode])
+                lambd[physical_mode, alpha] = spsolve(scattering_matrix.tocsc(), velocity[physical_mode, alpha])
+            else:
+                scattering_matrix += np.diag(gamma[physical_mode])
+                scattering_inverse = np.linalg.inv(scattering_matrix)
+                lambd[physical_mode, alpha] = scattering_inverse.dot(velocity[physical_mode, alpha])
             if finite_length_method == 'caltech':
                 if length is not None:
                     if length[alpha]:
@@ -462,6 +515,9 @@ class Conductivity:
         gamma_tensor = self.calculate_scattering_matrix(is_including_diagonal=True,
                                                         is_rescaling_omega=False,
                                                         is_rescaling_population=True)
+        if issparse(gamma_tensor):
+            # The eigenvectors of the scattering matrix are dense
+            gamma_tensor = gamma_tensor.toarray()
 
         neg_diag = (gamma_tensor.diagonal() < 0).sum()
         logging.info('negative on diagonal : ' + str(neg_diag))
@@ -4,53 +4,85 @@ Anharmonic Lattice Dynamics
 """
 import numpy as np
 import ase.units as units
+from functools import partial
 from kaldo.helpers.tools import timeit
 import tensorflow as tf
+from scipy.sparse import coo_matrix, hstack, issparse
 from opt_einsum import contract
 from kaldo.helpers.logger import get_logger, log_size
 from kaldo.controllers.dirac_kernel import gaussian_delta, triangular_delta, lorentz_delta
+from kaldo.controllers.harmonic import MAX_CHUNK_MEMORY_IN_MB
+import kaldo.helpers.parallel as parallel
 logging = get_logger()
 
 
 @timeit
-def project_amorphous(phonons):
-    is_balanced = phonons.is_balanced
-    frequency = phonons.frequency
-    omega = 2 * np.pi * frequency
-    population = phonons.population
-    n_replicas = phonons.forceconstants.n_replicas
-    rescaled_eigenvectors = phonons._rescaled_eigenvectors.astype(float)
-    # The ps and gamma matrix stores ps, gamma and then the scattering matrix
-    ps_and_gamma = np.zeros((phonons.n_phonons, 2))
-    evect_tf = tf.convert_to_tensor(rescaled_eigenvectors[0])
-
+def project_amorphous(phonons, start=None, stop=None):
+    """Phase space and bandwidth of each mode, when the unit cell is the only k point. The modes are
+    distributed in chunks across phonons.n_workers processes, which map the third order and the harmonic
+    properties from shared memory, and write their rows of the ps and gamma array directly in a shared buffer.
+    If start or stop are given, only the rows of the phonons in range(start, stop) are projected and returned.
+    """
+    start, stop = _calculate_row_range(phonons.n_phonons, start, stop)
     coords = phonons.forceconstants.third.value.coords
-    data = phonons.forceconstants.third.value.data
-    coords = np.vstack([coords[1], coords[2], coords[0]])
-    third_tf = tf.SparseTensor(coords.T, data, (
-        phonons.n_modes * n_replicas, phonons.n_modes * n_replicas, phonons.n_modes))
-
-    third_tf = tf.sparse.reshape(third_tf, ((phonons.n_modes * n_replicas) ** 2, phonons.n_modes))
-    physical_mode = phonons.physical_mode.reshape((phonons.n_k_points, phonons.n_modes))
+    arrays = {'third_coords': np.vstack([coords[1], coords[2], coords[0]]).T,
+              'third_data': phonons.forceconstants.third.value.data,
+              'rescaled_eigenvectors': phonons._rescaled_eigenvectors.astype(float)[0],
+              'omega': 2 * np.pi * phonons.frequency,
+              'population': phonons.population,
+              'physical_mode': phonons.physical_mode.reshape((phonons.n_k_points, phonons.n_modes)),
+              # The ps and gamma matrix stores ps, gamma and then the scattering matrix
+              'ps_and_gamma': np.zeros((stop - start, 2))}
+    project = partial(_project_amorphous_modes,
+                      start=start,
+                      # Degrees of freedom of the unit cell, which can be more than the modes computed in a
+                      # frequency window
+                      n_dof=phonons.forceconstants.n_modes,
+                      n_replicas=phonons.forceconstants.n_replicas,
+                      third_bandwidth=phonons.third_bandwidth,
+                      broadening_shape=phonons.broadening_shape,
+                      is_balanced=phonons.is_balanced,
+                      hbar=phonons.hbar)
+    n_rows = stop - start
+    mode_chunks = np.array_split(np.arange(start, stop),
+                                 parallel.calculate_n_chunks(n_rows, n_rows, phonons.n_workers))
     logging.info('Projection started')
+    parallel.map_with_shared_arrays(project, arrays, [mode_chunks], phonons.n_workers, writable=('ps_and_gamma', ))
+    return arrays['ps_and_gamma']
+
+
+def _project_amorphous_modes(arrays, nu_ids, start, n_dof, n_replicas, third_bandwidth, broadening_shape,
+                             is_balanced, hbar):
+    omega = arrays['omega']
+    frequency = omega / (2 * np.pi)
+    population = arrays['population']
+    physical_mode = arrays['physical_mode']
+    ps_and_gamma = arrays['ps_and_gamma']
+    n_k_points = omega.shape[0]
+    n_phonons = omega.size
+    evect_tf = tf.convert_to_tensor(arrays['rescaled_eigenvectors'])
+    third_tf = tf.SparseTensor(arrays['third_coords'], arrays['third_data'], (
+        n_dof * n_replicas, n_dof * n_replicas, n_dof))
+
+    third_tf = tf.sparse.reshape(third_tf, ((n_dof * n_replicas) ** 2, n_dof))
     gamma_to_thz = 1e11 * units.mol * (units.mol / (10 * units.J)) ** 2
-    thztomev = units.J * phonons.hbar * 2 * np.pi * 1e15
-    for nu_single in range(phonons.n_phonons):
-        sigma_tf = tf.constant(phonons.third_bandwidth, dtype=tf.float64)
+    thztomev = units.J * hbar * 2 * np.pi * 1e15
+    for nu_single in nu_ids:
+        sigma_tf = tf.constant(third_bandwidth, dtype=tf.float64)
 
         out = calculate_dirac_delta_amorphous(omega,
                                               population,
                                               physical_mode,
                                               sigma_tf,
-                                              phonons.broadening_shape,
+                                              broadening_shape,
                                               nu_single,
                                               is_balanced)
         if not out:
             continue
         third_nu_tf = tf.sparse.sparse_dense_matmul(third_tf,
-                                                    tf.reshape(evect_tf[:, nu_single], ((phonons.n_modes, 1))))
+                                                    tf.reshape(evect_tf[:, nu_single], ((n_dof, 1))))
         third_nu_tf = tf.reshape(third_nu_tf,
-                                 (phonons.n_modes * n_replicas, phonons.n_modes * n_replicas))
+                                 (n_dof * n_replicas, n_dof * n_replicas))
 
         dirac_delta_tf, mup_vec, mupp_vec = out
         scaled_potential_tf = tf.einsum('ij,in,jm->nm', third_nu_tf, evect_tf, evect_tf)
@@ -61,154 +93,309 @@ def project_amorphous(phonons):
         pot_times_dirac = tf.gather_nd(scaled_potential_tf,coords) **  2
         pot_times_dirac = pot_times_dirac / tf.gather(omega[0], mup_vec) / tf.gather(omega[0], mupp_vec)
         pot_times_dirac = tf.reduce_sum(tf.abs(pot_times_dirac) * dirac_delta_tf)
-        pot_times_dirac = np.pi * phonons.hbar / 4. * pot_times_dirac / phonons.n_k_points * gamma_to_thz
+        pot_times_dirac = np.pi * hbar / 4. * pot_times_dirac / n_k_points * gamma_to_thz
 
         dirac_delta = tf.reduce_sum(dirac_delta_tf)
 
-        ps_and_gamma[nu_single, 0] = dirac_delta.numpy()
-        ps_and_gamma[nu_single, 1] = pot_times_dirac.numpy()
-        ps_and_gamma[nu_single, 1:] /= omega.flatten()[nu_single]
+        row = nu_single - start
+        ps_and_gamma[row, 0] = dirac_delta.numpy()
+        ps_and_gamma[row, 1] = pot_times_dirac.numpy()
+        ps_and_gamma[row, 1:] /= omega.flatten()[nu_single]
 
         logging.info('calculating third ' + str(nu_single) + ': ' + str(np.round(nu_single / \
-                                                                                 phonons.n_phonons, 2) * 100) + '%')
-        logging.info(str(frequency.reshape(phonons.n_phonons)[nu_single]) + ': ' + \
-                     str(ps_and_gamma[nu_single, 1] * thztomev / (2 * np.pi)))
-
-    return ps_and_gamma
+                                                                                 n_phonons, 2) * 100) + '%')
+        logging.info(str(frequency.reshape(n_phonons)[nu_single]) + ': ' + \
+                     str(ps_and_gamma[row, 1] * thztomev / (2 * np.pi)))
 
 
 @timeit
-def project_crystal(phonons):
-    is_balanced = phonons.is_balanced
-    is_gamma_tensor_enabled = phonons.is_gamma_tensor_enabled
-    n_replicas = phonons.forceconstants.third.n_replicas
-
+def project_crystal(phonons, start=None, stop=None, is_gamma_tensor_enabled=None):
+    """Phase space, bandwidth and, if is_gamma_tensor_enabled, scattering tensor of each mode. The k points, only
+    the irreducible ones when using symmetries, are distributed in chunks across phonons.n_workers processes,
+    which map the third order and the harmonic properties from shared memory, and write their rows of the ps
+    and gamma array directly in a shared buffer.
+    If phonons.is_using_sparse_gamma_tensor, each worker accumulates the nonzero entries of its rows of the
+    scattering tensor, and the result is a scipy.sparse.csr_matrix with the same layout.
+    If start or stop are given, only the rows of the phonons in range(start, stop) are projected and returned.
+    These rows are not unfolded when using symmetries, and the ones of the reducible k points are left to zero,
+    see unfold_ps_and_gamma.
+    If is_gamma_tensor_enabled is not given, phonons.is_gamma_tensor_enabled is used.
+    """
+    if is_gamma_tensor_enabled is None:
+        is_gamma_tensor_enabled = phonons.is_gamma_tensor_enabled
+    is_block = start is not None or stop is not None
+    start, stop = _calculate_row_range(phonons.n_phonons, start, stop)
+    n_modes = phonons.n_modes
     try:
-        sparse_third = phonons.forceconstants.third.value.reshape((phonons.n_modes, -1))
+        sparse_third = phonons.forceconstants.third.value.reshape((n_modes, -1))
         # transpose
-        sparse_coords = tf.stack([sparse_third.coords[1], sparse_third.coords[0]], -1)
-        third_tf = tf.SparseTensor(sparse_coords,
-                                   sparse_third.data,
-                                   ((phonons.n_modes * n_replicas) ** 2, phonons.n_modes))
+        arrays = {'third_coords': np.stack([sparse_third.coords[1], sparse_third.coords[0]], -1),
+                  'third_data': sparse_third.data}
         is_sparse = True
     except AttributeError:
-        third_tf = tf.convert_to_tensor(phonons.forceconstants.third.value)
+        arrays = {'third': np.asarray(phonons.forceconstants.third.value)}
         is_sparse = False
-    third_tf = tf.cast(third_tf, dtype=tf.complex64)
     k_mesh = phonons._reciprocal_grid.unitary_grid(is_wrapping=False)
     n_k_points = k_mesh.shape[0]
-    _chi_k = tf.convert_to_tensor(phonons.forceconstants.third._chi_k(k_mesh))
-    _chi_k = tf.cast(_chi_k, dtype=tf.complex64)
-    evect_tf = tf.convert_to_tensor(phonons._rescaled_eigenvectors)
-    evect_tf = tf.cast(evect_tf, dtype=tf.complex64)
+    arrays['k_mesh'] = k_mesh
+    arrays['chi_k'] = phonons.forceconstants.third._chi_k(k_mesh).astype(np.complex64)
+
+    # Read the eigenvectors by chunks of k points, to avoid a double precision copy of the whole eigensystem
+    rescaled_eigenvectors = np.zeros((n_k_points, n_modes, n_modes), dtype=np.complex64)
+    for k_chunk in phonons._k_chunks():
+        rescaled_eigenvectors[k_chunk] = phonons._rescaled_eigenvectors_at_k(k_chunk)
+    arrays['rescaled_eigenvectors'] = rescaled_eigenvectors
+    arrays['omega'] = phonons.omega
+    arrays['population'] = phonons.population
+    arrays['physical_mode'] = phonons.physical_mode.reshape((phonons.n_k_points, n_modes))
+    if not phonons.third_bandwidth:
+        arrays['velocity'] = phonons.velocity
+
     # The ps and gamma matrix stores ps, gamma and then the scattering matrix
-    if is_gamma_tensor_enabled:
-        shape = (phonons.n_phonons, 2 + phonons.n_phonons)
+    is_sparse_gamma_tensor = is_gamma_tensor_enabled and phonons.is_using_sparse_gamma_tensor
+    if is_gamma_tensor_enabled and not is_sparse_gamma_tensor:
+        shape = (stop - start, 2 + phonons.n_phonons)
         log_size(shape, name='scattering_tensor')
-        ps_and_gamma = np.zeros(shape)
+        arrays['ps_and_gamma'] = np.zeros(shape)
     else:
-        ps_and_gamma = np.zeros((phonons.n_phonons, 2))
+        arrays['ps_and_gamma'] = np.zeros((stop - start, 2))
+    project = partial(_project_crystal_k_points,
+                      start=start,
+                      stop=stop,
+                      is_sparse=is_sparse,
+                      n_replicas=phonons.forceconstants.third.n_replicas,
+                      grid_shape=phonons._reciprocal_grid.grid_shape,
+                      grid_type=phonons._grid_type,
+                      cell_inv=phonons.forceconstants.cell_inv,
+                      kpts=phonons.kpts,
+                      third_bandwidth=phonons.third_bandwidth,
+                      broadening_shape=phonons.broadening_shape,
+                      is_balanced=phonons.is_balanced,
+                      is_gamma_tensor_enabled=is_gamma_tensor_enabled,
+                      is_sparse_gamma_tensor=is_sparse_gamma_tensor,
+                      hbar=phonons.hbar)
+    if phonons._is_projecting_irreducible_k_points:
+        # The scattering rates are invariant under the group, only the irreducible k points are projected
+        k_ids = phonons._k_symmetry.irreducible_k_ids
+    else:
+        k_ids = np.arange(n_k_points)
+    k_ids = k_ids[(k_ids >= start // n_modes) & (k_ids <= (stop - 1) // n_modes)]
+    k_chunks = np.array_split(k_ids, parallel.calculate_n_chunks(k_ids.shape[0], k_ids.shape[0],
+                                                                  phonons.n_workers))
+    logging.info('Projection started')
+    results = parallel.map_with_shared_arrays(project, arrays, [k_chunks], phonons.n_workers,
+                                              writable=('ps_and_gamma', ))
+    ps_and_gamma = arrays['ps_and_gamma']
+    if is_sparse_gamma_tensor:
+        rows, cols, data = [np.concatenate(entries) for entries in zip(*results)]
+        gamma_tensor = coo_matrix((data, (rows - start, cols)), shape=(stop - start, phonons.n_phonons))
+        ps_and_gamma = hstack([coo_matrix(ps_and_gamma), gamma_tensor], format='csr')
+    if phonons._is_projecting_irreducible_k_points and not is_block:
+        ps_and_gamma = unfold_ps_and_gamma(phonons, ps_and_gamma)
+    return ps_and_gamma
+
+
+def _project_crystal_k_points(arrays, k_ids, start, stop, is_sparse, n_replicas, grid_shape, grid_type, cell_inv,
+                              kpts, third_bandwidth, broadening_shape, is_balanced, is_gamma_tensor_enabled,
+                              is_sparse_gamma_tensor, hbar):
+    k_mesh = arrays['k_mesh']
+    omega = arrays['omega']
+    population = arrays['population']
+    physical_mode = arrays['physical_mode']
+    ps_and_gamma = arrays['ps_and_gamma']
+    n_k_points, n_modes = omega.shape
+    n_phonons = n_k_points * n_modes
+    if is_sparse:
+        third_tf = tf.SparseTensor(arrays['third_coords'],
+                                   arrays['third_data'],
+                                   ((n_modes * n_replicas) ** 2, n_modes))
+    else:
+        third_tf = tf.convert_to_tensor(arrays['third'])
+    third_tf = tf.cast(third_tf, dtype=tf.complex64)
+    _chi_k = tf.convert_to_tensor(arrays['chi_k'])
+    evect_tf = tf.convert_to_tensor(arrays['rescaled_eigenvectors'])
     second_minus = tf.math.conj(evect_tf)
     second_minus_chi = tf.math.conj(_chi_k)
-    logging.info('Projection started')
-    population = phonons.population
-    broadening_shape = phonons.broadening_shape
-    physical_mode = phonons.physical_mode.reshape((phonons.n_k_points, phonons.n_modes))
-    omega = phonons.omega
-    if not phonons.third_bandwidth:
-        velocity_tf = tf.convert_to_tensor(phonons.velocity)
+    if not third_bandwidth:
+        velocity_tf = tf.convert_to_tensor(arrays['velocity'])
     gamma_to_thz = 1e11 * units.mol * (units.mol / (10 * units.J)) ** 2
-    for nu_single in range(phonons.n_phonons):
-        if nu_single % 200 == 0:
-            logging.info('Calculating third order projection ' + str(nu_single) +  ', ' + \
-                         str(np.round(nu_single / phonons.n_phonons, 2) * 100) + '%')
-        index_k, mu = np.unravel_index(nu_single, (n_k_points, phonons.n_modes))
-        if is_sparse:
-            third_nu_tf = tf.sparse.sparse_dense_matmul(third_tf, evect_tf[index_k, :, mu, tf.newaxis])
-        else:
-            third_nu_tf = contract('ijk,i->jk', third_tf, evect_tf[index_k, :, mu], backend='tensorflow')
-            third_nu_tf = tf.reshape(third_nu_tf, (n_replicas * n_replicas, phonons.n_modes, phonons.n_modes))
-
-        third_nu_tf = tf.cast(
-            tf.reshape(third_nu_tf, (n_replicas, phonons.n_modes, n_replicas, phonons.n_modes)),
-            dtype=tf.complex64)
-        third_nu_tf = tf.transpose(third_nu_tf, (0, 2, 1, 3))
-        third_nu_tf = tf.reshape(third_nu_tf, (n_replicas * n_replicas, phonons.n_modes, phonons.n_modes))
+    block_size = calculate_mode_block_size(n_k_points, n_modes, n_replicas)
+    # Nonzero entries of the rows of the scattering tensor, when it's sparse
+    gamma_rows = []
+    gamma_cols = []
+    gamma_data = []
+    for i, index_k in enumerate(k_ids):
+        if i % max(1, int(200 / n_modes)) == 0:
+            logging.info('Calculating third order projection ' + str(index_k * n_modes) +  ', ' + \
+                         str(np.round(i / k_ids.shape[0], 2) * 100) + '%')
+
+        # Everything that depends only on k, for both the processes
+        index_kpp_full = {}
+        sigma_tf = {}
+        chi_prod = {}
+        second = {}
+        third = {}
         for is_plus in (0, 1):
-            index_kpp_full = phonons._allowed_third_phonons_index(index_k, is_plus)
-            index_kpp_full = tf.cast(index_kpp_full, dtype=tf.int32)
-
-            if phonons.third_bandwidth:
-                sigma_tf = tf.constant(phonons.third_bandwidth, dtype=tf.float64)
+            index_kpp_full[is_plus] = tf.cast(calculate_kpp_index(index_k, is_plus, k_mesh, grid_shape, grid_type),
+                                              dtype=tf.int32)
+            if third_bandwidth:
+                sigma_tf[is_plus] = tf.constant(third_bandwidth, dtype=tf.float64)
             else:
-                cellinv = phonons.forceconstants.cell_inv
-                k_size = phonons.kpts
-                sigma_tf = calculate_broadening(velocity_tf, cellinv, k_size, index_kpp_full)
-
-            out = calculate_dirac_delta_crystal(omega,
-                                                population,
-                                                physical_mode,
-                                                sigma_tf,
-                                                broadening_shape,
-                                                index_kpp_full,
-                                                index_k,
-                                                mu,
-                                                is_plus,
-                                                is_balanced)
-            if not out:
-                continue
-
+                sigma_tf[is_plus] = calculate_broadening(velocity_tf, cell_inv, kpts, index_kpp_full[is_plus])
             if is_plus:
-
-                second = evect_tf
+                second[is_plus] = evect_tf
                 second_chi = _chi_k
             else:
-
-                second = second_minus
+                second[is_plus] = second_minus
                 second_chi = second_minus_chi
-
-            third = tf.math.conj(tf.gather(evect_tf, index_kpp_full))
-            third_chi = tf.math.conj(tf.gather(_chi_k, index_kpp_full))
-            dirac_delta, index_kp_vec, mup_vec, index_kpp_vec, mupp_vec = out
-
-            # The ps and gamma array stores first ps then gamma then the scattering array
-            chi_prod = tf.einsum('kt,kl->ktl', second_chi, third_chi)
-            chi_prod = tf.reshape(chi_prod, (n_k_points, n_replicas ** 2))
-            scaled_potential = tf.tensordot(chi_prod, third_nu_tf, (1, 0))
-            scaled_potential = tf.einsum('kij,kim->kjm', scaled_potential, second)
-            scaled_potential = tf.einsum('kjm,kjn->kmn', scaled_potential, third)
-
-            scaled_potential = tf.gather_nd(scaled_potential, tf.stack([index_kp_vec, mup_vec, mupp_vec], axis=-1))
-            pot_times_dirac = tf.abs(
-                scaled_potential) ** 2 * dirac_delta
-
-            nup_vec = index_kp_vec * phonons.n_modes + mup_vec
-            nupp_vec = index_kpp_vec * phonons.n_modes + mupp_vec
-            pot_times_dirac = tf.cast(pot_times_dirac, dtype=tf.float64)
-            pot_times_dirac = pot_times_dirac / tf.gather(omega.flatten(), nup_vec) / tf.gather(omega.flatten(), nupp_vec)
-
-            if is_gamma_tensor_enabled:
-                # We need to use bincount together with fancy indexing here. See:
-                # https://stackoverflow.com/questions/15973827/handling-of-duplicate-indices-in-numpy-assignments
-
-                nup_vec = index_kp_vec * phonons.n_modes + mup_vec
-                nupp_vec = index_kpp_vec * phonons.n_modes + mupp_vec
-
-                result = tf.math.bincount(nup_vec, pot_times_dirac, phonons.n_phonons)
-                if is_plus:
-                    ps_and_gamma[nu_single, 2:] -= result
-                else:
-                    ps_and_gamma[nu_single, 2:] += result
-
-                result = tf.math.bincount(nupp_vec, pot_times_dirac, phonons.n_phonons)
-                ps_and_gamma[nu_single, 2:] += result
-            ps_and_gamma[nu_single, 0] += tf.reduce_sum(dirac_delta) / phonons.n_k_points
-            ps_and_gamma[nu_single, 1] += tf.reduce_sum(pot_times_dirac)
-        ps_and_gamma[nu_single, 1:] /= omega.flatten()[nu_single]
-        ps_and_gamma[nu_single, 1:] *= np.pi * phonons.hbar / 4 / n_k_points * gamma_to_thz
+            third[is_plus] = tf.math.conj(tf.gather(evect_tf, index_kpp_full[is_plus]))
+            third_chi = tf.math.conj(tf.gather(_chi_k, index_kpp_full[is_plus]))
+            chi_prod[is_plus] = tf.reshape(tf.einsum('kt,kl->ktl', second_chi, third_chi),
+                                           (n_k_points, n_replicas ** 2))
+        # Only the modes in the range of rows are projected
+        modes = np.arange(n_modes)
+        modes = modes[(index_k * n_modes + modes >= start) & (index_k * n_modes + modes < stop)]
+        for mode_block in np.array_split(modes, int(np.ceil(modes.shape[0] / block_size))):
+            # Project the third order on all the modes of the block at once
+            evect_block = tf.gather(evect_tf[index_k], mode_block, axis=1)
+            if is_sparse:
+                third_block_tf = tf.sparse.sparse_dense_matmul(third_tf, evect_block)
+                third_block_tf = tf.reshape(third_block_tf, (n_replicas, n_modes, n_replicas, n_modes,
+                                                             mode_block.shape[0]))
+                third_block_tf = tf.transpose(third_block_tf, (4, 0, 2, 1, 3))
+            else:
+                third_block_tf = contract('ijk,iu->ujk', third_tf, evect_block, backend='tensorflow')
+                third_block_tf = tf.reshape(third_block_tf, (mode_block.shape[0], n_replicas, n_modes, n_replicas,
+                                                             n_modes))
+                third_block_tf = tf.transpose(third_block_tf, (0, 1, 3, 2, 4))
+            third_block_tf = tf.reshape(tf.cast(third_block_tf, dtype=tf.complex64),
+                                        (mode_block.shape[0], n_replicas ** 2, n_modes, n_modes))
+            scaled_potential = {}
+            for is_plus in (0, 1):
+                potential = tf.tensordot(chi_prod[is_plus], third_block_tf, (1, 1))
+                potential = tf.einsum('kbij,kim->kbjm', potential, second[is_plus])
+                scaled_potential[is_plus] = tf.einsum('kbjm,kjn->bkmn', potential, third[is_plus])
+
+            for block_index, mu in enumerate(mode_block):
+                nu_single = index_k * n_modes + mu
+                row = nu_single - start
+                if is_sparse_gamma_tensor:
+                    gamma_row = np.zeros(n_phonons)
+                elif is_gamma_tensor_enabled:
+                    gamma_row = ps_and_gamma[row, 2:]
+                for is_plus in (0, 1):
+                    out = calculate_dirac_delta_crystal(omega,
+                                                        population,
+                                                        physical_mode,
+                                                        sigma_tf[is_plus],
+                                                        broadening_shape,
+                                                        index_kpp_full[is_plus],
+                                                        index_k,
+                                                        mu,
+                                                        is_plus,
+                                                        is_balanced)
+                    if not out:
+                        continue
+                    dirac_delta, index_kp_vec, mup_vec, index_kpp_vec, mupp_vec = out
+
+                    # The ps and gamma array stores first ps then gamma then the scattering array
+                    potential = tf.gather_nd(scaled_potential[is_plus][block_index],
+                                             tf.stack([index_kp_vec, mup_vec, mupp_vec], axis=-1))
+                    pot_times_dirac = tf.abs(potential) ** 2 * dirac_delta
+
+                    nup_vec = index_kp_vec * n_modes + mup_vec
+                    nupp_vec = index_kpp_vec * n_modes + mupp_vec
+                    pot_times_dirac = tf.cast(pot_times_dirac, dtype=tf.float64)
+                    pot_times_dirac = pot_times_dirac / tf.gather(omega.flatten(), nup_vec) / tf.gather(omega.flatten(), nupp_vec)
+
+                    if is_gamma_tensor_enabled:
+                        # We need to use bincount together with fancy indexing here. See:
+                        # https://stackoverflow.com/questions/15973827/handling-of-duplicate-indices-in-numpy-assignments
+                        result = tf.math.bincount(nup_vec, pot_times_dirac, n_phonons).numpy()
+                        if is_plus:
+                            gamma_row -= result
+                        else:
+                            gamma_row += result
+
+                        result = tf.math.bincount(nupp_vec, pot_times_dirac, n_phonons).numpy()
+                        gamma_row += result
+                    ps_and_gamma[row, 0] += tf.reduce_sum(dirac_delta) / n_k_points
+                    ps_and_gamma[row, 1] += tf.reduce_sum(pot_times_dirac)
+                ps_and_gamma[row, 1:] /= omega.flatten()[nu_single]
+                ps_and_gamma[row, 1:] *= np.pi * hbar / 4 / n_k_points * gamma_to_thz
+                if is_sparse_gamma_tensor:
+                    gamma_row /= omega.flatten()[nu_single]
+                    gamma_row *= np.pi * hbar / 4 / n_k_points * gamma_to_thz
+                    nonzero = np.flatnonzero(gamma_row)
+                    gamma_rows.append(np.full(nonzero.shape[0], nu_single))
+                    gamma_cols.append(nonzero)
+                    gamma_data.append(gamma_row[nonzero])
+    if is_sparse_gamma_tensor:
+        return [np.concatenate(entries) if entries else np.zeros(0, dtype=dtype)
+                for entries, dtype in zip((gamma_rows, gamma_cols, gamma_data), (np.int, np.int, np.float))]
+
+
+def unfold_ps_and_gamma(phonons, ps_and_gamma):
+    """Replicate phase space, bandwidth and, if present, the scattering tensor, from the irreducible k points to
+    the full mesh.
+    """
+    k_symmetry = phonons._k_symmetry
+    n_k_points = phonons.n_k_points
+    n_modes = phonons.n_modes
+    if issparse(ps_and_gamma):
+        ps_and_gamma = ps_and_gamma.tocsr()
+        phase_space_and_gamma = k_symmetry.unfold_scalar(ps_and_gamma[:, :2].toarray()
+                                                         .reshape((n_k_points, n_modes, 2))).reshape((-1, 2))
+        gamma_tensor = k_symmetry.unfold_sparse_tensor(ps_and_gamma[:, 2:], n_modes)
+        return hstack([coo_matrix(phase_space_and_gamma), gamma_tensor], format='csr')
+    ps_and_gamma[:, :2] = k_symmetry.unfold_scalar(ps_and_gamma[:, :2].reshape((n_k_points, n_modes, 2))) \
+        .reshape((-1, 2))
+    if ps_and_gamma.shape[1] > 2:
+        gamma_tensor = ps_and_gamma[:, 2:].reshape((n_k_points, n_modes, n_k_points, n_modes))
+        ps_and_gamma[:, 2:] = k_symmetry.unfold_tensor(gamma_tensor).reshape((phonons.n_phonons, -1))
     return ps_and_gamma
 
 
+def _calculate_row_range(n_phonons, start, stop):
+    start = 0 if start is None else start
+    stop = n_phonons if stop is None else stop
+    if not 0 <= start < stop <= n_phonons:
+        raise ValueError('The range of phonons (' + str(start) + ', ' + str(stop) + ') is not valid, with '
+                         + str(n_phonons) + ' phonons')
+    return start, stop
+
+
+def calculate_kpp_index(index_k, is_plus, k_mesh, grid_shape, grid_type):
+    """Index of the k point q'' = q +/- q' allowed by the momentum conservation, for each q' of the mesh.
+
+    Parameters
+    ----------
+    index_k : int
+    is_plus : bool
+    k_mesh : np.array(n_k_points, 3)
+        k points of the mesh in fractional coordinates, not wrapped
+    grid_shape : (3) tuple
+    grid_type : 'C' or 'F'
+
+    Returns
+    -------
+    index_kpp_full : np.array(n_k_points)
+    """
+    kpp_vec = k_mesh[index_k][np.newaxis, :] + (int(is_plus) * 2 - 1) * k_mesh
+    rescaled_kpp = np.round((kpp_vec * grid_shape), 0).astype(np.int)
+    rescaled_kpp = np.mod(rescaled_kpp, grid_shape)
+    return np.ravel_multi_index(rescaled_kpp.T, grid_shape, mode='raise', order=grid_type)
+
+
+def calculate_mode_block_size(n_k_points, n_modes, n_replicas):
+    """Number of modes of the same k point projected together, so that the projected third order and the
+    scattering amplitudes of the block, in single precision complex, fit in MAX_CHUNK_MEMORY_IN_MB.
+    """
+    memory_per_mode_in_mb = (2 * (n_modes * n_replicas) ** 2 + 4 * n_k_points * n_modes ** 2) * 8 * 1e-6
+    block_size = int(MAX_CHUNK_MEMORY_IN_MB / memory_per_mode_in_mb)
+    return int(np.clip(block_size, 1, n_modes))
+
+
 def calculate_dirac_delta_crystal(omega, population, physical_mode, sigma_tf, broadening_shape,
                                   index_kpp_full, index_k, mu, is_plus, is_balanced, default_delta_threshold=2):
     if not physical_mode[index_k, mu]:
@@ -0,0 +1,616 @@
+"""
+kaldo
+Anharmonic Lattice Dynamics
+"""
+import numpy as np
+import ase.units as units
+from opt_einsum import contract
+import scipy.linalg
+import scipy.sparse.linalg
+from scipy.sparse import csr_matrix, coo_matrix
+from kaldo.grid import wrap_coordinates
+from kaldo.observables.forceconstant import chi
+from kaldo.helpers.logger import get_logger, log_size
+logging = get_logger()
+
+MAX_CHUNK_MEMORY_IN_MB = 512
+
+# Number of modes computed by each shift-invert Lanczos solve of the sparse eigensolver
+MODES_PER_SLICE = 256
+
+# Generic direction of the flux operator diagonalized inside the degenerate subspaces, so that the velocities
+# along x, y and z are all calculated in the same basis, without accidental degeneracies along the high symmetry
+# directions of the crystal
+DEGENERATE_SUBSPACE_DIRECTION = np.array([1, np.sqrt(2), np.sqrt(5)]) / np.sqrt(8)
+
+
+def calculate_chunk_size(n_k_points, n_modes, n_arrays=4):
+    """Number of q points that fit in MAX_CHUNK_MEMORY_IN_MB, when n_arrays complex
+    (n_modes, n_modes) matrices are needed per q point.
+    """
+    memory_per_q_in_mb = n_arrays * n_modes ** 2 * 16 * 1e-6
+    chunk_size = int(MAX_CHUNK_MEMORY_IN_MB / memory_per_q_in_mb)
+    return int(np.clip(chunk_size, 1, n_k_points))
+
+
+def calculate_dynmat_fourier(second, q_points, distance_threshold=None, is_unfolding=False):
+    """Calculate the dynamical matrix for all the q points at once.
+
+    Parameters
+    ----------
+    second : SecondOrder
+    q_points : np.array(n_k_points, 3)
+        q points in unitary reciprocal coordinates
+    distance_threshold : float, optional
+    is_unfolding : bool, optional
+
+    Returns
+    -------
+    dynmat_fourier : np.array(n_k_points, n_modes, n_modes)
+        real if the system is amorphous or if all the q points are at gamma, complex otherwise.
+    """
+    q_points = np.atleast_2d(q_points)
+    n_k_points = q_points.shape[0]
+    n_modes = second.n_modes
+    log_size((n_k_points, n_modes, n_modes), _calculate_type(second, q_points), name='dynmat_fourier')
+    if is_unfolding:
+        return _calculate_dynmat_from_table(second.unfolding_table, q_points, n_modes // 3)[:, 0]
+    if distance_threshold is not None:
+        dynmat_fourier = _calculate_dynmat_from_table(second.neighbor_table(distance_threshold), q_points,
+                                                      n_modes // 3)
+        return dynmat_fourier[:, 0]
+    dynmat = np.asarray(second.dynmat)[0]
+    if second.n_replicas == 1:
+        dynmat_fourier = np.broadcast_to(dynmat[:, :, 0, :, :], (n_k_points, ) + dynmat[:, :, 0].shape)
+        return dynmat_fourier.reshape((n_k_points, n_modes, n_modes))
+    chi_k = _calculate_chi_k(second, q_points)
+    dynmat_fourier = contract('ialjb,kl->kiajb', dynmat, chi_k)
+    return dynmat_fourier.reshape((n_k_points, n_modes, n_modes))
+
+
+def calculate_dynmat_derivatives(second, q_points, distance_threshold=None, is_unfolding=False,
+                                 directions=(0, 1, 2)):
+    """Calculate the derivatives of the dynamical matrix along the given cartesian directions, for all
+    the q points, in a single contraction.
+
+    Returns
+    -------
+    dynmat_derivatives : np.array(n_k_points, len(directions), n_modes, n_modes)
+        real if the system is amorphous or if all the q points are at gamma, complex otherwise.
+    """
+    q_points = np.atleast_2d(q_points)
+    directions = list(directions)
+    n_k_points = q_points.shape[0]
+    n_modes = second.n_modes
+    shape = (n_k_points, len(directions), n_modes, n_modes)
+    log_size(shape, _calculate_type(second, q_points), name='dynamical_matrix_derivatives')
+    if is_unfolding:
+        return _calculate_dynmat_from_table(second.unfolding_table, q_points, n_modes // 3, directions)
+    if distance_threshold is not None:
+        return _calculate_dynmat_from_table(second.neighbor_table(distance_threshold), q_points, n_modes // 3,
+                                            directions)
+    positions = second.atoms.positions
+    dynmat = np.asarray(second.dynmat)[0]
+    if second.n_replicas == 1:
+        distance = positions[:, np.newaxis, :] - positions[np.newaxis, :, :]
+        distance = wrap_coordinates(distance, second.replicated_atoms.cell, second.replicated_cell_inv)
+        dynmat_derivatives = contract('ijx,iajb->xiajb', distance[..., directions], dynmat[:, :, 0, :, :])
+        dynmat_derivatives = np.broadcast_to(dynmat_derivatives, (n_k_points, ) + dynmat_derivatives.shape)
+        return dynmat_derivatives.reshape(shape)
+    chi_k = _calculate_chi_k(second, q_points)
+    list_of_replicas = second.list_of_replicas
+    distance = positions[:, np.newaxis, np.newaxis, :] - (positions[np.newaxis, np.newaxis, :, :] +
+                                                          list_of_replicas[np.newaxis, :, np.newaxis, :])
+    distance = distance[..., directions]
+    dynmat_derivatives = contract('iljx,ialjb,kl->kxiajb', distance, dynmat, chi_k)
+    return dynmat_derivatives.reshape(shape)
+
+
+def calculate_eigensystem(dynmat_fourier, only_eigenvals=False):
+    """Diagonalize a stack of dynamical matrices with batched LAPACK calls.
+
+    Parameters
+    ----------
+    dynmat_fourier : np.array(n_k_points, n_modes, n_modes)
+
+    Returns
+    -------
+    eigensystem : np.array(n_k_points, n_modes + 1, n_modes)
+        eigenvalues in the first row and eigenvectors in the remaining rows, for each k point.
+        If only_eigenvals is True, only the (n_k_points, n_modes) eigenvalues are returned.
+    """
+    if only_eigenvals:
+        return np.linalg.eigvalsh(dynmat_fourier)
+    eigenvals, eigenvects = np.linalg.eigh(dynmat_fourier)
+    eigensystem = np.concatenate((eigenvals[:, np.newaxis, :], eigenvects), axis=1)
+    return eigensystem
+
+
+def calculate_eigensystem_in_window(dynmat_fourier, min_frequency=None, max_frequency=None):
+    """Diagonalize a single dynamical matrix, computing only the modes with frequency in
+    (min_frequency, max_frequency] THz, with the subset by value LAPACK drivers.
+
+    Returns
+    -------
+    eigensystem : np.array(n_modes + 1, n_window_modes)
+        eigenvalues in the first row and eigenvectors in the remaining rows.
+    """
+    spectral_bound = np.abs(dynmat_fourier).sum(axis=-1).max() + 1.
+    window = _calculate_eigenvalues_window(min_frequency, max_frequency, spectral_bound)
+    eigenvals, eigenvects = scipy.linalg.eigh(dynmat_fourier, subset_by_value=window)
+    logging.info('Calculated ' + str(eigenvals.shape[0]) + ' modes out of ' + str(dynmat_fourier.shape[0]) +
+                 ' in the frequency window')
+    return np.vstack((eigenvals[np.newaxis, :], eigenvects))
+
+
+def calculate_sparse_dynmat(second, distance_threshold=None, direction=None):
+    """Calculate the dynamical matrix at gamma, or its derivative along a cartesian direction, as a sparse
+    matrix of 3x3 blocks. Only the nonzero blocks of the force constants, or the interactions within
+    distance_threshold, are stored.
+
+    Returns
+    -------
+    sparse_dynmat : scipy.sparse.bsr_matrix(n_modes, n_modes)
+    """
+    if distance_threshold is not None:
+        table = second.neighbor_table(distance_threshold)
+    else:
+        table = second.sparse_table
+    n_modes = second.n_modes
+    blocks = table['weight'][:, np.newaxis, np.newaxis] * table['dynmat']
+    if direction is not None:
+        blocks = blocks * table['distance'][:, direction, np.newaxis, np.newaxis]
+    rows = 3 * table['i'][:, np.newaxis, np.newaxis] + np.arange(3)[np.newaxis, :, np.newaxis]
+    columns = 3 * table['j'][:, np.newaxis, np.newaxis] + np.arange(3)[np.newaxis, np.newaxis, :]
+    rows, columns = np.broadcast_arrays(rows, columns)
+
+    # The conversion to csr sums the blocks of the equivalent replicas of each couple of atoms
+    sparse_dynmat = coo_matrix((blocks.flatten(), (rows.flatten(), columns.flatten())), shape=(n_modes, n_modes))
+    return sparse_dynmat.tocsr().tobsr(blocksize=(3, 3))
+
+
+def calculate_eigensystem_sparse(sparse_dynmat, min_frequency=None, max_frequency=None,
+                                 n_modes_per_slice=MODES_PER_SLICE):
+    """Diagonalize a sparse dynamical matrix, computing only the modes with frequency in
+    (min_frequency, max_frequency] THz, with shift-invert Lanczos. The window is bisected into slices, until
+    each slice is solved by a single scipy.sparse.linalg.eigsh call around its center.
+
+    Parameters
+    ----------
+    sparse_dynmat : scipy.sparse.spmatrix(n_modes, n_modes)
+    min_frequency : float, optional
+    max_frequency : float, optional
+    n_modes_per_slice : int, optional
+        number of modes computed by each eigsh call. Default is MODES_PER_SLICE
+
+    Returns
+    -------
+    eigensystem : np.array(n_modes + 1, n_window_modes)
+        eigenvalues in the first row and eigenvectors in the remaining rows.
+    """
+    n_modes = sparse_dynmat.shape[0]
+    if n_modes_per_slice >= n_modes - 1:
+        return calculate_eigensystem_in_window(sparse_dynmat.toarray(), min_frequency, max_frequency)
+    spectral_bound = abs(sparse_dynmat).sum(axis=-1).max() + 1.
+    slices = [_calculate_eigenvalues_window(min_frequency, max_frequency, spectral_bound)]
+    eigenvals = []
+    eigenvects = []
+    while slices:
+        lower, upper = slices.pop()
+        shift = (lower + upper) / 2
+        slice_eigenvals, slice_eigenvects = scipy.sparse.linalg.eigsh(sparse_dynmat, k=n_modes_per_slice,
+                                                                      sigma=shift)
+
+        # eigsh finds the eigenvalues closest to the shift, the slice may hold more unless some fall outside
+        if np.abs(slice_eigenvals - shift).max() <= (upper - lower) / 2:
+            slices.extend([(lower, shift), (shift, upper)])
+            continue
+        is_in_slice = (slice_eigenvals > lower) & (slice_eigenvals <= upper)
+        eigenvals.append(slice_eigenvals[is_in_slice])
+        eigenvects.append(slice_eigenvects[:, is_in_slice])
+    eigenvals = np.concatenate(eigenvals)
+    order = np.argsort(eigenvals)
+    eigenvals = eigenvals[order]
+    eigenvects = np.concatenate(eigenvects, axis=1)[:, order]
+    logging.info('Calculated ' + str(eigenvals.shape[0]) + ' modes out of ' + str(n_modes) +
+                 ' in the frequency window, with the sparse eigensolver')
+    return np.vstack((eigenvals[np.newaxis, :], eigenvects))
+
+
+def calculate_frequency(eigenvals):
+    """Frequency in THz from the eigenvalues of the dynamical matrix. Imaginary modes get a negative frequency."""
+    frequency = np.abs(eigenvals) ** .5 * np.sign(eigenvals) / (np.pi * 2.)
+    return frequency
+
+
+def calculate_sij(eigenvectors, dynmat_derivatives):
+    """Flux operators, one for each direction of the derivatives.
+
+    Parameters
+    ----------
+    eigenvectors : np.array(n_k_points, n_modes, n_modes)
+    dynmat_derivatives : np.array(n_k_points, n_directions, n_modes, n_modes)
+
+    Returns
+    -------
+    sij : np.array(n_k_points, n_directions, n_modes, n_modes)
+    """
+    sij = contract('kin,kxij,kjm->kxnm', eigenvectors.conj(), dynmat_derivatives, eigenvectors)
+    return sij
+
+
+def calculate_velocity(frequency, sij):
+    """Group velocity from the diagonal of the flux operators, using Hellmann-Feynman theorem.
+
+    Returns
+    -------
+    velocity : np.array(n_k_points, n_modes, n_directions)
+    """
+    sij_diagonal = np.diagonal(sij, axis1=-2, axis2=-1)
+    return _calculate_velocity_from_sij_diagonal(frequency, sij_diagonal)
+
+
+def calculate_velocity_diagonal(frequency, eigenvectors, dynmat_derivatives, degeneracy_threshold=None):
+    """Group velocity computing only the diagonal of the flux operators, without building the full sij.
+    If degeneracy_threshold is given, the flux operator along DEGENERATE_SUBSPACE_DIRECTION is diagonalized
+    inside each subspace of degenerate modes, and the velocities along all the directions are calculated in
+    its eigenbasis, so that they don't depend on the basis chosen by the eigensolver.
+
+    Parameters
+    ----------
+    frequency : np.array(n_k_points, n_modes)
+        sorted in ascending order, as returned by calculate_frequency
+    eigenvectors : np.array(n_k_points, n_modes, n_modes)
+    dynmat_derivatives : np.array(n_k_points, n_directions, n_modes, n_modes)
+    degeneracy_threshold : float, optional
+        modes closer than degeneracy_threshold THz are considered degenerate. Default is None
+
+    Returns
+    -------
+    velocity : np.array(n_k_points, n_modes, n_directions)
+    """
+    derivatives_eigenvectors = contract('kxij,kjm->kxim', dynmat_derivatives, eigenvectors)
+    return _calculate_velocity_diagonal_from_product(frequency, eigenvectors, derivatives_eigenvectors,
+                                                     degeneracy_threshold)
+
+
+def calculate_dynmat_derivatives_dot(second, q_points, eigenvectors, distance_threshold=None, is_unfolding=False,
+                                     is_sparse=False):
+    """Product of the derivatives of the dynamical matrix along x, y and z with the eigenvectors, for a chunk
+    of q points. If is_sparse, the derivatives are sparse matrices and only gamma is available.
+
+    Returns
+    -------
+    derivatives_eigenvectors : np.array(n_k_points, 3, n_modes, n_eigenvectors)
+    """
+    if not is_sparse:
+        dynmat_derivatives = calculate_dynmat_derivatives(second, q_points, distance_threshold=distance_threshold,
+                                                          is_unfolding=is_unfolding)
+
+        # Keep the precision of the eigenvectors
+        type = np.finfo(eigenvectors.dtype).dtype
+        if np.iscomplexobj(dynmat_derivatives):
+            type = np.result_type(type, np.complex64)
+        dynmat_derivatives = dynmat_derivatives.astype(type, copy=False)
+        return contract('kxij,kjm->kxim', dynmat_derivatives, eigenvectors)
+    if not (np.atleast_2d(q_points) == 0).all():
+        raise ValueError('The sparse dynamical matrix is only available at gamma')
+    derivatives_eigenvectors = np.zeros((eigenvectors.shape[0], 3) + eigenvectors.shape[1:],
+                                        dtype=eigenvectors.dtype)
+    for alpha in range(3):
+        sparse_derivative = calculate_sparse_dynmat(second, distance_threshold=distance_threshold, direction=alpha)
+        for k_index in range(eigenvectors.shape[0]):
+            derivatives_eigenvectors[k_index, alpha] = sparse_derivative.dot(eigenvectors[k_index])
+    return derivatives_eigenvectors
+
+
+def calculate_eigensystem_at_q_points(second, q_points, distance_threshold=None, is_unfolding=False):
+    """Build and diagonalize the dynamical matrix for a chunk of q points.
+
+    Returns
+    -------
+    eigensystem : np.array(n_k_points, n_modes + 1, n_modes)
+    """
+    dynmat_fourier = calculate_dynmat_fourier(second, q_points, distance_threshold=distance_threshold,
+                                              is_unfolding=is_unfolding)
+    return calculate_eigensystem(dynmat_fourier)
+
+
+def calculate_eigenvalues_at_q_points(second, q_points, eigenvectors, distance_threshold=None, is_unfolding=False,
+                                      is_sparse=False):
+    """Eigenvalues for a chunk of q points, as Rayleigh quotients of the given eigenvectors, in double precision.
+
+    Returns
+    -------
+    eigenvalues : np.array(n_k_points, n_eigenvectors)
+    """
+    eigenvectors = eigenvectors.astype(np.result_type(eigenvectors.dtype, np.float64))
+    if is_sparse:
+        sparse_dynmat = calculate_sparse_dynmat(second, distance_threshold=distance_threshold)
+        dynmat_eigenvectors = np.array([sparse_dynmat.dot(eigenvectors_k) for eigenvectors_k in eigenvectors])
+    else:
+        dynmat_fourier = calculate_dynmat_fourier(second, q_points, distance_threshold=distance_threshold,
+                                                  is_unfolding=is_unfolding)
+        dynmat_eigenvectors = contract('kij,kjn->kin', dynmat_fourier, eigenvectors)
+    return contract('kin,kin->kn', eigenvectors.conj(), dynmat_eigenvectors).real
+
+
+def calculate_sij_at_q_points(second, q_points, eigenvectors, distance_threshold=None, is_unfolding=False,
+                              is_sparse=False):
+    """Flux operators along x, y and z for a chunk of q points, given their eigenvectors.
+
+    Returns
+    -------
+    sij : np.array(n_k_points, 3, n_modes, n_modes)
+    """
+    derivatives_eigenvectors = calculate_dynmat_derivatives_dot(second, q_points, eigenvectors,
+                                                                distance_threshold=distance_threshold,
+                                                                is_unfolding=is_unfolding,
+                                                                is_sparse=is_sparse)
+    return contract('kin,kxim->kxnm', eigenvectors.conj(), derivatives_eigenvectors)
+
+
+def calculate_velocity_at_q_points(second, q_points, eigenvectors, frequency, distance_threshold=None,
+                                   is_unfolding=False, degeneracy_threshold=None, is_sparse=False):
+    """Group velocity for a chunk of q points, given their eigenvectors and frequencies.
+
+    Returns
+    -------
+    velocity : np.array(n_k_points, n_modes, 3)
+    """
+    derivatives_eigenvectors = calculate_dynmat_derivatives_dot(second, q_points, eigenvectors,
+                                                                distance_threshold=distance_threshold,
+                                                                is_unfolding=is_unfolding,
+                                                                is_sparse=is_sparse)
+    return _calculate_velocity_diagonal_from_product(frequency, eigenvectors, derivatives_eigenvectors,
+                                                     degeneracy_threshold)
+
+
+def calculate_harmonic_at_q_points(second, q_points, distance_threshold=None, is_unfolding=False,
+                                   is_calculating_velocity=True, degeneracy_threshold=None):
+    """Eigensystem and group velocity for a chunk of q points, in a single pass.
+
+    Returns
+    -------
+    eigensystem : np.array(n_k_points, n_modes + 1, n_modes)
+    velocity : np.array(n_k_points, n_modes, 3)
+        None if not is_calculating_velocity
+    """
+    eigensystem = calculate_eigensystem_at_q_points(second, q_points, distance_threshold=distance_threshold,
+                                                    is_unfolding=is_unfolding)
+    if not is_calculating_velocity:
+        return eigensystem, None
+    frequency = calculate_frequency(eigensystem[:, 0, :].real)
+    velocity = calculate_velocity_at_q_points(second, q_points, eigensystem[:, 1:, :], frequency,
+                                              distance_threshold=distance_threshold, is_unfolding=is_unfolding,
+                                              degeneracy_threshold=degeneracy_threshold)
+    return eigensystem, velocity
+
+
+def calculate_acoustic_mode(eigenvectors, masses):
+    """Acoustic modes at gamma, the ones with more than half of their weight on the rigid translations of the
+    system. When only the modes in a frequency window are calculated, the acoustic modes are not necessarily the
+    first three, and may be partially or not at all in the window.
+
+    Returns
+    -------
+    acoustic_mode : np.array(n_modes) bool
+    """
+    translations = np.sqrt(masses)[:, np.newaxis, np.newaxis] * np.eye(3)[np.newaxis, :, :]
+    translations = translations.reshape((-1, 3)) / np.sqrt(masses.sum())
+    overlap = (np.abs(translations.T.dot(eigenvectors)) ** 2).sum(axis=0)
+    return overlap > 0.5
+
+
+def calculate_physical_mode(q_points, frequency, min_frequency=None, max_frequency=None, is_nw=False,
+                            acoustic_mode=None):
+    """Physical modes, excluding the acoustic modes at gamma, and the modes outside the frequency range.
+    The acoustic modes at gamma are the first three, four if is_nw, unless acoustic_mode is given.
+
+    Returns
+    -------
+    physical_mode : np.array(n_k_points, n_modes) bool
+    """
+    physical_mode = np.ones(frequency.shape, dtype=np.bool)
+    is_at_gamma = (q_points == 0).all(axis=1)
+    if acoustic_mode is not None:
+        physical_mode[np.ix_(is_at_gamma, acoustic_mode)] = False
+    elif is_nw:
+        physical_mode[is_at_gamma, :4] = False
+    else:
+        physical_mode[is_at_gamma, :3] = False
+    if min_frequency is not None:
+        physical_mode[frequency < min_frequency] = False
+    if max_frequency is not None:
+        physical_mode[frequency > max_frequency] = False
+    return physical_mode
+
+
+def calculate_population(frequency, temperature, hbar, physical_mode):
+    """Bose-Einstein population of the physical modes, zero elsewhere."""
+    kelvintothz = units.kB / units.J / (2 * np.pi * hbar) * 1e-12
+    temp = temperature * kelvintothz
+    population = np.zeros_like(frequency)
+    population[physical_mode] = 1. / (np.exp(frequency[physical_mode] / temp) - 1.)
+    return population
+
+
+def calculate_heat_capacity(frequency, population, temperature, hbar, physical_mode):
+    """Heat capacity of the physical modes in J/K, zero elsewhere."""
+    c_v = np.zeros_like(frequency)
+    kelvintothz = units.kB / units.J / (2 * np.pi * hbar) * 1e-12
+    temperature = temperature * kelvintothz
+    kelvintojoule = units.kB / units.J
+    f_be = population
+    c_v[physical_mode] = kelvintojoule * f_be[physical_mode] * (f_be[physical_mode] + 1) * frequency[
+        physical_mode] ** 2 / (temperature ** 2)
+    return c_v
+
+
+def calculate_thermodynamics(frequency, temperature, hbar, physical_mode):
+    """Harmonic thermodynamic properties of the physical modes, zero elsewhere, for a vector of temperatures.
+    The exponentials are evaluated as exp(-x) and expm1(-x), which don't overflow for the high frequency modes
+    at low temperature and keep their precision for the low frequency ones.
+
+    Parameters
+    ----------
+    frequency : np.array(...)
+        frequency in THz
+    temperature : np.array(n_temperatures)
+        Units: K
+    hbar : float
+    physical_mode : np.array(...) bool
+
+    Returns
+    -------
+    thermodynamics : dict
+        'population', 'heat_capacity' in J/K, 'free_energy' in J, 'entropy' in J/K and 'internal_energy' in J,
+        each a np.array(n_temperatures, ...)
+    """
+    kelvintojoule = units.kB / units.J
+    kelvintothz = units.kB / units.J / (2 * np.pi * hbar) * 1e-12
+    temperature = np.atleast_1d(temperature).reshape((-1, ) + (1, ) * np.ndim(frequency))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.where(physical_mode, frequency / (temperature * kelvintothz), 1)
+
+        # Everything in terms of exp(-x) and 1 - exp(-x), which are bounded for x > 0
+        exp_minus_x = np.exp(-x)
+        one_minus_exp = -np.expm1(-x)
+        population = exp_minus_x / one_minus_exp
+        heat_capacity = kelvintojoule * x ** 2 * exp_minus_x / one_minus_exp ** 2
+        log_occupation = np.log(one_minus_exp)
+    energy_scale = kelvintojoule * temperature
+    thermodynamics = {'population': population,
+                      'heat_capacity': heat_capacity,
+                      'free_energy': energy_scale * (x / 2 + log_occupation),
+                      'entropy': kelvintojoule * (x * population - log_occupation),
+                      'internal_energy': energy_scale * (x / 2 + x * population)}
+    for property in thermodynamics:
+        thermodynamics[property] = np.where(physical_mode, thermodynamics[property], 0)
+    return thermodynamics
+
+
+def calculate_heat_capacity_2d(frequency, population, heat_capacity, temperature, hbar, physical_mode):
+    """Generalized heat capacity for each couple of modes, in J/K, broadcasting over the leading axes.
+    classical case: k_b
+    quantum case: c_nm=hbar w_n w_m/T  * (n_n-n_m)/(w_m-w_n)
+
+    Returns
+    -------
+    c_v : np.array
+        (..., n_modes, n_modes) float
+    """
+    kelvintojoule = units.kB / units.J
+    kelvintothz = units.kB / units.J / (2 * np.pi * hbar) * 1e-12
+    temperature = temperature * kelvintothz
+    f_be = population
+    c_v_omega = (f_be[..., :, np.newaxis] - f_be[..., np.newaxis, :])
+    diff_omega = (frequency[..., :, np.newaxis] - frequency[..., np.newaxis, :])
+    mask_degeneracy = np.where(diff_omega == 0, True, False)
+
+    # value to do the division
+    diff_omega[mask_degeneracy] = 1
+    divide_omega = -1 / diff_omega
+    freq_sq = frequency[..., :, np.newaxis] * frequency[..., np.newaxis, :]
+
+    # remember here f_n-f_m/ w_m-w_n index reversed
+    c_v = freq_sq * c_v_omega * divide_omega
+    c_v = kelvintojoule * c_v / temperature
+
+    #Degeneracy part: let us substitute the wrong elements
+    heat_capacity_deg_2d = (heat_capacity[..., :, np.newaxis]
+                            + heat_capacity[..., np.newaxis, :]) / 2
+    c_v = np.where(mask_degeneracy, heat_capacity_deg_2d, c_v)
+
+    #Physical modes
+    c_v = c_v * physical_mode[..., :, np.newaxis] * physical_mode[..., np.newaxis, :]
+    return c_v
+
+
+def _calculate_velocity_diagonal_from_product(frequency, eigenvectors, derivatives_eigenvectors,
+                                              degeneracy_threshold=None):
+    sij_diagonal = contract('kim,kxim->kxm', eigenvectors.conj(), derivatives_eigenvectors).astype(np.complex)
+    if degeneracy_threshold is None:
+        return _calculate_velocity_from_sij_diagonal(frequency, sij_diagonal)
+    is_new_subspace = np.diff(frequency, axis=-1) > degeneracy_threshold
+    for k_index in np.argwhere(~is_new_subspace.all(axis=-1)).flatten():
+        subspaces = np.split(np.arange(frequency.shape[-1]), np.argwhere(is_new_subspace[k_index]).flatten() + 1)
+        for subspace in subspaces:
+            if subspace.shape[0] == 1:
+                continue
+            sij_block = contract('im,xin->xmn', eigenvectors[k_index][:, subspace].conj(),
+                                 derivatives_eigenvectors[k_index][:, :, subspace])
+            # The velocity is the imaginary part of sij, the hermitian part of -1j * sij
+            sij_block = (sij_block - sij_block.conj().transpose((0, 2, 1))) / 2j
+            # A single basis for all the directions, so that each mode has a well defined velocity vector
+            _, rotation = np.linalg.eigh(contract('x,xmn->mn', DEGENERATE_SUBSPACE_DIRECTION, sij_block))
+            sij_diagonal[k_index][:, subspace] = 1j * contract('mi,xmn,ni->xi', rotation.conj(), sij_block,
+                                                               rotation).real
+    return _calculate_velocity_from_sij_diagonal(frequency, sij_diagonal)
+
+
+def _calculate_velocity_from_sij_diagonal(frequency, sij_diagonal):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inverse_freq = (1 / np.sqrt(frequency)).astype(np.complex) ** 2
+        velocity = 1 / (2 * np.pi) * sij_diagonal * inverse_freq[:, np.newaxis, :] / 2
+    velocity = np.where(np.isnan(velocity.real), 0., velocity)
+    return velocity.imag.transpose((0, 2, 1))
+
+
+def _calculate_eigenvalues_window(min_frequency, max_frequency, spectral_bound):
+    """Window of eigenvalues corresponding to (min_frequency, max_frequency] THz. LAPACK needs finite bounds, so
+    the missing ones are replaced by spectral_bound, a bound on the absolute value of the eigenvalues.
+    """
+    window = [-spectral_bound, spectral_bound]
+    for index, frequency in enumerate([min_frequency, max_frequency]):
+        if frequency is not None:
+            window[index] = np.sign(frequency) * (2 * np.pi * frequency) ** 2
+    return window
+
+
+def _calculate_type(second, q_points):
+    if second.n_replicas == 1 or (q_points == 0).all():
+        return np.float
+    return np.complex
+
+
+def _calculate_chi_k(second, q_points):
+    chi_k = chi(q_points, second.list_of_replicas, second.cell_inv).T
+    if (q_points == 0).all():
+        chi_k = chi_k.real
+    return chi_k
+
+
+def _calculate_dynmat_from_table(table, q_points, n_unit_cell, directions=None):
+    """Sum the phase weighted entries of a real space table, like SecondOrder.neighbor_table, into the dynamical
+    matrix, or its derivatives along directions, for each q point.
+
+    Returns
+    -------
+    dynmat : np.array(n_k_points, n_directions, n_modes, n_modes)
+        with n_directions = 1 if directions is None
+    """
+    n_k_points = q_points.shape[0]
+    n_entries = table['i'].shape[0]
+    couples, couple_index = np.unique(table['i'] * n_unit_cell + table['j'], return_inverse=True)
+    n_couples = couples.shape[0]
+
+    # Sparse map from the entries of the table to the 3x3 blocks of each couple of atoms
+    rows = np.repeat(np.arange(n_entries), 9)
+    columns = (couple_index[:, np.newaxis] * 9 + np.arange(9)[np.newaxis, :]).flatten()
+    values = (table['weight'][:, np.newaxis, np.newaxis] * table['dynmat']).flatten()
+    entries_to_couples = csr_matrix((values, (rows, columns)), shape=(n_entries, n_couples * 9))
+
+    phase = np.exp(2j * np.pi * q_points.dot(table['replica'].T))
+    if directions is None:
+        phase = phase[:, np.newaxis, :]
+    else:
+        phase = phase[:, np.newaxis, :] * table['distance'][:, directions].T[np.newaxis, :, :]
+    n_directions = phase.shape[1]
+    couples_values = entries_to_couples.T.dot(phase.reshape((-1, n_entries)).T).T
+    dynmat = np.zeros((n_k_points * n_directions, n_unit_cell, n_unit_cell, 3, 3), dtype=np.complex)
+    dynmat[:, couples // n_unit_cell, couples % n_unit_cell] = couples_values.reshape((-1, n_couples, 3, 3))
+    dynmat = dynmat.transpose((0, 1, 3, 2, 4))
+    if (q_points == 0).all():
+        dynmat = dynmat.real
+    return dynmat.reshape((n_k_points, n_directions, n_unit_cell * 3, n_unit_cell * 3))
@@ -0,0 +1,60 @@
+"""
+kaldo
+Anharmonic Lattice Dynamics
+
+Interpolation of the observables per mode from a coarse k mesh
+"""
+import numpy as np
+from itertools import product
+from opt_einsum import contract
+import kaldo.controllers.harmonic as hmc
+from kaldo.helpers.logger import get_logger
+logging = get_logger()
+
+# Corners of the sub-cell of the coarse mesh around each q point
+CORNERS = np.array(list(product((0, 1), repeat=3)))
+
+
+def interpolate_on_mesh(q_points, coarse_kpts, coarse_observable, eigenvectors=None, coarse_eigenvectors=None,
+                        grid_type='C'):
+    """Periodic trilinear interpolation of an observable per mode, from a coarse k mesh to arbitrary q points.
+    Without eigenvectors, the modes are matched by band index. With eigenvectors, each mode at q gets the
+    average of the modes at each corner of the coarse sub-cell, weighted by the square overlap of the
+    eigenvectors, which follows the bands through crossings and degeneracies.
+
+    Parameters
+    ----------
+    q_points : np.array(n_q_points, 3)
+        q points in fractional coordinates of the reciprocal cell
+    coarse_kpts : (3) tuple
+    coarse_observable : np.array(n_coarse_k_points, n_modes)
+    eigenvectors : np.array(n_q_points, n_modes, n_modes), optional
+    coarse_eigenvectors : np.array(n_coarse_k_points, n_modes, n_modes), optional
+    grid_type : 'C' or 'F', optional
+        order of the coarse mesh. Default is 'C'
+
+    Returns
+    -------
+    observable : np.array(n_q_points, n_modes)
+    """
+    coarse_kpts = np.array(coarse_kpts)
+    scaled_q_points = q_points * coarse_kpts
+    lower_corner = np.floor(scaled_q_points)
+    fraction = scaled_q_points - lower_corner
+    weights = np.prod(np.where(CORNERS[np.newaxis, :, :], fraction[:, np.newaxis, :],
+                               1 - fraction[:, np.newaxis, :]), axis=-1)
+    corners = np.mod(lower_corner[:, np.newaxis, :] + CORNERS[np.newaxis, :, :], coarse_kpts).astype(np.int)
+    corner_ids = np.ravel_multi_index(corners.reshape((-1, 3)).T, coarse_kpts, order=grid_type)
+    corner_ids = corner_ids.reshape((-1, CORNERS.shape[0]))
+    if eigenvectors is None:
+        return contract('qc,qcm->qm', weights, coarse_observable[corner_ids])
+    n_q_points = q_points.shape[0]
+    n_modes = coarse_observable.shape[-1]
+    observable = np.zeros((n_q_points, n_modes))
+    chunk_size = hmc.calculate_chunk_size(n_q_points, n_modes, n_arrays=2 * CORNERS.shape[0])
+    for q_chunk in np.array_split(np.arange(n_q_points), int(np.ceil(n_q_points / chunk_size))):
+        overlap = contract('qin,qcim->qcnm', eigenvectors[q_chunk].conj(),
+                           coarse_eigenvectors[corner_ids[q_chunk]])
+        observable[q_chunk] = contract('qc,qcnm,qcm->qn', weights[q_chunk], np.abs(overlap) ** 2,
+                                       coarse_observable[corner_ids[q_chunk]])
+    return observable
@@ -0,0 +1,201 @@
+"""
+kaldo
+Anharmonic Lattice Dynamics
+
+Kernel polynomial method
+A. Weisse, G. Wellein, A. Alvermann, and H. Fehske, "The kernel polynomial method,"
+Rev. Mod. Phys., vol. 78, pp. 275-306, Mar. 2006.
+"""
+import numpy as np
+from opt_einsum import contract
+import kaldo.controllers.harmonic as hmc
+from kaldo.helpers.logger import get_logger
+logging = get_logger()
+
+N_MOMENTS = 256
+N_RANDOM_VECTORS = 16
+
+# Relative padding of the spectral bounds, to keep the rescaled spectrum strictly inside (-1, 1)
+BOUNDS_PADDING = 0.01
+
+
+def calculate_dos(phonons, frequency, n_moments=N_MOMENTS, n_vectors=N_RANDOM_VECTORS, seed=None):
+    """Vibrational density of states of an amorphous system with the kernel polynomial method. Only products
+    of the sparse dynamical matrix with vectors are used, so the cost is linear in the number of atoms.
+
+    Parameters
+    ----------
+    phonons : Phonons
+    frequency : np.array(n_frequencies)
+        frequencies in THz where the density of states is evaluated
+    n_moments : int, optional
+        number of Chebyshev moments, which sets the resolution. Default is N_MOMENTS
+    n_vectors : int, optional
+        number of random vectors of the stochastic trace. If None, the trace is exact, using all the unit
+        vectors. Default is N_RANDOM_VECTORS
+    seed : int, optional
+
+    Returns
+    -------
+    dos : np.array(n_frequencies)
+        density of states in 1/THz, normalized to the number of modes
+    """
+    sparse_dynmat = _calculate_sparse_dynmat(phonons)
+    bounds = calculate_spectral_bounds(sparse_dynmat)
+    moments = calculate_dos_moments(sparse_dynmat, bounds, n_moments, n_vectors, seed)
+    omega = 2 * np.pi * np.asarray(frequency)
+    scale = (bounds[1] - bounds[0]) / 2
+    x = _rescale(omega ** 2, bounds)
+    dos_x = _reconstruct(moments * jackson_kernel(n_moments), x)
+
+    # From the rescaled eigenvalues to the frequency in THz, d x = 2 omega d omega / scale, d omega = 2 pi d nu
+    return 2 * np.pi * 2 * omega / scale * dos_x
+
+
+def calculate_diffusivity(phonons, frequency, n_moments=N_MOMENTS, n_vectors=N_RANDOM_VECTORS, seed=None):
+    """Allen-Feldman diffusivity as a function of frequency, with the kernel polynomial method. The flux
+    operators are never built, only products of the sparse dynamical matrix and its derivatives with vectors.
+    The broadening of the resonance is given by the Jackson kernel, of width about pi / n_moments in the
+    rescaled spectrum.
+
+    Parameters
+    ----------
+    phonons : Phonons
+    frequency : np.array(n_frequencies)
+        frequencies in THz where the diffusivity is evaluated
+    n_moments : int, optional
+        number of Chebyshev moments along each axis. Default is N_MOMENTS
+    n_vectors : int, optional
+        number of random vectors of the stochastic trace. If None, the trace is exact. Default is N_RANDOM_VECTORS
+    seed : int, optional
+
+    Returns
+    -------
+    diffusivity : np.array(n_frequencies)
+        diffusivity in mm^2/s, averaged over the three directions
+    """
+    sparse_dynmat = _calculate_sparse_dynmat(phonons)
+    bounds = calculate_spectral_bounds(sparse_dynmat)
+    kernel = jackson_kernel(n_moments)
+    omega = 2 * np.pi * np.asarray(frequency)
+    scale = (bounds[1] - bounds[0]) / 2
+    x = _rescale(omega ** 2, bounds)
+    dos_x = _reconstruct(calculate_dos_moments(sparse_dynmat, bounds, n_moments, n_vectors, seed) * kernel, x)
+    flux_x = np.zeros_like(x)
+    for alpha in range(3):
+        sparse_derivative = hmc.calculate_sparse_dynmat(phonons.forceconstants.second,
+                                                        distance_threshold=phonons.forceconstants.distance_threshold,
+                                                        direction=alpha)
+        moments = calculate_diffusivity_moments(sparse_dynmat, sparse_derivative, bounds, n_moments, n_vectors,
+                                                seed)
+        flux_x += _reconstruct(kernel[:, np.newaxis] * moments * kernel[np.newaxis, :], x, x)
+
+    # Same units of Conductivity.diffusivity, sum_nm |S_nm|^2 pi delta(omega - omega_n) delta(omega - omega_m)
+    # / (4 omega_n omega_m), averaged over the directions, divided by the density of states
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diffusivity = np.pi * flux_x / (600 * scale * omega * dos_x)
+    return np.where(omega > 0, diffusivity, 0)
+
+
+def calculate_spectral_bounds(sparse_dynmat):
+    """Lower and upper bound of the eigenvalues from the Gershgorin circles, padded by BOUNDS_PADDING."""
+    diagonal = sparse_dynmat.diagonal()
+    radius = np.asarray(abs(sparse_dynmat).sum(axis=-1)).flatten() - np.abs(diagonal)
+    lower = (diagonal - radius).min()
+    upper = (diagonal + radius).max()
+    padding = BOUNDS_PADDING * (upper - lower)
+    return lower - padding, upper + padding
+
+
+def calculate_dos_moments(sparse_dynmat, bounds, n_moments=N_MOMENTS, n_vectors=N_RANDOM_VECTORS, seed=None):
+    """Chebyshev moments Tr[T_m(H)] of the rescaled dynamical matrix H, with stochastic trace estimation.
+
+    Returns
+    -------
+    moments : np.array(n_moments)
+    """
+    vectors = _calculate_random_vectors(sparse_dynmat.shape[0], n_vectors, seed)
+    moments = np.zeros(n_moments)
+    for m, chebyshev_vectors in enumerate(_iterate_chebyshev(sparse_dynmat, bounds, vectors, n_moments)):
+        moments[m] = np.sum(vectors * chebyshev_vectors)
+    return moments
+
+
+def calculate_diffusivity_moments(sparse_dynmat, sparse_derivative, bounds, n_moments=N_MOMENTS,
+                                  n_vectors=N_RANDOM_VECTORS, seed=None):
+    """Chebyshev moments Tr[dD^T T_k(H) dD T_l(H)] of the rescaled dynamical matrix H and its derivative dD
+    along one direction, with stochastic trace estimation. For each random vector, the n_moments vectors
+    dD T_l(H) r are stored, while T_k(H) dD r are generated one at a time.
+
+    Returns
+    -------
+    moments : np.array(n_moments, n_moments)
+    """
+    vectors = _calculate_random_vectors(sparse_dynmat.shape[0], n_vectors, seed)
+    moments = np.zeros((n_moments, n_moments))
+    for vector in vectors.T:
+        vector = vector[:, np.newaxis]
+        right_vectors = np.array([sparse_derivative.dot(chebyshev_vector)[:, 0] for chebyshev_vector in
+                                  _iterate_chebyshev(sparse_dynmat, bounds, vector, n_moments)])
+        left_start = sparse_derivative.dot(vector)
+        for k, left_vector in enumerate(_iterate_chebyshev(sparse_dynmat, bounds, left_start, n_moments)):
+            moments[k] += right_vectors.dot(left_vector[:, 0])
+    return moments
+
+
+def jackson_kernel(n_moments):
+    """Jackson damping factors of the Chebyshev moments, which remove the Gibbs oscillations."""
+    m = np.arange(n_moments)
+    angle = np.pi / (n_moments + 1)
+    return ((n_moments - m + 1) * np.cos(angle * m) + np.sin(angle * m) / np.tan(angle)) / (n_moments + 1)
+
+
+def _calculate_sparse_dynmat(phonons):
+    if not phonons._is_amorphous:
+        raise ValueError('The kernel polynomial method is only available when kpts is (1, 1, 1)')
+    return hmc.calculate_sparse_dynmat(phonons.forceconstants.second,
+                                       distance_threshold=phonons.forceconstants.distance_threshold)
+
+
+def _calculate_random_vectors(n_modes, n_vectors, seed):
+    """Random vectors r, normalized so that sum_r r^T A r estimates Tr[A]. If n_vectors is None, the unit
+    vectors, which give the exact trace.
+    """
+    if n_vectors is None:
+        return np.eye(n_modes)
+    random_state = np.random.RandomState(seed)
+    return random_state.choice([-1., 1.], size=(n_modes, n_vectors)) / np.sqrt(n_vectors)
+
+
+def _iterate_chebyshev(sparse_dynmat, bounds, vectors, n_moments):
+    """Yield T_m(H) vectors for m < n_moments, with H the dynamical matrix rescaled to (-1, 1)."""
+    center = (bounds[1] + bounds[0]) / 2
+    scale = (bounds[1] - bounds[0]) / 2
+    previous = vectors
+    yield previous
+    current = (sparse_dynmat.dot(vectors) - center * vectors) / scale
+    for _ in range(1, n_moments):
+        yield current
+        following = 2 * (sparse_dynmat.dot(current) - center * current) / scale - previous
+        previous, current = current, following
+
+
+def _rescale(eigenvalues, bounds):
+    center = (bounds[1] + bounds[0]) / 2
+    scale = (bounds[1] - bounds[0]) / 2
+    return (eigenvalues - center) / scale
+
+
+def _reconstruct(moments, x, y=None):
+    """Sum the Chebyshev series of a density from its damped moments, at the points x, or at the couples of
+    points (x, y) for the series in two variables.
+    """
+    n_moments = moments.shape[0]
+    weights = 2. * np.ones(n_moments)
+    weights[0] = 1.
+    polynomials_x = np.cos(np.arange(n_moments)[:, np.newaxis] * np.arccos(x)[np.newaxis, :])
+    if y is None:
+        return (weights * moments).dot(polynomials_x) / (np.pi * np.sqrt(1 - x ** 2))
+    polynomials_y = np.cos(np.arange(n_moments)[:, np.newaxis] * np.arccos(y)[np.newaxis, :])
+    density = contract('k,l,kl,kp,lp->p', weights, weights, moments, polynomials_x, polynomials_y)
+    return density / (np.pi ** 2 * np.sqrt(1 - x ** 2) * np.sqrt(1 - y ** 2))
@@ -18,6 +18,7 @@ from sklearn.neighbors.kde import KernelDensity
 from scipy import ndimage
 from kaldo.helpers.storage import get_folder_from_label
 from kaldo.observables.harmonic_with_q import HarmonicWithQ
+import kaldo.controllers.tetrahedron as tetrahedron
 import os
 
 BUFFER_PLOT = .2
@@ -130,15 +131,18 @@ def plot_vs_frequency(phonons, observable, observable_name, is_showing=True):
         plt.close()
 
 
-def plot_dos(phonons, bandwidth=.05,n_points=200, is_showing=True):
+def plot_dos(phonons, bandwidth=.05,n_points=200, is_showing=True, method='kde'):
     
     fig = plt.figure()
     physical_mode = phonons.physical_mode.flatten(order='C')
     frequency = phonons.frequency.flatten(order='C')
     frequency = frequency[physical_mode]
-    kde = KernelDensity(kernel='gaussian', bandwidth=bandwidth).fit(frequency.reshape(-1, 1))
     x = np.linspace(frequency.min(), phonons.frequency.max(), n_points)
-    y = np.exp(kde.score_samples(x.reshape((-1, 1))))
+    if method == 'tetrahedron':
+        y = tetrahedron.calculate_dos(phonons, x) / phonons.n_modes
+    else:
+        kde = KernelDensity(kernel='gaussian', bandwidth=bandwidth).fit(frequency.reshape(-1, 1))
+        y = np.exp(kde.score_samples(x.reshape((-1, 1))))
     plt.plot(x, y)
     plt.fill_between(x, y, alpha=.2)
     plt.xlabel("$\\nu$ (THz)", fontsize=16)
@@ -181,21 +185,29 @@ def plot_dispersion(phonons, n_k_points=300, is_showing=True, symprec=1e-3, is_n
     freqs_plot = []
     vel_plot = []
     vel_norm = []
-    for q_point in k_list:
-        phonon = HarmonicWithQ(q_point, phonons.forceconstants.second,
-                               distance_threshold=phonons.forceconstants.distance_threshold,
-                               storage='memory',
-                               is_nw=is_nw,
-                               is_unfolding=is_unfolding)
-        freqs_plot.append(phonon.frequency.flatten())
+    if is_unfolding == phonons.is_unfolding:
+        properties = ('frequency', 'velocity') if with_velocity else ('frequency', )
+        harmonic = phonons.evaluate_at(k_list, properties=properties)
+        freqs_plot = harmonic['frequency']
         if with_velocity:
-            val_value = phonon.velocity[0]
-            vel_plot.append(val_value)
-            vel_norm.append(np.linalg.norm(val_value, axis=-1))
-    freqs_plot = np.array(freqs_plot)
-    if with_velocity:
-        vel_plot = np.array(vel_plot)
-        vel_norm = np.array(vel_norm)
+            vel_plot = harmonic['velocity']
+            vel_norm = np.linalg.norm(vel_plot, axis=-1)
+    else:
+        for q_point in k_list:
+            phonon = HarmonicWithQ(q_point, phonons.forceconstants.second,
+                                   distance_threshold=phonons.forceconstants.distance_threshold,
+                                   storage='memory',
+                                   is_nw=is_nw,
+                                   is_unfolding=is_unfolding)
+            freqs_plot.append(phonon.frequency.flatten())
+            if with_velocity:
+                val_value = phonon.velocity[0]
+                vel_plot.append(val_value)
+                vel_norm.append(np.linalg.norm(val_value, axis=-1))
+        freqs_plot = np.array(freqs_plot)
+        if with_velocity:
+            vel_plot = np.array(vel_plot)
+            vel_norm = np.array(vel_norm)
     fig1, ax1 = plt.subplots()
     plt.tick_params(axis='both', which='minor', labelsize=16)
     plt.ylabel("$\\nu$ (THz)", fontsize=16)
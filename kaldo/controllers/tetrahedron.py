@@ -0,0 +1,132 @@
+"""
+kaldo
+Anharmonic Lattice Dynamics
+
+Linear tetrahedron method
+P. E. Blochl, O. Jepsen, and O. K. Andersen, "Improved tetrahedron method for Brillouin-zone integrations,"
+Phys. Rev. B, vol. 49, pp. 16223-16233, Jun. 1994.
+"""
+import numpy as np
+from opt_einsum import contract
+from kaldo.helpers.logger import get_logger
+logging = get_logger()
+
+# Corners of the two triangles the cross section of a tetrahedron is split into
+TRIANGLES = np.array([[0, 1, 2], [0, 2, 3]])
+
+
+def calculate_dos(phonons, frequency, is_projected=False):
+    """Vibrational density of states with the linear tetrahedron method. The frequencies are interpolated
+    linearly inside each tetrahedron of the k mesh, which gives a converged density of states on much coarser
+    meshes than a histogram or a kernel density estimate.
+
+    Parameters
+    ----------
+    phonons : Phonons
+    frequency : np.array(n_frequencies)
+        frequencies in THz where the density of states is evaluated
+    is_projected : bool, optional
+        if True, the density of states is projected on each atom of the unit cell, using the square modulus
+        of the eigenvectors as weights. Default is False
+
+    Returns
+    -------
+    dos : np.array(n_frequencies) or np.array(n_atoms, n_frequencies), if is_projected
+        density of states in 1/THz, normalized to the number of modes
+    """
+    tetrahedra = _calculate_tetrahedra(phonons)
+    n_tetrahedra = tetrahedra.shape[0]
+    corner_frequency = np.swapaxes(phonons.frequency[tetrahedra], 1, 2)
+    frequency = np.asarray(frequency)
+    if is_projected:
+        projection = calculate_atom_projection(phonons.eigenvectors, phonons.n_atoms)
+        corner_projection = projection[tetrahedra]
+        dos = np.zeros((phonons.n_atoms, frequency.shape[0]))
+    else:
+        dos = np.zeros(frequency.shape[0])
+    for i, nu in enumerate(frequency):
+        weights = calculate_tetrahedron_weights(corner_frequency, nu)
+        if is_projected:
+            dos[:, i] = contract('tmc,tcam->a', weights, corner_projection) / n_tetrahedra
+        else:
+            dos[i] = weights.sum() / n_tetrahedra
+    return dos
+
+
+def calculate_atom_projection(eigenvectors, n_atoms):
+    """Weight of each atom of the unit cell in each mode.
+
+    Returns
+    -------
+    projection : np.array(n_k_points, n_atoms, n_modes)
+    """
+    n_k_points = eigenvectors.shape[0]
+    n_modes = eigenvectors.shape[-1]
+    projection = np.abs(eigenvectors) ** 2
+    return projection.reshape((n_k_points, n_atoms, 3, n_modes)).sum(axis=2)
+
+
+def calculate_tetrahedron_weights(corner_frequency, frequency):
+    """Weights of the corners of each tetrahedron in the density of states at a given frequency. The sum over
+    the corners is the density of states of the tetrahedron, as a fraction of its volume. Each corner gets the
+    average of its barycentric coordinate over the cross section of the tetrahedron at the given frequency.
+
+    Parameters
+    ----------
+    corner_frequency : np.array(..., 4)
+        frequency at the corners of each tetrahedron
+    frequency : float
+
+    Returns
+    -------
+    weights : np.array(..., 4)
+        in 1/THz
+    """
+    shape = corner_frequency.shape
+    corner_frequency = corner_frequency.reshape((-1, 4))
+    weights = np.zeros_like(corner_frequency, dtype=np.float)
+    is_crossed = (corner_frequency.min(axis=-1) <= frequency) & (corner_frequency.max(axis=-1) > frequency)
+    crossed_frequency = corner_frequency[is_crossed]
+    order = np.argsort(crossed_frequency, axis=-1)
+    sorted_frequency = np.take_along_axis(crossed_frequency, order, axis=-1)
+    is_first = frequency < sorted_frequency[:, 1]
+    is_second = ~is_first & (frequency < sorted_frequency[:, 2])
+
+    # Cross section, as four points in barycentric coordinates. A triangle, when only a corner is on one side
+    edges = np.where(is_first[:, np.newaxis, np.newaxis], [[0, 1], [0, 2], [0, 3], [0, 3]],
+                     np.where(is_second[:, np.newaxis, np.newaxis], [[0, 2], [0, 3], [1, 3], [1, 2]],
+                              [[0, 3], [1, 3], [2, 3], [2, 3]]))
+    points = _calculate_edge_points(sorted_frequency, frequency, edges)
+
+    # Areas in the reference tetrahedron, where the barycentric coordinates of the last three corners are the
+    # cartesian ones. The areas are proportional to the ones in the reciprocal space
+    vertices = points[:, TRIANGLES, :]
+    sides = vertices[:, :, 1:, 1:] - vertices[:, :, :1, 1:]
+    areas = np.linalg.norm(np.cross(sides[:, :, 0, :], sides[:, :, 1, :]), axis=-1) / 2
+    centroids = vertices.sum(axis=2) / 3
+    gradient = np.linalg.norm(sorted_frequency[:, 1:] - sorted_frequency[:, :1], axis=-1)
+
+    # The volume of the reference tetrahedron is 1/6
+    sorted_weights = 6 * (areas[:, :, np.newaxis] * centroids).sum(axis=1) / gradient[:, np.newaxis]
+    crossed_weights = np.zeros_like(sorted_weights)
+    np.put_along_axis(crossed_weights, order, sorted_weights, axis=-1)
+    weights[is_crossed] = crossed_weights
+    return weights.reshape(shape)
+
+
+def _calculate_tetrahedra(phonons):
+    if phonons._is_amorphous:
+        raise ValueError('The tetrahedron method is not available when kpts is (1, 1, 1)')
+    return phonons._reciprocal_grid.tetrahedra(reciprocal_cell=phonons.atoms.cell.reciprocal())
+
+
+def _calculate_edge_points(sorted_frequency, frequency, edges):
+    """Points where the frequency is reached along the edges between the sorted corners, in barycentric
+    coordinates.
+    """
+    start = np.take_along_axis(sorted_frequency[..., np.newaxis, :], edges[..., :1], axis=-1)[..., 0]
+    end = np.take_along_axis(sorted_frequency[..., np.newaxis, :], edges[..., 1:], axis=-1)[..., 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.nan_to_num((frequency - start) / (end - start))
+    corners = np.eye(4)
+    return (1 - t)[..., np.newaxis] * corners[edges[..., 0]] + t[..., np.newaxis] * corners[edges[..., 1]]
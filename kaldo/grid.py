@@ -1,4 +1,5 @@
 import numpy as np
+from itertools import permutations
 from kaldo.helpers.logger import get_logger
 logging = get_logger()
 
@@ -52,3 +53,41 @@ class Grid:
             index_grid = wrap_coordinates(index_grid, np.diag(self.grid_shape))
         return np.rint(index_grid).astype(np.int)
 
+
+    def tetrahedra(self, reciprocal_cell=None):
+        """Split each sub-cell of the grid into six tetrahedra sharing one main diagonal, as in the linear
+        tetrahedron method. The shortest main diagonal is used, when the reciprocal cell is given.
+
+        Parameters
+        ----------
+        reciprocal_cell : np.array(3, 3), optional
+            reciprocal lattice vectors, as rows. Default is None, which uses the (0, 0, 0) - (1, 1, 1) diagonal
+
+        Returns
+        -------
+        tetrahedra : np.array(6 * grid_size, 4)
+            ids of the grid points at the corners of each tetrahedron
+        """
+        start = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]])
+        if reciprocal_cell is None:
+            diagonal_start = start[0]
+        else:
+            steps = np.asarray(reciprocal_cell) / np.array(self.grid_shape)[:, np.newaxis]
+            diagonals = (1 - 2 * start).dot(steps)
+            diagonal_start = start[np.argmin(np.linalg.norm(diagonals, axis=1))]
+
+        # Walk from one end of the diagonal to the other, one axis at a time, in the six possible orders
+        shifts = []
+        for axes in permutations(range(3)):
+            corner = diagonal_start.copy()
+            corners = [corner.copy()]
+            for axis in axes:
+                corner[axis] = 1 - corner[axis]
+                corners.append(corner.copy())
+            shifts.append(corners)
+        shifts = np.array(shifts)
+        index_grid = self.generate_index_grid()
+        corners = index_grid[:, np.newaxis, np.newaxis, :] + shifts[np.newaxis, :, :, :]
+        corners = np.mod(corners, self.grid_shape).reshape((-1, 3))
+        tetrahedra = np.ravel_multi_index(corners.T, self.grid_shape, order=self.order)
+        return tetrahedra.reshape((-1, 4))
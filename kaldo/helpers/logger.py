@@ -26,10 +26,7 @@ def log_size(shape, type=np.float, name=None, memory_threshold_in_mb=10):
     shape = np.array(shape)
     label_size =  str(int(psutil.virtual_memory().available/1e6)) + ' / '
     label_size +=  str(int(psutil.virtual_memory().total/1e6)) + ' MB'
-    if type == np.float:
-        size = 64
-    elif type == np.complex:
-        size = 128
+    size = np.dtype(type).itemsize * 8
     out = str(shape)
     out += ' * ' + str(type)
     memory_used_in_mb = np.prod(shape) * size / 8 * 1e-6
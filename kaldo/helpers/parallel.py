@@ -0,0 +1,254 @@
+"""
+kaldo
+Anharmonic Lattice Dynamics
+"""
+import numpy as np
+import multiprocessing
+from itertools import repeat
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from kaldo.helpers.logger import get_logger
+logging = get_logger()
+
+# Number of chunks each worker receives on average, to balance the load between the processes
+CHUNKS_PER_WORKER = 4
+
+_worker_second = None
+
+
+class SharedSecondOrder:
+    """Read-only view of a SecondOrder that can be sent to worker processes.
+    The dynamical matrix and the list of replicas live in shared memory, so that each worker maps the same
+    buffers instead of receiving a copy. Only the attributes used by kaldo.controllers.harmonic are exposed.
+
+    Parameters
+    ----------
+    second : SecondOrder
+    """
+    def __init__(self, second):
+        self.atoms = second.atoms
+        self.replicated_atoms = second.replicated_atoms
+        self.supercell = second.supercell
+        self.n_modes = second.n_modes
+        self.n_replicas = second.n_replicas
+        self.cell_inv = second.cell_inv
+        self.replicated_cell_inv = second.replicated_cell_inv
+        self.supercell_positions = second.supercell_positions
+        self.supercell_replicas = second.supercell_replicas
+        self._neighbor_tables = dict(second._neighbor_tables)
+        self._calculate_neighbor_table = type(second).calculate_neighbor_table
+        self._calculate_unfolding_table = type(second).calculate_unfolding_table
+        if hasattr(second, '_unfolding_table'):
+            self._unfolding_table = second._unfolding_table
+        if hasattr(second, '_sparse_table'):
+            self.sparse_table = second._sparse_table
+        self._memory = {}
+        self._buffers = {}
+        for name, array in (('dynmat', np.asarray(second.dynmat)),
+                            ('list_of_replicas', np.asarray(second.list_of_replicas))):
+            memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            buffer = np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)
+            buffer[...] = array
+            self._memory[name] = memory
+            self._buffers[name] = (memory.name, array.shape, array.dtype.str)
+        self._attach()
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_memory'] = {}
+        state.pop('dynmat')
+        state.pop('list_of_replicas')
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name, (memory_name, _, _) in self._buffers.items():
+            self._memory[name] = shared_memory.SharedMemory(name=memory_name)
+        self._attach()
+
+
+    def _attach(self):
+        arrays = {}
+        for name, (_, shape, dtype) in self._buffers.items():
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=self._memory[name].buf)
+            array.flags.writeable = False
+            arrays[name] = array
+        self.dynmat = arrays['dynmat']
+        self.list_of_replicas = arrays['list_of_replicas']
+
+
+    def neighbor_table(self, distance_threshold):
+        if distance_threshold not in self._neighbor_tables:
+            self._neighbor_tables[distance_threshold] = self._calculate_neighbor_table(self, distance_threshold)
+        return self._neighbor_tables[distance_threshold]
+
+
+    @property
+    def unfolding_table(self):
+        try:
+            return self._unfolding_table
+        except AttributeError:
+            self._unfolding_table = self._calculate_unfolding_table(self)
+            return self._unfolding_table
+
+
+    def unlink(self):
+        """Release the shared buffers. Call it only from the process that created them."""
+        self.dynmat = None
+        self.list_of_replicas = None
+        for memory in self._memory.values():
+            memory.close()
+            memory.unlink()
+        self._memory = {}
+
+
+class SharedArrays:
+    """Dictionary of numpy arrays living in shared memory, that can be sent to worker processes. Each worker maps
+    the same buffers instead of receiving a copy. The arrays are read only, except the ones in writable, where
+    the workers can write their results directly.
+
+    Parameters
+    ----------
+    arrays : dict of np.array
+    writable : tuple of str, optional
+        names of the arrays the workers can write to. Default is ()
+    """
+    def __init__(self, arrays, writable=()):
+        self.writable = tuple(writable)
+        self._memory = {}
+        self._buffers = {}
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            buffer = np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)
+            buffer[...] = array
+            self._memory[name] = memory
+            self._buffers[name] = (memory.name, array.shape, array.dtype.str)
+        self._attach()
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_memory'] = {}
+        state.pop('_arrays')
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name, (memory_name, _, _) in self._buffers.items():
+            self._memory[name] = shared_memory.SharedMemory(name=memory_name)
+        self._attach()
+
+
+    def _attach(self):
+        self._arrays = {}
+        for name, (_, shape, dtype) in self._buffers.items():
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=self._memory[name].buf)
+            array.flags.writeable = name in self.writable
+            self._arrays[name] = array
+
+
+    def __getitem__(self, name):
+        return self._arrays[name]
+
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+
+    def unlink(self):
+        """Release the shared buffers. Call it only from the process that created them."""
+        self._arrays = {}
+        for memory in self._memory.values():
+            memory.close()
+            memory.unlink()
+        self._memory = {}
+
+
+def calculate_n_chunks(n_k_points, chunk_size, n_workers=None):
+    """Number of chunks to split n_k_points into. Each chunk holds at most chunk_size k points and, when
+    n_workers is given, there are enough chunks to keep all the workers busy.
+    """
+    n_chunks = int(np.ceil(n_k_points / chunk_size))
+    if n_workers is not None and n_workers > 1:
+        n_chunks = max(n_chunks, min(n_k_points, n_workers * CHUNKS_PER_WORKER))
+    return n_chunks
+
+
+def map_with_second(function, second, iterables, n_workers=None):
+    """Evaluate function(second, *args) for each args in zip(*iterables) and yield the results in input order.
+    When n_workers is larger than one, the evaluations are spread across a pool of n_workers processes, which
+    share second read only. The processes are started with the spawn method, so scripts using this mode need
+    the usual `if __name__ == '__main__':` guard. Consider setting OMP_NUM_THREADS to avoid oversubscribing
+    the cores with threaded BLAS calls.
+
+    Parameters
+    ----------
+    function : callable
+        module level function, with a SecondOrder-like object as first argument
+    second : SecondOrder
+    iterables : list of iterables
+    n_workers : int, optional
+        Default is None, which evaluates everything in the current process.
+    """
+    if n_workers is None or n_workers <= 1:
+        for args in zip(*iterables):
+            yield function(second, *args)
+        return
+    shared_second = SharedSecondOrder(second)
+    try:
+        for result in _map_in_pool(function, shared_second, iterables, n_workers):
+            yield result
+    finally:
+        shared_second.unlink()
+
+
+def map_with_shared_arrays(function, arrays, iterables, n_workers=None, writable=()):
+    """Evaluate function(arrays, *args) for each args in zip(*iterables) and return the results in input order.
+    When n_workers is larger than one, the evaluations are spread across a pool of n_workers processes, which
+    map the arrays from shared memory. The arrays named in writable can be written by the workers, and are
+    copied back into arrays at the end. The same caveats of map_with_second apply.
+
+    Parameters
+    ----------
+    function : callable
+        module level function, with a dict-like of arrays as first argument
+    arrays : dict of np.array
+    iterables : list of iterables
+    n_workers : int, optional
+        Default is None, which evaluates everything in the current process, on arrays itself.
+    writable : tuple of str, optional
+        Default is ()
+    """
+    if n_workers is None or n_workers <= 1:
+        return [function(arrays, *args) for args in zip(*iterables)]
+    shared_arrays = SharedArrays(arrays, writable=writable)
+    try:
+        results = list(_map_in_pool(function, shared_arrays, iterables, n_workers))
+        for name in writable:
+            arrays[name][...] = shared_arrays[name]
+    finally:
+        shared_arrays.unlink()
+    return results
+
+
+def _map_in_pool(function, shared, iterables, n_workers):
+    logging.info('Using ' + str(n_workers) + ' worker processes')
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_initialize_worker,
+                             initargs=(shared, )) as executor:
+        for result in executor.map(_call_with_second, repeat(function), *iterables):
+            yield result
+
+
+def _initialize_worker(shared_second):
+    global _worker_second
+    _worker_second = shared_second
+
+
+def _call_with_second(function, *args):
+    return function(_worker_second, *args)
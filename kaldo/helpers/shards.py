@@ -0,0 +1,138 @@
+"""
+kaldo
+Anharmonic Lattice Dynamics
+
+Shards of the anharmonic projection, saved independently so that a calculation can be split across batch jobs
+and restarted after an interruption
+"""
+import numpy as np
+import hashlib
+import json
+import os
+import re
+from scipy.sparse import coo_matrix, issparse
+from kaldo.helpers.logger import get_logger
+logging = get_logger()
+
+SHARDS_FOLDER = 'shards'
+
+
+def split_phonons(n_phonons, n_shards):
+    """Split the phonons into n_shards contiguous ranges of similar size.
+
+    Returns
+    -------
+    ranges : list of (start, stop) tuples
+    """
+    bounds = np.linspace(0, n_phonons, n_shards + 1).round().astype(np.int)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def calculate_forceconstants_hash(forceconstants):
+    """Hash of the values of the second and third order, identifying the force constants a shard was calculated
+    with.
+
+    Returns
+    -------
+    hash : str
+    """
+    forceconstants_hash = hashlib.sha1()
+    forceconstants_hash.update(np.ascontiguousarray(forceconstants.second.value).tobytes())
+    third = forceconstants.third.value
+    if hasattr(third, 'coords'):
+        forceconstants_hash.update(np.ascontiguousarray(third.coords).tobytes())
+        forceconstants_hash.update(np.ascontiguousarray(third.data).tobytes())
+    else:
+        forceconstants_hash.update(np.ascontiguousarray(third).tobytes())
+    return forceconstants_hash.hexdigest()
+
+
+def get_shard_metadata(metadata, start, stop):
+    """Metadata of the shard of the phonons in range(start, stop)."""
+    return dict(metadata, start=int(start), stop=int(stop))
+
+
+def get_shard_file(folder, property, start, stop):
+    return folder + '/' + SHARDS_FOLDER + '/' + property + '_' + str(start) + '_' + str(stop) + '.npz'
+
+
+def is_complete(folder, property, start, stop, metadata):
+    """True if the shard exists and was calculated with the same metadata. Shards are written to a temporary
+    file first and then renamed, so an existing shard file is always complete.
+    """
+    shard_file = get_shard_file(folder, property, start, stop)
+    if not os.path.exists(shard_file):
+        return False
+    with np.load(shard_file) as shard:
+        return json.loads(str(shard['metadata'])) == get_shard_metadata(metadata, start, stop)
+
+
+def save_shard(folder, property, start, stop, block, metadata):
+    """Save the rows of the phonons in range(start, stop), along with the metadata of the calculation and the
+    range of the shard. Sparse blocks are saved as their nonzero entries.
+
+    Returns
+    -------
+    shard_file : str
+    """
+    shard_file = get_shard_file(folder, property, start, stop)
+    os.makedirs(os.path.dirname(shard_file), exist_ok=True)
+    temporary_file = shard_file[:-len('.npz')] + '_' + str(os.getpid()) + '.tmp.npz'
+    metadata = json.dumps(get_shard_metadata(metadata, start, stop))
+    if issparse(block):
+        block = block.tocoo()
+        np.savez(temporary_file, row=block.row, col=block.col, data=block.data, shape=block.shape,
+                 metadata=metadata)
+    else:
+        np.savez(temporary_file, block=block, metadata=metadata)
+    os.replace(temporary_file, shard_file)
+    logging.info(shard_file + ' stored')
+    return shard_file
+
+
+def load_shards(folder, property, n_phonons, metadata):
+    """Assemble the rows of all the shards of a property. Raises ValueError if the shards were calculated with
+    different metadata, if some phonons are in more than one shard, or if some phonons are not in any shard.
+
+    Returns
+    -------
+    merged : np.array(n_phonons, ...) or scipy.sparse.csr_matrix(n_phonons, ...), for sparse shards
+    """
+    shards_folder = folder + '/' + SHARDS_FOLDER
+    pattern = re.compile(re.escape(property) + r'_(\d+)_(\d+)\.npz$')
+    shard_files = os.listdir(shards_folder) if os.path.isdir(shards_folder) else []
+    merged = None
+    sparse_entries = []
+    is_covered = np.zeros(n_phonons, dtype=np.bool)
+    for shard_file in sorted(shard_files):
+        if not pattern.match(shard_file):
+            continue
+        with np.load(shards_folder + '/' + shard_file) as shard:
+            shard_metadata = json.loads(str(shard['metadata']))
+            start = shard_metadata.pop('start')
+            stop = shard_metadata.pop('stop')
+            if shard_metadata != metadata:
+                raise ValueError('The shard ' + shard_file + ' was calculated with different parameters: ' +
+                                 str(shard['metadata']))
+            if is_covered[start:stop].any():
+                overlapping = np.argwhere(is_covered[start:stop]).flatten() + start
+                raise ValueError('The shard ' + shard_file + ' overlaps with other shards of ' + property +
+                                 ' in ' + shards_folder + ', starting from phonon ' + str(overlapping[0]))
+            if 'data' in shard.files:
+                n_columns = int(shard['shape'][1])
+                sparse_entries.append((shard['row'] + start, shard['col'], shard['data']))
+            else:
+                block = shard['block']
+                if merged is None:
+                    merged = np.zeros((n_phonons, ) + block.shape[1:])
+                merged[start:stop] = block
+        is_covered[start:stop] = True
+    if not is_covered.all():
+        missing = np.argwhere(~is_covered).flatten()
+        raise ValueError(str(missing.shape[0]) + ' phonons are missing from the shards of ' + property +
+                         ' in ' + shards_folder + ', starting from phonon ' + str(missing[0]))
+    if sparse_entries:
+        row, col, data = [np.concatenate(entries) for entries in zip(*sparse_entries)]
+        merged = coo_matrix((data, (row, col)), shape=(n_phonons, n_columns)).tocsr()
+    logging.info('Merged the shards of ' + property + ' in ' + shards_folder)
+    return merged
@@ -1,6 +1,7 @@
 import numpy as np
 import os
 from sparse import COO
+from scipy.sparse import csr_matrix, issparse, load_npz, save_npz
 from kaldo.helpers.logger import get_logger
 logging = get_logger()
 
@@ -26,8 +27,16 @@ DEFAULT_STORE_FORMATS = {'physical_mode': 'formatted',
                          '_eigensystem': 'numpy',
                          '_ps_and_gamma': 'numpy',
                          '_ps_gamma_and_gamma_tensor': 'numpy',
+                         '_sparse_ps_gamma_and_gamma_tensor': 'numpy',
                          '_generalized_diffusivity': 'numpy'}
 
+# Large arrays opened as read only memory maps when stored in numpy format, so that only the slices in use are read
+MEMORY_MAPPED_PROPERTIES = ('_eigensystem', 'velocity', '_ps_gamma_and_gamma_tensor')
+
+# Properties stored as scipy sparse matrices, in the npz format of scipy when stored in numpy format, and as the
+# data, indices, indptr and shape datasets of the csr format when stored in hdf5 format
+SPARSE_PROPERTIES = ('_sparse_ps_gamma_and_gamma_tensor', )
+
 
 def parse_pair(txt):
     return complex(txt.strip("()"))
@@ -37,11 +46,17 @@ def load(property, folder, instance, format='formatted'):
     # TODO: move this into single observables
     name = folder + '/' + property
     if format == 'numpy':
-        loaded = np.load(name + '.npy', allow_pickle=True)
+        if property in SPARSE_PROPERTIES:
+            return load_npz(name + '.npz')
+        mmap_mode = 'r' if property in MEMORY_MAPPED_PROPERTIES else None
+        loaded = np.load(name + '.npy', allow_pickle=True, mmap_mode=mmap_mode)
         return loaded
     elif format == 'hdf5':
         with h5py.File(name.split('/')[0] + '.hdf5', 'r') as storage:
             loaded = storage[name]
+            if property in SPARSE_PROPERTIES:
+                return csr_matrix((loaded['data'][()], loaded['indices'][()], loaded['indptr'][()]),
+                                  shape=tuple(loaded['shape'][()]))
             return loaded[()]
     elif format == 'formatted':
         if property == 'physical_mode':
@@ -92,12 +107,23 @@ def save(property, folder, loaded_attr, format='formatted'):
     if format == 'numpy':
         if not os.path.exists(folder):
             os.makedirs(folder)
-        np.save(name + '.npy', loaded_attr)
+        if issparse(loaded_attr):
+            save_npz(name + '.npz', loaded_attr)
+        else:
+            np.save(name + '.npy', loaded_attr)
         logging.info(name + ' stored')
     elif format == 'hdf5':
         with h5py.File(name.split('/')[0] + '.hdf5', 'a') as storage:
             if not name in storage:
-                storage.create_dataset(name, data=loaded_attr, chunks=True, compression='gzip', compression_opts=9)
+                if issparse(loaded_attr):
+                    loaded_attr = loaded_attr.tocsr()
+                    group = storage.create_group(name)
+                    for dataset in ('data', 'indices', 'indptr'):
+                        group.create_dataset(dataset, data=getattr(loaded_attr, dataset), chunks=True,
+                                             compression='gzip', compression_opts=9)
+                    group.create_dataset('shape', data=loaded_attr.shape)
+                else:
+                    storage.create_dataset(name, data=loaded_attr, chunks=True, compression='gzip', compression_opts=9)
         logging.info(name + ' stored')
     elif format == 'formatted':
         # loaded_attr = np.nan_to_num(loaded_attr)
@@ -166,6 +192,10 @@ def get_folder_from_label(instance, label='', base_folder=None):
         if '<third_bandwidth>' in label:
             if instance.third_bandwidth is not None:
                 base_folder += '/tb_' + str(np.mean(instance.third_bandwidth))
+            bandwidth_kpts = getattr(instance, 'bandwidth_kpts', None)
+            if bandwidth_kpts is not None:
+                base_folder += '/bk_' + str(bandwidth_kpts[0]) + '_' + str(bandwidth_kpts[1]) + '_' \
+                               + str(bandwidth_kpts[2])
 
         if '<method>' in label:
             base_folder += '/' + str(instance.method)
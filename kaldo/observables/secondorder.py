@@ -7,12 +7,16 @@ import numpy as np
 from kaldo.interface.eskm_io import import_from_files
 import kaldo.interface.shengbte_io as shengbte_io
 from kaldo.controllers.displacement import calculate_second
+from kaldo.grid import wrap_coordinates
 import ase.units as units
 from kaldo.helpers.logger import get_logger, log_size
 logging = get_logger()
 
 SECOND_ORDER_FILE = 'second.npy'
 
+# Memory of the temporary arrays used to scan the dense force constants for their nonzero blocks
+SPARSE_TABLE_CHUNK_MEMORY_IN_MB = 64
+
 
 def acoustic_sum_rule(dynmat):
     n_unit = dynmat[0].shape[0]
@@ -38,6 +42,8 @@ class SecondOrder(ForceConstant):
             self.value = acoustic_sum_rule(self.value)
         self.n_modes = self.atoms.positions.shape[0] * 3
         self._list_of_replicas = None
+        self._neighbor_tables = {}
+        self._harmonic_with_q = {}
         self.storage = 'numpy'
 
 
@@ -199,6 +205,24 @@ class SecondOrder(ForceConstant):
             return self._supercell_positions
 
 
+    @property
+    def unfolding_table(self):
+        try:
+            return self._unfolding_table
+        except AttributeError:
+            self._unfolding_table = self.calculate_unfolding_table()
+            return self._unfolding_table
+
+
+    @property
+    def sparse_table(self):
+        try:
+            return self._sparse_table
+        except AttributeError:
+            self._sparse_table = self.calculate_sparse_table()
+            return self._sparse_table
+
+
     @property
     def dynmat(self):
         try:
@@ -208,6 +232,24 @@ class SecondOrder(ForceConstant):
             return self._dynmat
 
 
+    def neighbor_table(self, distance_threshold):
+        """Real space table of the interactions between atoms closer than distance_threshold. The table is
+        calculated once for each threshold and reused for every q point.
+
+        Returns
+        -------
+        neighbor_table : dict
+            'i', 'j': (n_entries) atoms of each interaction, sorted by couple
+            'replica': (n_entries, 3) lattice vector in reduced coordinates, defining the phase exp(2 pi i q.replica)
+            'weight': (n_entries) weight of each interaction
+            'distance': (n_entries, 3) distance vector used for the derivatives of the dynamical matrix
+            'dynmat': (n_entries, 3, 3) block of the dynamical matrix
+        """
+        if distance_threshold not in self._neighbor_tables:
+            self._neighbor_tables[distance_threshold] = self.calculate_neighbor_table(distance_threshold)
+        return self._neighbor_tables[distance_threshold]
+
+
     def calculate(self, calculator, delta_shift=1e-3, is_storing=True, is_verbose=False):
         atoms = self.atoms
         replicated_atoms = self.replicated_atoms
@@ -244,6 +286,125 @@ class SecondOrder(ForceConstant):
         return tf.convert_to_tensor(dynmat * evtotenjovermol)
 
 
+    def calculate_neighbor_table(self, distance_threshold):
+        atoms = self.atoms
+        positions = atoms.positions
+        n_unit_cell = positions.shape[0]
+        list_of_replicas = self.list_of_replicas
+        replicated_positions = self.replicated_atoms.positions.reshape((self.n_replicas, n_unit_cell, 3))
+        distance_to_wrap = positions[:, np.newaxis, np.newaxis, :] - replicated_positions[np.newaxis, :, :, :]
+        wrapped_distance = wrap_coordinates(distance_to_wrap, self.replicated_atoms.cell, self.replicated_cell_inv)
+        mask = np.linalg.norm(wrapped_distance, axis=-1) < distance_threshold
+        id_i, id_l, id_j = np.argwhere(mask.transpose((0, 2, 1)))[:, [0, 2, 1]].T
+        if self.n_replicas == 1:
+            distance = wrapped_distance[id_i, id_l, id_j]
+        else:
+            distance = positions[id_i] - (positions[id_j] + list_of_replicas[id_l])
+        replica = np.round(list_of_replicas.dot(self.cell_inv)).astype(np.int)
+        dynmat = np.asarray(self.dynmat)[0]
+        logging.info('Neighbor table with ' + str(id_i.shape[0]) + ' interactions within ' +
+                     str(distance_threshold) + ' A')
+        neighbor_table = {'i': id_i,
+                          'j': id_j,
+                          'replica': replica[id_l],
+                          'weight': np.ones(id_i.shape[0]),
+                          'distance': distance,
+                          'dynmat': dynmat[id_i, :, 0, id_j, :]}
+        return neighbor_table
+
+
+    def calculate_sparse_table(self):
+        """Real space table of the nonzero blocks of the dynamical matrix, with the same layout of neighbor_table.
+        If the force constants are a sparse.COO array, the blocks are taken from its nonzero entries. Otherwise the
+        dense force constants are scanned by chunks of atoms, so that no other array of their size is created.
+        """
+        positions = self.atoms.positions
+        mass = self.atoms.get_masses()
+        if hasattr(self.value, 'coords'):
+            id_i, id_l, id_j, blocks = self._find_sparse_blocks(self.value)
+        else:
+            id_i, id_l, id_j, blocks = self._find_dense_blocks(np.asarray(self.value)[0])
+        list_of_replicas = self.list_of_replicas
+        if self.n_replicas == 1:
+            distance = wrap_coordinates(positions[id_i] - positions[id_j], self.replicated_atoms.cell,
+                                        self.replicated_cell_inv)
+        else:
+            distance = positions[id_i] - (positions[id_j] + list_of_replicas[id_l])
+        replica = np.round(list_of_replicas.dot(self.cell_inv)).astype(np.int)
+        evtotenjovermol = units.mol / (10 * units.J)
+        dynmat = blocks / np.sqrt(mass[id_i] * mass[id_j])[:, np.newaxis, np.newaxis]
+        logging.info('Sparse table with ' + str(id_i.shape[0]) + ' blocks out of ' +
+                     str(positions.shape[0] ** 2 * self.n_replicas))
+        sparse_table = {'i': id_i,
+                        'j': id_j,
+                        'replica': replica[id_l],
+                        'weight': np.ones(id_i.shape[0]),
+                        'distance': distance,
+                        'dynmat': dynmat * evtotenjovermol}
+        return sparse_table
+
+
+    def _find_dense_blocks(self, value):
+        n_atoms = value.shape[0]
+        n_rows = max(1, int(SPARSE_TABLE_CHUNK_MEMORY_IN_MB * 1e6 / value[0].size))
+        ids = []
+        blocks = []
+        for start in range(0, n_atoms, n_rows):
+            chunk_i, chunk_l, chunk_j = np.argwhere((value[start:start + n_rows] != 0).any(axis=(1, 4))).T
+            chunk_i = chunk_i + start
+            ids.append((chunk_i, chunk_l, chunk_j))
+            blocks.append(value[chunk_i, :, chunk_l, chunk_j, :])
+        id_i, id_l, id_j = [np.concatenate(chunk_id) for chunk_id in zip(*ids)]
+        return id_i, id_l, id_j, np.concatenate(blocks)
+
+
+    def _find_sparse_blocks(self, value):
+        coords = value.coords
+        block_coords, block_index = np.unique(coords[[1, 3, 4]], axis=1, return_inverse=True)
+        blocks = np.zeros((block_coords.shape[1], 3, 3))
+        np.add.at(blocks, (block_index.flatten(), coords[2], coords[5]), value.data)
+        id_i, id_l, id_j = block_coords
+        return id_i, id_l, id_j, blocks
+
+
+    def calculate_unfolding_table(self):
+        """Real space table of the interactions used to unfold the dynamical matrix, with the same layout of
+        neighbor_table. Each couple of atoms interacts through the replicas inside its Wigner-Seitz cell of the
+        supercell, with weight 1 / n, when the interaction is shared between n equivalent replicas.
+        """
+        scell = self.supercell
+        atoms = self.atoms
+        positions = atoms.positions
+        n_unit_cell = positions.shape[0]
+        fc_s = np.asarray(self.dynmat).reshape((n_unit_cell, 3, scell[0], scell[1], scell[2], n_unit_cell, 3))
+        sc_r_pos = self.supercell_positions
+        sc_r_pos_norm = 1 / 2 * np.linalg.norm(sc_r_pos, axis=1) ** 2
+        tt = self.supercell_replicas
+        replica_positions = tt.dot(atoms.cell)
+        id_i, id_j, id_t, weight = [], [], [], []
+        for ind in range(tt.shape[0]):
+            distance = replica_positions[ind] + positions[:, np.newaxis, :] - positions[np.newaxis, :, :]
+            projection = distance.dot(sc_r_pos.T) - sc_r_pos_norm
+            iat, jat = np.argwhere((projection <= 1e-6).all(axis=-1)).T
+            neq = (np.abs(projection[iat, jat]) <= 1e-6).sum(axis=-1)
+            id_i.append(iat)
+            id_j.append(jat)
+            id_t.append(np.full(iat.shape[0], ind))
+            weight.append(1.0 / neq)
+        id_i, id_j, id_t, weight = (np.concatenate(array) for array in (id_i, id_j, id_t, weight))
+        order = np.lexsort((id_t, id_j, id_i))
+        id_i, id_j, id_t, weight = id_i[order], id_j[order], id_t[order], weight[order]
+        t = tt[id_t]
+        dynmat = fc_s[id_j, :, t[:, 0], t[:, 1], t[:, 2], id_i, :].transpose((0, 2, 1))
+        unfolding_table = {'i': id_i,
+                           'j': id_j,
+                           'replica': - t,
+                           'weight': weight,
+                           'distance': - replica_positions[id_t],
+                           'dynmat': dynmat}
+        return unfolding_table
+
+
     def calculate_super_replicas(self):
         scell = self.supercell
         n_replicas = np.prod(scell)
@@ -6,16 +6,28 @@ Anharmonic Lattice Dynamics
 from kaldo.helpers.storage import is_calculated
 from kaldo.helpers.storage import lazy_property
 from kaldo.helpers.logger import log_size
-from kaldo.helpers.storage import DEFAULT_STORE_FORMATS, FOLDER_NAME
+from kaldo.helpers.storage import DEFAULT_STORE_FORMATS, FOLDER_NAME, LAZY_PREFIX
+from kaldo.helpers.storage import get_folder_from_label, save
 from kaldo.grid import Grid
-from kaldo.observables.harmonic_with_q import HarmonicWithQ
-from kaldo.observables.harmonic_with_q_temp import HarmonicWithQTemp
+from kaldo.symmetry import KPointSymmetry
 import kaldo.controllers.anharmonic as aha
+import kaldo.controllers.harmonic as hmc
+import kaldo.controllers.interpolation as interpolation
+import kaldo.helpers.parallel as parallel
+import kaldo.helpers.shards as shards
 import numpy as np
+from functools import partial
+from scipy.sparse import issparse
 import ase.units as units
 from kaldo.helpers.logger import get_logger
 logging = get_logger()
 
+HARMONIC_PROPERTIES = ('q_point', 'frequency', 'eigenvectors', 'velocity', 'physical_mode', 'population',
+                       'heat_capacity')
+
+# Lazy properties that don't depend on the temperature
+HARMONIC_LAZY_PROPERTIES = ('physical_mode', 'frequency', 'velocity', '_eigensystem', 'eigenvalues')
+
 
 class Phonons:
     """The Phonons object exposes all the phononic properties of a system.
@@ -63,6 +75,54 @@ class Phonons:
         Default 'C'
     is_balanced : Enforce detailed balance when calculating anharmonic properties,
         Default: False
+    n_workers : int, optional
+        Number of worker processes used to evaluate the harmonic properties on the k points, and to project
+        the third order on the modes. The dynamical matrix, the third order and the harmonic properties are
+        shared read only between the workers. Default is `None`, which runs in the current process.
+    is_using_symmetry : bool, optional
+        Use the space group of the crystal, found by spglib, to calculate the harmonic properties only on the
+        irreducible k points. Frequencies, velocities and eigenvectors are then unfolded to the full k mesh.
+        The anharmonic projection is also done only on the irreducible k points, and phase space, bandwidth and
+        scattering tensor are replicated to the full k mesh. Inside the degenerate subspaces the modes are paired
+        with velocities in a different basis, and the conductivity of each direction differs by less than one
+        percent from the calculation on the full k mesh. The adaptive broadening, used when `third_bandwidth` is
+        not defined, depends on the orientation of the k mesh and is not invariant under the symmetry
+        operations: in that case only the harmonic properties use the symmetry, and the anharmonic projection
+        is done on the full k mesh.
+        Default is `False`
+    degeneracy_threshold : float, optional
+        If defined, modes whose frequencies differ less than `degeneracy_threshold` THz are considered
+        degenerate, and their velocities are obtained diagonalizing a combination of the velocity operators
+        along x, y and z in the degenerate subspace. Each mode then has a velocity vector calculated in a single
+        basis, which doesn't depend on the basis chosen by the eigensolver.
+        Default is `None`
+    is_solving_frequency_window : bool, optional
+        Compute only the modes with frequency between `min_frequency` and `max_frequency`, using a partial
+        eigensolver. All the arrays over the modes shrink to the modes in the window. Only available for
+        amorphous systems, where the k mesh is (1, 1, 1).
+        Default is `False`
+    is_using_sparse_dynmat : bool, optional
+        Store the dynamical matrix and its derivatives as sparse matrices of 3x3 blocks, and compute the modes
+        in the frequency window with shift-invert Lanczos, for large amorphous systems. It implies
+        `is_solving_frequency_window`.
+        Default is `False`
+    is_using_sparse_gamma_tensor : bool, optional
+        Accumulate and store the scattering tensor as a sparse matrix, with only the couples of modes allowed by
+        the energy conservation, instead of a dense (n_phonons, n_phonons) array. The self-consistent and the
+        inverse solvers of the conductivity then use it as a sparse matrix.
+        Default is `False`
+    precision : str, optional
+        'double' or 'single'. With 'single', the eigenvectors and the flux operators are stored in single
+        precision, halving the memory and disk footprint of the largest harmonic arrays. The eigenvalues and the
+        sums over the modes are still calculated in double precision.
+        Default is `'double'`
+    bandwidth_kpts : (3) tuple, optional
+        If defined, the bandwidth and the phase space are calculated on this coarser k mesh and interpolated on the
+        k mesh `kpts`, matching the modes by the overlap of their eigenvectors. The anharmonic calculation, by far
+        the most expensive, then scales with the coarse mesh, while the harmonic properties use the dense one.
+        Only the relaxation time approximation is available: the scattering tensor of the dense mesh is never
+        calculated, and Conductivity raises a ValueError for the methods that need it ('sc', 'inverse', 'full').
+        Default is `None`
 
     Returns
     -------
@@ -91,46 +151,52 @@ class Phonons:
         self.is_symmetrizing_frequency = kwargs.pop('is_symmetrizing_frequency', False)
         self.is_antisymmetrizing_velocity = kwargs.pop('is_antisymmetrizing_velocity', False)
         self.is_balanced = kwargs.pop('is_balanced', False)
+        self.n_workers = kwargs.pop('n_workers', None)
+        self.is_using_symmetry = kwargs.pop('is_using_symmetry', False)
+        self.degeneracy_threshold = kwargs.pop('degeneracy_threshold', None)
+        self.is_using_sparse_dynmat = kwargs.pop('is_using_sparse_dynmat', False)
+        self.is_solving_frequency_window = kwargs.pop('is_solving_frequency_window', self.is_using_sparse_dynmat)
+        self.is_using_sparse_gamma_tensor = kwargs.pop('is_using_sparse_gamma_tensor', False)
+        self.precision = kwargs.pop('precision', 'double')
+        if self.precision not in ('double', 'single'):
+            raise ValueError('precision must be double or single')
+        self.bandwidth_kpts = kwargs.pop('bandwidth_kpts', None)
+        if self.bandwidth_kpts is not None:
+            self.bandwidth_kpts = np.array(self.bandwidth_kpts)
         self.atoms = self.forceconstants.atoms
         self.supercell = np.array(self.forceconstants.supercell)
         self.n_k_points = int(np.prod(self.kpts))
         self.n_atoms = self.forceconstants.n_atoms
-        self.n_modes = self.forceconstants.n_modes
-        self.n_phonons = self.n_k_points * self.n_modes
         self.is_able_to_calculate = True
         self.hbar = units._hbar
         if self.is_classic:
             self.hbar = self.hbar * 1e-6
+        if self.is_using_symmetry:
+            self._k_symmetry = KPointSymmetry(self.atoms, self._reciprocal_grid)
+        if self.is_solving_frequency_window and not self._is_amorphous:
+            raise ValueError('The frequency window eigensolver is only available when kpts is (1, 1, 1)')
+        if self.bandwidth_kpts is not None and self._is_amorphous:
+            raise ValueError('The bandwidth interpolation is not available when kpts is (1, 1, 1)')
 
 
 
     @lazy_property(label='')
     def physical_mode(self):
         """Calculate physical modes. Non physical modes are the first 3 modes of q=(0, 0, 0) and, if defined, all the
-        modes outside the frequency range min_frequency and max_frequency.
+        modes outside the frequency range min_frequency and max_frequency. When only the modes in the frequency
+        window are calculated, the acoustic modes are the ones overlapping the rigid translations instead.
         Returns
         -------
         physical_mode : np array
             (n_k_points, n_modes) bool
         """
         q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
-        physical_mode = np.zeros((self.n_k_points, self.n_modes), dtype=np.bool)
-
-        for ik in range(len(q_points)):
-            q_point = q_points[ik]
-            phonon = HarmonicWithQ(q_point=q_point,
-                                   second=self.forceconstants.second,
-                                   distance_threshold=self.forceconstants.distance_threshold,
-                                   folder=self.folder,
-                                   storage=self.storage,
-                                   is_nw=self.is_nw,
-                                   is_unfolding=self.is_unfolding)
-
-            physical_mode[ik] = phonon.physical_mode
-        if self.min_frequency is not None:
-            physical_mode[self.frequency < self.min_frequency] = False
-        if self.max_frequency is not None:
-            physical_mode[self.frequency > self.max_frequency] = False
+        acoustic_mode = None
+        if self.is_using_sparse_dynmat or self.is_solving_frequency_window:
+            # Only the modes in the frequency window are calculated, identify the acoustic ones among them
+            acoustic_mode = hmc.calculate_acoustic_mode(self.eigenvectors[0], self.atoms.get_masses())
+        physical_mode = hmc.calculate_physical_mode(q_points, self.frequency, self.min_frequency,
+                                                    self.max_frequency, self.is_nw, acoustic_mode)
         return physical_mode
 
 
@@ -142,20 +208,7 @@ class Phonons:
         frequency : np array
             (n_k_points, n_modes) frequency in THz
         """
-        q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
-        frequency = np.zeros((self.n_k_points, self.n_modes))
-        for ik in range(len(q_points)):
-            q_point = q_points[ik]
-            phonon = HarmonicWithQ(q_point=q_point,
-                                   second=self.forceconstants.second,
-                                   distance_threshold=self.forceconstants.distance_threshold,
-                                   folder=self.folder,
-                                   storage=self.storage,
-                                   is_nw=self.is_nw,
-                                   is_unfolding=self.is_unfolding)
-
-            frequency[ik] = phonon.frequency
-
+        frequency = hmc.calculate_frequency(self.eigenvalues.real)
         return frequency
 
 
@@ -168,19 +221,15 @@ class Phonons:
         velocity : np array
             (n_k_points, n_unit_cell * 3, 3) velocity in 100m/s or A/ps
         """
-
-        q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
         velocity = np.zeros((self.n_k_points, self.n_modes, 3))
-        for ik in range(len(q_points)):
-            q_point = q_points[ik]
-            phonon = HarmonicWithQ(q_point=q_point,
-                                   second=self.forceconstants.second,
-                                   distance_threshold=self.forceconstants.distance_threshold,
-                                   folder=self.folder,
-                                   storage=self.storage,
-                                   is_nw=self.is_nw,
-                                   is_unfolding=self.is_unfolding)
-            velocity[ik] = phonon.velocity
+        for k_chunk, velocity_chunk in self._map_k_chunks(hmc.calculate_velocity_at_q_points,
+                                                          self.eigenvectors, self.frequency,
+                                                          is_irreducible=True,
+                                                          degeneracy_threshold=self.degeneracy_threshold,
+                                                          is_sparse=self.is_using_sparse_dynmat):
+            velocity[k_chunk] = velocity_chunk
+        if self.is_using_symmetry:
+            velocity = self._k_symmetry.unfold_velocity(velocity)
         return velocity
 
 
@@ -194,24 +243,45 @@ class Phonons:
             eigensystem is calculated for each k point, the three dimensional array
             records the eigenvalues in the last column of the last dimension.
 
-            If the system is not amorphous, these values are stored as complex numbers.
+            If the system is not amorphous, these values are stored as complex numbers, otherwise as real numbers.
+            With single precision, only the eigenvectors are stored, as complex64 (float32 if amorphous), and
+            the eigenvalues are calculated in double precision by `eigenvalues`.
         """
-        q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
-        shape = (self.n_k_points, self.n_modes + 1, self.n_modes)
-        log_size(shape, name='eigensystem', type=np.complex)
-        eigensystem = np.zeros(shape, dtype=np.complex)
-        for ik in range(len(q_points)):
-            q_point = q_points[ik]
-            phonon = HarmonicWithQ(q_point=q_point,
-                                   second=self.forceconstants.second,
-                                   distance_threshold=self.forceconstants.distance_threshold,
-                                   folder=self.folder,
-                                   storage=self.storage,
-                                   is_nw=self.is_nw,
-                                   is_unfolding=self.is_unfolding)
-
-            eigensystem[ik] = phonon._eigensystem
-
+        if self.is_using_sparse_dynmat:
+            sparse_dynmat = hmc.calculate_sparse_dynmat(self.forceconstants.second,
+                                                        distance_threshold=self.forceconstants.distance_threshold)
+            eigensystem = hmc.calculate_eigensystem_sparse(sparse_dynmat, self.min_frequency, self.max_frequency)
+            return self._cast_eigensystem(eigensystem[np.newaxis, ...])
+        if self.is_solving_frequency_window:
+            dynmat_fourier = hmc.calculate_dynmat_fourier(self.forceconstants.second,
+                                                          np.zeros((1, 3)),
+                                                          distance_threshold=self.forceconstants.distance_threshold,
+                                                          is_unfolding=self.is_unfolding)
+            eigensystem = hmc.calculate_eigensystem_in_window(dynmat_fourier[0],
+                                                              self.min_frequency,
+                                                              self.max_frequency)
+            return self._cast_eigensystem(eigensystem[np.newaxis, ...])
+        n_modes = self.forceconstants.n_modes
+        type = self._eigenvectors_type
+        if self.precision == 'single':
+            shape = (self.n_k_points, n_modes, n_modes)
+            log_size(shape, name='eigenvectors', type=type)
+            eigensystem = np.zeros(shape, dtype=type)
+            eigenvectors = eigensystem
+        else:
+            shape = (self.n_k_points, n_modes + 1, n_modes)
+            log_size(shape, name='eigensystem', type=type)
+            eigensystem = np.zeros(shape, dtype=type)
+            eigenvectors = eigensystem[:, 1:, :]
+        for k_chunk, eigensystem_chunk in self._map_k_chunks(hmc.calculate_eigensystem_at_q_points,
+                                                             is_irreducible=True):
+            if self.precision != 'single':
+                eigensystem[k_chunk, 0, :] = eigensystem_chunk[:, 0, :]
+            eigenvectors[k_chunk] = eigensystem_chunk[:, 1:, :]
+        if self.is_using_symmetry:
+            if self.precision != 'single':
+                eigensystem[:, 0, :] = self._k_symmetry.unfold_scalar(eigensystem[:, 0, :])
+            eigenvectors[...] = self._k_symmetry.unfold_eigenvectors(eigenvectors)
         return eigensystem
 
 
@@ -231,20 +301,8 @@ class Phonons:
         c_v : np.array(n_k_points, n_modes)
             heat capacity in W/m/K for each k point and each mode
         """
-        q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
-        c_v = np.zeros((self.n_k_points, self.n_modes))
-        for ik in range(len(q_points)):
-            q_point = q_points[ik]
-            phonon = HarmonicWithQTemp(q_point=q_point,
-                                       second=self.forceconstants.second,
-                                       distance_threshold=self.forceconstants.distance_threshold,
-                                       folder=self.folder,
-                                       storage=self.storage,
-                                       temperature=self.temperature,
-                                       is_classic=self.is_classic,
-                                       is_nw=self.is_nw,
-                                       is_unfolding=self.is_unfolding)
-            c_v[ik] = phonon.heat_capacity
+        c_v = hmc.calculate_heat_capacity(self.frequency, self.population, self.temperature, self.hbar,
+                                          self.physical_mode)
         return c_v
 
 
@@ -258,22 +316,12 @@ class Phonons:
         heat_capacity_2d : np.array(n_k_points, n_modes, n_modes)
             heat capacity in W/m/K for each k point and each modes couple.
         """
-        q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
         shape = (self.n_k_points, self.n_modes, self.n_modes)
         log_size(shape, name='heat_capacity_2d', type=np.float)
-        heat_capacity_2d = np.zeros(shape)
-        for ik in range(len(q_points)):
-            q_point = q_points[ik]
-            phonon = HarmonicWithQTemp(q_point=q_point,
-                                       second=self.forceconstants.second,
-                                       distance_threshold=self.forceconstants.distance_threshold,
-                                       folder=self.folder,
-                                       storage=self.storage,
-                                       temperature=self.temperature,
-                                       is_classic=self.is_classic,
-                                       is_nw=self.is_nw,
-                                       is_unfolding=self.is_unfolding)
-            heat_capacity_2d[ik] = phonon.heat_capacity_2d
+        heat_capacity_2d = hmc.calculate_heat_capacity_2d(self.frequency, self.population, self.heat_capacity,
+                                                          self.temperature, self.hbar, self.physical_mode)
+        if self.precision == 'single':
+            heat_capacity_2d = heat_capacity_2d.astype(np.float32)
         return heat_capacity_2d
 
 
@@ -288,32 +336,22 @@ class Phonons:
         population : np.array(n_k_points, n_modes)
             population for each k point and each mode
         """
-        q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
-        population = np.zeros((self.n_k_points, self.n_modes))
-        for ik in range(len(q_points)):
-            q_point = q_points[ik]
-            phonon = HarmonicWithQTemp(q_point=q_point,
-                                       second=self.forceconstants.second,
-                                       distance_threshold=self.forceconstants.distance_threshold,
-                                       folder=self.folder,
-                                       storage=self.storage,
-                                       temperature=self.temperature,
-                                       is_classic=self.is_classic,
-                                       is_nw=self.is_nw,
-                                       is_unfolding=self.is_unfolding)
-            population[ik] = phonon.population
+        population = hmc.calculate_population(self.frequency, self.temperature, self.hbar, self.physical_mode)
         return population
 
 
     @lazy_property(label='<temperature>/<statistics>/<third_bandwidth>')
     def bandwidth(self):
         """Calculate the phonons bandwidth, the inverse of the lifetime, for each k point in k_points and each mode.
+        If bandwidth_kpts is defined, the bandwidth is interpolated from the coarse mesh.
 
         Returns
         -------
         bandwidth : np.array(n_k_points, n_modes)
             bandwidth for each k point and each mode
         """
+        if self.bandwidth_kpts is not None:
+            return self._interpolate_from_bandwidth_kpts('bandwidth')
         gamma = self._ps_and_gamma[:, 1].reshape(self.n_k_points, self.n_modes)
         return gamma
 
@@ -321,12 +359,15 @@ class Phonons:
     @lazy_property(label='<temperature>/<statistics>/<third_bandwidth>')
     def phase_space(self):
         """Calculate the 3-phonons-processes phase_space, for each k point in k_points and each mode.
+        If bandwidth_kpts is defined, the phase_space is interpolated from the coarse mesh.
 
         Returns
         -------
         phase_space : np.array(n_k_points, n_modes)
             phase_space for each k point and each mode
         """
+        if self.bandwidth_kpts is not None:
+            return self._interpolate_from_bandwidth_kpts('phase_space')
         ps = self._ps_and_gamma[:, 0].reshape(self.n_k_points, self.n_modes)
         return ps
 
@@ -340,7 +381,18 @@ class Phonons:
         eigenvalues : np array
             (n_phonons) Eigenvalues of the dynamical matrix
         """
-        eigenvalues = self._eigensystem[:, 0, :]
+        if self.precision != 'single':
+            return self._eigensystem[:, 0, :]
+
+        # Rayleigh quotients of the single precision eigenvectors, the error is quadratic in the rounding
+        eigenvalues = np.zeros((self.n_k_points, self.n_modes))
+        for k_chunk, eigenvalues_chunk in self._map_k_chunks(hmc.calculate_eigenvalues_at_q_points,
+                                                             self.eigenvectors,
+                                                             is_irreducible=True,
+                                                             is_sparse=self.is_using_sparse_dynmat):
+            eigenvalues[k_chunk] = eigenvalues_chunk
+        if self.is_using_symmetry:
+            eigenvalues = self._k_symmetry.unfold_scalar(eigenvalues)
         return eigenvalues
 
 
@@ -353,17 +405,22 @@ class Phonons:
         eigenvectors : np array
             (n_phonons, n_phonons) Eigenvectors of the dynamical matrix
         """
+        if self.precision == 'single':
+            return self._eigensystem
         eigenvectors = self._eigensystem[:, 1:, :]
         return eigenvectors
 
 
     @lazy_property(label='<temperature>/<statistics>/<third_bandwidth>')
     def _ps_and_gamma(self):
-        store_format = DEFAULT_STORE_FORMATS['_ps_gamma_and_gamma_tensor'] \
+        gamma_tensor_property = self._gamma_tensor_property
+        store_format = DEFAULT_STORE_FORMATS[gamma_tensor_property] \
             if self.storage == 'formatted' else self.storage
-        if is_calculated('_ps_gamma_and_gamma_tensor', self, '<temperature>/<statistics>/<third_bandwidth>', \
+        if is_calculated(gamma_tensor_property, self, '<temperature>/<statistics>/<third_bandwidth>', \
                          format=store_format):
-            ps_and_gamma = self._ps_gamma_and_gamma_tensor[:, :2]
+            ps_and_gamma = getattr(self, gamma_tensor_property)[:, :2]
+            if issparse(ps_and_gamma):
+                ps_and_gamma = ps_and_gamma.toarray()
         else:
             ps_and_gamma = self._select_algorithm_for_phase_space_and_gamma(is_gamma_tensor_enabled=False)
         return ps_and_gamma
@@ -374,8 +431,30 @@ class Phonons:
         ps_gamma_and_gamma_tensor = self._select_algorithm_for_phase_space_and_gamma(is_gamma_tensor_enabled=True)
         return ps_gamma_and_gamma_tensor
 
+
+    @lazy_property(label='<temperature>/<statistics>/<third_bandwidth>')
+    def _sparse_ps_gamma_and_gamma_tensor(self):
+        """Same as _ps_gamma_and_gamma_tensor, as a scipy.sparse.csr_matrix, when is_using_sparse_gamma_tensor."""
+        ps_gamma_and_gamma_tensor = self._select_algorithm_for_phase_space_and_gamma(is_gamma_tensor_enabled=True)
+        return ps_gamma_and_gamma_tensor
+
 # Helpers properties
 
+    @property
+    def n_modes(self):
+        """Number of modes for each k point. It's the number of degrees of freedom of the unit cell, unless the
+        frequency window eigensolver is used.
+        """
+        if self.is_solving_frequency_window:
+            return self._eigensystem.shape[-1]
+        return self.forceconstants.n_modes
+
+
+    @property
+    def n_phonons(self):
+        return self.n_k_points * self.n_modes
+
+
     @property
     def omega(self):
         """Calculates the angular frequencies from the diagonalized dynamical matrix.
@@ -390,36 +469,379 @@ class Phonons:
 
     @property
     def _rescaled_eigenvectors(self):
+        return self._rescaled_eigenvectors_at_k(slice(None))
+
+
+    def _rescaled_eigenvectors_at_k(self, k_index):
+        """Eigenvectors divided by the square root of the masses, only for the k points in k_index. When the
+        eigensystem is stored in numpy format, it's memory mapped and only these k points are read from disk.
+        """
         n_atoms = self.n_atoms
         n_modes = self.n_modes
         masses = self.atoms.get_masses()
-        rescaled_eigenvectors = self.eigenvectors[:, :, :].reshape(
-            (self.n_k_points, n_atoms, 3, n_modes)) / np.sqrt(
+        eigenvectors = np.asarray(self.eigenvectors[k_index])
+        n_k_points = eigenvectors.shape[0]
+        rescaled_eigenvectors = eigenvectors.reshape(
+            (n_k_points, n_atoms, 3, n_modes)) / np.sqrt(
             masses[np.newaxis, :, np.newaxis, np.newaxis])
-        rescaled_eigenvectors = rescaled_eigenvectors.reshape((self.n_k_points, n_modes, n_modes))
+        rescaled_eigenvectors = rescaled_eigenvectors.reshape((n_k_points, n_atoms * 3, n_modes))
         return rescaled_eigenvectors
 
 
+    @property
+    def _eigenvectors_type(self):
+        if self._is_amorphous:
+            return np.float32 if self.precision == 'single' else np.float
+        return np.complex64 if self.precision == 'single' else np.complex
+
+
+    def _cast_eigensystem(self, eigensystem):
+        if self.precision == 'single':
+            return eigensystem[:, 1:, :].astype(self._eigenvectors_type)
+        return eigensystem
+
+
     @property
     def _is_amorphous(self):
         is_amorphous = (self.kpts == (1, 1, 1)).all()
         return is_amorphous
 
 
+    @property
+    def _is_projecting_irreducible_k_points(self):
+        # The adaptive broadening is not invariant under the symmetry operations, all the k points are projected
+        return self.is_using_symmetry and not self._is_amorphous and self.third_bandwidth is not None
+
+
     def _allowed_third_phonons_index(self, index_q, is_plus):
-        q_vec = self._reciprocal_grid.id_to_unitary_grid_index(index_q)
-        qp_vec = self._reciprocal_grid.unitary_grid(is_wrapping=False)
-        qpp_vec = q_vec[np.newaxis, :] + (int(is_plus) * 2 - 1) * qp_vec[:, :]
-        rescaled_qpp = np.round((qpp_vec * self._reciprocal_grid.grid_shape), 0).astype(np.int)
-        rescaled_qpp = np.mod(rescaled_qpp, self._reciprocal_grid.grid_shape)
-        index_qpp_full = np.ravel_multi_index(rescaled_qpp.T, self._reciprocal_grid.grid_shape, mode='raise',
-                                              order=self._grid_type)
-        return index_qpp_full
+        k_mesh = self._reciprocal_grid.unitary_grid(is_wrapping=False)
+        return aha.calculate_kpp_index(index_q, is_plus, k_mesh, self._reciprocal_grid.grid_shape, self._grid_type)
+
+
+    def _k_chunks(self, n_arrays=4, is_irreducible=False, chunk_size=None):
+        if is_irreducible and self.is_using_symmetry:
+            k_ids = self._k_symmetry.irreducible_k_ids
+        else:
+            k_ids = np.arange(self.n_k_points)
+        if chunk_size is None:
+            chunk_size = hmc.calculate_chunk_size(k_ids.shape[0], self.n_modes, n_arrays=n_arrays)
+        n_chunks = parallel.calculate_n_chunks(k_ids.shape[0], chunk_size, self.n_workers)
+        return np.array_split(k_ids, n_chunks)
+
+
+    def _map_k_chunks(self, function, *arrays, n_arrays=4, is_irreducible=False, chunk_size=None, **kwargs):
+        """Evaluate function(second, q_points, *arrays) on each chunk of the k mesh, using n_workers processes
+        if requested, and yield each chunk of k indices along with the result, in k order.
+        If is_irreducible, only the irreducible k points are evaluated, when using symmetries.
+        """
+        q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
+        k_chunks = self._k_chunks(n_arrays=n_arrays, is_irreducible=is_irreducible, chunk_size=chunk_size)
+        function = partial(function,
+                           distance_threshold=self.forceconstants.distance_threshold,
+                           is_unfolding=self.is_unfolding,
+                           **kwargs)
+        iterables = [map(array.__getitem__, k_chunks) for array in (q_points, ) + arrays]
+        results = parallel.map_with_second(function, self.forceconstants.second, iterables, self.n_workers)
+        return zip(k_chunks, results)
+
+
+    def iter_k(self, properties=HARMONIC_PROPERTIES, chunk=None):
+        """Iterate over the k mesh, yielding the harmonic properties of a chunk of k points at a time.
+        The properties are calculated on the fly for each chunk, without building or storing the arrays over the
+        whole mesh, so that the memory needed doesn't grow with the number of k points.
+
+        Parameters
+        ----------
+        properties : tuple of str, optional
+            properties in each bundle, among HARMONIC_PROPERTIES: 'q_point', 'frequency', 'eigenvectors',
+            'velocity', 'physical_mode', 'population' and 'heat_capacity'. Default is all of them
+        chunk : int, optional
+            number of k points in each chunk. Default is None, which uses the largest chunks that fit in
+            MAX_CHUNK_MEMORY_IN_MB
+
+        Yields
+        ------
+        bundle : dict
+            'k_index' holds the np.array(n_chunk) of the indices of the k points in the chunk, and each property
+            holds its values for the chunk, with the same shape of the corresponding property of Phonons,
+            but n_chunk k points.
+        """
+        self._check_harmonic_properties(properties)
+        q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
+        if self.is_solving_frequency_window:
+            # The window eigensolver only works at gamma, there is a single k point
+            bundle = self._calculate_harmonic_bundle(q_points, self.frequency, self.eigenvectors, self.velocity,
+                                                     properties)
+            bundle['k_index'] = np.arange(self.n_k_points)
+            yield bundle
+            return
+        for k_chunk, (eigensystem, velocity) in self._map_k_chunks(hmc.calculate_harmonic_at_q_points,
+                                                                   chunk_size=chunk,
+                                                                   is_calculating_velocity='velocity' in properties,
+                                                                   degeneracy_threshold=self.degeneracy_threshold):
+            bundle = self._calculate_harmonic_bundle(q_points[k_chunk],
+                                                     hmc.calculate_frequency(eigensystem[:, 0, :].real),
+                                                     eigensystem[:, 1:, :], velocity, properties)
+            bundle['k_index'] = k_chunk
+            yield bundle
+
+
+    def evaluate_at(self, q_points, properties=('frequency', 'velocity'), chunk=None):
+        """Evaluate the harmonic properties at arbitrary q points, for example along a path for the band
+        structure. The q points are processed in vectorized chunks, using n_workers processes if requested, and
+        nothing is stored.
+
+        Parameters
+        ----------
+        q_points : np.array(n_q_points, 3)
+            q points in fractional coordinates of the reciprocal cell
+        properties : tuple of str, optional
+            properties to calculate, among HARMONIC_PROPERTIES. Default is ('frequency', 'velocity')
+        chunk : int, optional
+            number of q points in each chunk. Default is None, which uses the largest chunks that fit in
+            MAX_CHUNK_MEMORY_IN_MB
+
+        Returns
+        -------
+        harmonic : dict
+            each property holds an array with the same shape of the corresponding property of Phonons, but
+            n_q_points instead of n_k_points.
+        """
+        self._check_harmonic_properties(properties)
+        q_points = np.atleast_2d(np.asarray(q_points, dtype=np.float))
+        n_q_points = q_points.shape[0]
+        if chunk is None:
+            chunk = hmc.calculate_chunk_size(n_q_points, self.n_modes)
+        q_chunks = np.array_split(np.arange(n_q_points),
+                                  parallel.calculate_n_chunks(n_q_points, chunk, self.n_workers))
+        function = partial(hmc.calculate_harmonic_at_q_points,
+                           distance_threshold=self.forceconstants.distance_threshold,
+                           is_unfolding=self.is_unfolding,
+                           is_calculating_velocity='velocity' in properties,
+                           degeneracy_threshold=self.degeneracy_threshold)
+        results = parallel.map_with_second(function, self.forceconstants.second,
+                                           [map(q_points.__getitem__, q_chunks)], self.n_workers)
+        bundles = []
+        for q_chunk, (eigensystem, velocity) in zip(q_chunks, results):
+            bundles.append(self._calculate_harmonic_bundle(q_points[q_chunk],
+                                                           hmc.calculate_frequency(eigensystem[:, 0, :].real),
+                                                           eigensystem[:, 1:, :], velocity, properties))
+        return {property: np.concatenate([bundle[property] for bundle in bundles]) for property in properties}
+
+
+    def thermodynamics(self, temperatures, is_integrated=False):
+        """Harmonic thermodynamic properties for a vector of temperatures, from a single calculation of the
+        frequencies.
+
+        Parameters
+        ----------
+        temperatures : np.array(n_temperatures)
+            Units: K
+        is_integrated : bool, optional
+            if True, the properties are summed over the modes and averaged over the k points, giving the values
+            per unit cell. Default is False
+
+        Returns
+        -------
+        thermodynamics : dict
+            'population', 'heat_capacity' in J/K, 'free_energy' in J, 'entropy' in J/K and 'internal_energy' in J,
+            each a np.array(n_temperatures, n_k_points, n_modes), or np.array(n_temperatures) if is_integrated
+        """
+        thermodynamics = hmc.calculate_thermodynamics(self.frequency, temperatures, self.hbar, self.physical_mode)
+        if is_integrated:
+            for property in thermodynamics:
+                thermodynamics[property] = thermodynamics[property].sum(axis=(1, 2)) / self.n_k_points
+        return thermodynamics
+
+
+    def at_temperature(self, temperature, is_classic=None):
+        """Phonons with the same settings at a different temperature. The temperature independent properties
+        already calculated in memory, frequency, eigensystem and velocity, are shared instead of calculated
+        again, so that a temperature sweep only runs the harmonic calculation once. With the other storage
+        strategies they are shared on disk, where they are not stored by temperature.
+
+        Parameters
+        ----------
+        temperature : float
+            Units: K
+        is_classic : bool, optional
+            Default is None, which keeps the statistics of this object
+
+        Returns
+        -------
+        phonons : Phonons
+        """
+        if is_classic is None:
+            is_classic = self.is_classic
+        phonons = self._create_phonons(temperature=temperature, is_classic=is_classic)
+        for property in HARMONIC_LAZY_PROPERTIES:
+            attr = LAZY_PREFIX + property
+            if hasattr(self, attr):
+                setattr(phonons, attr, getattr(self, attr))
+        return phonons
+
+
+    def project_shard(self, start, stop, is_gamma_tensor_enabled=True):
+        """Project the third order only on the phonons in range(start, stop), and save their rows of phase space,
+        bandwidth and, if is_gamma_tensor_enabled, scattering tensor as an independent shard, in the folder of the
+        anharmonic properties. Each shard can run in a separate job, and a shard already complete is not
+        calculated again, so that an interrupted calculation can be restarted. See merge_shards.
+
+        Parameters
+        ----------
+        start : int
+        stop : int
+        is_gamma_tensor_enabled : bool, optional
+            Default is True
+
+        Returns
+        -------
+        shard_file : str
+        """
+        property = self._ps_and_gamma_property(is_gamma_tensor_enabled)
+        folder = get_folder_from_label(self, '<temperature>/<statistics>/<third_bandwidth>')
+        metadata = self._shard_metadata()
+        if shards.is_complete(folder, property, start, stop, metadata):
+            logging.info('Shard ' + str(start) + ', ' + str(stop) + ' already complete, skipping it')
+            return shards.get_shard_file(folder, property, start, stop)
+        if self._is_amorphous:
+            block = aha.project_amorphous(self, start, stop)
+        else:
+            block = aha.project_crystal(self, start, stop, is_gamma_tensor_enabled=is_gamma_tensor_enabled)
+        return shards.save_shard(folder, property, start, stop, block, metadata)
+
+
+    def merge_shards(self, is_gamma_tensor_enabled=True):
+        """Assemble the shards saved by project_shard and store them as the phase space and bandwidth, and the
+        scattering tensor if is_gamma_tensor_enabled, so that the anharmonic properties and the conductivity are
+        then loaded instead of calculated. Raises ValueError if some phonons are not in any shard.
+
+        Parameters
+        ----------
+        is_gamma_tensor_enabled : bool, optional
+            Default is True
+
+        Returns
+        -------
+        ps_and_gamma : np.array(n_phonons, 2) or np.array(n_phonons, 2 + n_phonons), if is_gamma_tensor_enabled
+        """
+        property = self._ps_and_gamma_property(is_gamma_tensor_enabled)
+        folder = get_folder_from_label(self, '<temperature>/<statistics>/<third_bandwidth>')
+        ps_and_gamma = shards.load_shards(folder, property, self.n_phonons, self._shard_metadata())
+        if self._is_projecting_irreducible_k_points:
+            ps_and_gamma = aha.unfold_ps_and_gamma(self, ps_and_gamma)
+        store_format = DEFAULT_STORE_FORMATS[property] if self.storage == 'formatted' else self.storage
+        if store_format != 'memory':
+            save(property, folder, ps_and_gamma, format=store_format)
+        setattr(self, LAZY_PREFIX + property, ps_and_gamma)
+        return ps_and_gamma
+
+
+    def _ps_and_gamma_property(self, is_gamma_tensor_enabled):
+        if not is_gamma_tensor_enabled:
+            return '_ps_and_gamma'
+        return self._gamma_tensor_property
+
+
+    @property
+    def _gamma_tensor_property(self):
+        if self.is_using_sparse_gamma_tensor:
+            return '_sparse_ps_gamma_and_gamma_tensor'
+        return '_ps_gamma_and_gamma_tensor'
+
+
+    def _shard_metadata(self):
+        third_bandwidth = None if self.third_bandwidth is None else float(np.mean(self.third_bandwidth))
+        max_frequency = None if self.max_frequency is None else float(self.max_frequency)
+        min_frequency = None if self.min_frequency is None else float(self.min_frequency)
+        distance_threshold = self.forceconstants.distance_threshold
+        distance_threshold = None if distance_threshold is None else float(distance_threshold)
+        return {'n_phonons': int(self.n_phonons),
+                'kpts': [int(k) for k in self.kpts],
+                'grid_type': self._grid_type,
+                'temperature': float(self.temperature),
+                'is_classic': bool(self.is_classic),
+                'third_bandwidth': third_bandwidth,
+                'broadening_shape': self.broadening_shape,
+                'is_balanced': bool(self.is_balanced),
+                'is_using_symmetry': bool(self.is_using_symmetry),
+                'is_using_sparse_gamma_tensor': bool(self.is_using_sparse_gamma_tensor),
+                'min_frequency': min_frequency,
+                'max_frequency': max_frequency,
+                'is_nw': bool(self.is_nw),
+                'is_unfolding': bool(self.is_unfolding),
+                'distance_threshold': distance_threshold,
+                'supercell': [int(replicas) for replicas in self.supercell],
+                'forceconstants_folder': self.forceconstants.folder,
+                'forceconstants_hash': shards.calculate_forceconstants_hash(self.forceconstants)}
+
+
+    def _create_phonons(self, **kwargs):
+        """Phonons with the same settings, except the ones given in kwargs."""
+        settings = dict(forceconstants=self.forceconstants,
+                        kpts=self.kpts,
+                        is_classic=self.is_classic,
+                        temperature=self.temperature,
+                        folder=self.folder,
+                        grid_type=self._grid_type,
+                        is_unfolding=self.is_unfolding,
+                        min_frequency=self.min_frequency,
+                        max_frequency=self.max_frequency,
+                        broadening_shape=self.broadening_shape,
+                        is_nw=self.is_nw,
+                        third_bandwidth=self.third_bandwidth,
+                        storage=self.storage,
+                        is_symmetrizing_frequency=self.is_symmetrizing_frequency,
+                        is_antisymmetrizing_velocity=self.is_antisymmetrizing_velocity,
+                        is_balanced=self.is_balanced,
+                        n_workers=self.n_workers,
+                        is_using_symmetry=self.is_using_symmetry,
+                        degeneracy_threshold=self.degeneracy_threshold,
+                        is_solving_frequency_window=self.is_solving_frequency_window,
+                        is_using_sparse_dynmat=self.is_using_sparse_dynmat,
+                        is_using_sparse_gamma_tensor=self.is_using_sparse_gamma_tensor,
+                        precision=self.precision,
+                        bandwidth_kpts=self.bandwidth_kpts)
+        settings.update(kwargs)
+        return Phonons(**settings)
+
+
+    def _interpolate_from_bandwidth_kpts(self, property):
+        coarse_phonons = self._create_phonons(kpts=self.bandwidth_kpts, bandwidth_kpts=None)
+        logging.info('Interpolating ' + property + ' from ' + str(tuple(self.bandwidth_kpts)) + ' k mesh')
+        q_points = self._reciprocal_grid.unitary_grid(is_wrapping=False)
+        interpolated = interpolation.interpolate_on_mesh(q_points, self.bandwidth_kpts,
+                                                         getattr(coarse_phonons, property),
+                                                         self.eigenvectors, coarse_phonons.eigenvectors,
+                                                         grid_type=self._grid_type)
+        interpolated[~self.physical_mode] = 0
+        return interpolated
+
+
+    def _check_harmonic_properties(self, properties):
+        for property in properties:
+            if property not in HARMONIC_PROPERTIES:
+                raise ValueError('Property ' + str(property) + ' not available, use ' + str(HARMONIC_PROPERTIES))
+
+
+    def _calculate_harmonic_bundle(self, q_points, frequency, eigenvectors, velocity, properties):
+        bundle = {'q_point': q_points,
+                  'frequency': frequency,
+                  'eigenvectors': eigenvectors.astype(self._eigenvectors_type, copy=False),
+                  'velocity': velocity}
+        bundle['physical_mode'] = hmc.calculate_physical_mode(q_points, frequency, self.min_frequency,
+                                                              self.max_frequency, self.is_nw)
+        if 'population' in properties or 'heat_capacity' in properties:
+            bundle['population'] = hmc.calculate_population(frequency, self.temperature, self.hbar,
+                                                             bundle['physical_mode'])
+            bundle['heat_capacity'] = hmc.calculate_heat_capacity(frequency, bundle['population'],
+                                                                  self.temperature, self.hbar,
+                                                                  bundle['physical_mode'])
+        return {property: bundle[property] for property in properties}
 
 
     def _select_algorithm_for_phase_space_and_gamma(self, is_gamma_tensor_enabled=True):
         self.n_k_points = np.prod(self.kpts)
-        self.n_phonons = self.n_k_points * self.n_modes
         self.is_gamma_tensor_enabled = is_gamma_tensor_enabled
         if self._is_amorphous:
             ps_and_gamma = aha.project_amorphous(self)
@@ -0,0 +1,190 @@
+import numpy as np
+import spglib
+from scipy.sparse import coo_matrix
+from opt_einsum import contract
+from kaldo.helpers.logger import get_logger
+logging = get_logger()
+
+SYMPREC = 1e-5
+
+
+class KPointSymmetry:
+    """Reduction of a k points grid to its irreducible wedge, using the space group of the crystal found by spglib,
+    and time reversal symmetry. Each k point of the grid is the image of an irreducible point, q, through one
+    operation of the group, k = G q, optionally combined with time reversal, k = -G q.
+
+    Parameters
+    ----------
+    atoms : ase.Atoms
+        unit cell of the crystal
+    grid : Grid
+        k points grid, to be reduced
+    symprec : float, optional
+        tolerance used by spglib to detect the symmetries, in Angstrom.
+        Default is 1e-5
+    """
+    def __init__(self, atoms, grid, symprec=SYMPREC):
+        self.grid = grid
+        cell = np.array(atoms.cell)
+        scaled_positions = atoms.get_scaled_positions()
+        symmetry = spglib.get_symmetry((cell, scaled_positions, atoms.get_atomic_numbers()), symprec=symprec)
+        rotations = symmetry['rotations']
+        translations = symmetry['translations']
+
+        # Cartesian rotations, positions are row vectors, r = x.cell
+        self.rotations = contract('ba,obc,cd->oad', cell, rotations, np.linalg.inv(cell).T)
+
+        # Each operation moves atom i to atom_map[i], in the cell shifted by lattice_shift[i]
+        images = contract('oab,ib->oia', rotations, scaled_positions) + translations[:, np.newaxis, :]
+        difference = images[:, :, np.newaxis, :] - scaled_positions[np.newaxis, np.newaxis, :, :]
+        distance = np.linalg.norm((difference - np.round(difference)).dot(cell), axis=-1)
+        self.atom_map = np.argmin(distance, axis=-1)
+        self.lattice_shift = np.round(np.take_along_axis(difference, self.atom_map[..., np.newaxis, np.newaxis],
+                                                         axis=2)[:, :, 0, :]).astype(np.int)
+
+        # Operations on the reduced coordinates of the k points, without and with time reversal
+        n_operations = rotations.shape[0]
+        reciprocal_rotations = np.linalg.inv(rotations).transpose((0, 2, 1))
+        self.operation_sign = np.concatenate((np.ones(n_operations), - np.ones(n_operations))).astype(np.int)
+        reciprocal_rotations = np.concatenate((reciprocal_rotations, - reciprocal_rotations))
+        self.operation_index = np.concatenate((np.arange(n_operations), np.arange(n_operations)))
+        self._calculate_irreducible_k_points(reciprocal_rotations)
+        logging.info('Using ' + str(n_operations) + ' symmetry operations, ' + str(self.n_irreducible_k_points) +
+                     ' irreducible k points out of ' + str(self.grid.grid_size))
+
+
+    @property
+    def n_irreducible_k_points(self):
+        return self.irreducible_k_ids.shape[0]
+
+
+    def _calculate_irreducible_k_points(self, reciprocal_rotations):
+        grid_shape = np.array(self.grid.grid_shape)
+        index_grid = self.grid.grid(is_wrapping=False)
+
+        # Only the operations mapping the grid into itself are used
+        grid_rotations = reciprocal_rotations * grid_shape[np.newaxis, :, np.newaxis] / grid_shape[np.newaxis,
+                                                                                        np.newaxis, :]
+        is_preserving_grid = (np.abs(grid_rotations - np.round(grid_rotations)) < 1e-8).all(axis=(1, 2))
+        operations = np.argwhere(is_preserving_grid).flatten()
+        grid_rotations = np.round(grid_rotations[operations]).astype(np.int)
+        rotated_grid = np.mod(contract('oab,kb->oka', grid_rotations, index_grid), grid_shape)
+        images = np.ravel_multi_index(rotated_grid.transpose((2, 0, 1)), grid_shape, order=self.grid.order)
+
+        # Image of each k point through each operation, -1 for the operations not mapping the grid into itself
+        self.k_images = - np.ones((reciprocal_rotations.shape[0], self.grid.grid_size), dtype=np.int)
+        self.k_images[operations] = images
+
+        n_k_points = self.grid.grid_size
+        self.k_to_irreducible = - np.ones(n_k_points, dtype=np.int)
+        self.k_operation = np.zeros(n_k_points, dtype=np.int)
+        irreducible_k_ids = []
+        weights = []
+        for k_id in range(n_k_points):
+            if self.k_to_irreducible[k_id] != -1:
+                continue
+            irreducible_k_ids.append(k_id)
+            star, first_operation = np.unique(images[:, k_id], return_index=True)
+            self.k_to_irreducible[star] = k_id
+            self.k_operation[star] = operations[first_operation]
+            weights.append(star.shape[0])
+        self.irreducible_k_ids = np.array(irreducible_k_ids)
+        self.weights = np.array(weights)
+
+
+    def unfold_scalar(self, values):
+        """Copy the values of the irreducible k points to the full grid.
+
+        Parameters
+        ----------
+        values : np.array(n_k_points, ...)
+            only the values at irreducible_k_ids are used.
+        """
+        return values[self.k_to_irreducible]
+
+
+    def unfold_tensor(self, tensor):
+        """Copy the rows of a tensor over couples of modes, like the scattering tensor, from the irreducible k
+        points to the full grid. If k = G q, the value for k and k' is the value for q and G^-1 k'. Inside
+        degenerate subspaces at k', the columns are defined up to a rotation of the subspace, while their sum is
+        invariant.
+
+        Parameters
+        ----------
+        tensor : np.array(n_k_points, n_modes, n_k_points, n_modes)
+            only the rows at irreducible_k_ids are used.
+        """
+        unfolded_tensor = np.zeros_like(tensor)
+        for k_id in range(self.grid.grid_size):
+            images = self.k_images[self.k_operation[k_id]]
+            unfolded_tensor[k_id][:, images] = tensor[self.k_to_irreducible[k_id]]
+        return unfolded_tensor
+
+
+    def unfold_sparse_tensor(self, tensor, n_modes):
+        """Same as unfold_tensor, for a tensor stored as a sparse matrix.
+
+        Parameters
+        ----------
+        tensor : scipy.sparse.spmatrix(n_k_points * n_modes, n_k_points * n_modes)
+            only the rows of the irreducible_k_ids are used.
+        n_modes : int
+
+        Returns
+        -------
+        unfolded_tensor : scipy.sparse.csr_matrix(n_k_points * n_modes, n_k_points * n_modes)
+        """
+        tensor = tensor.tocsr()
+        rows, cols, data = [], [], []
+        for k_id in range(self.grid.grid_size):
+            images = self.k_images[self.k_operation[k_id]]
+            irreducible_k_id = self.k_to_irreducible[k_id]
+            block = tensor[irreducible_k_id * n_modes:(irreducible_k_id + 1) * n_modes].tocoo()
+            rows.append(block.row + k_id * n_modes)
+            cols.append(images[block.col // n_modes] * n_modes + block.col % n_modes)
+            data.append(block.data)
+        return coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                          shape=tensor.shape).tocsr()
+
+
+    def unfold_velocity(self, velocity):
+        """Rotate the velocities of the irreducible k points to the full grid.
+
+        Parameters
+        ----------
+        velocity : np.array(n_k_points, n_modes, 3)
+            only the values at irreducible_k_ids are used.
+        """
+        rotations = self.rotations[self.operation_index[self.k_operation]] * \
+                    self.operation_sign[self.k_operation, np.newaxis, np.newaxis]
+        return contract('kab,knb->kna', rotations, velocity[self.k_to_irreducible])
+
+
+    def unfold_eigenvectors(self, eigenvectors):
+        """Rotate the eigenvectors of the irreducible k points to the full grid, in place.
+        If k = G q, the eigenvectors are e_G(i)(k) = G e_i(q) exp(-2 pi i k.L_i), where G moves atom i to atom
+        G(i) in the cell L_i. Time reversal conjugates the eigenvectors.
+
+        Parameters
+        ----------
+        eigenvectors : np.array(n_k_points, n_modes, n_modes)
+            only the values at irreducible_k_ids are used.
+        """
+        n_k_points, n_modes, _ = eigenvectors.shape
+        n_atoms = n_modes // 3
+        k_points = self.grid.unitary_grid(is_wrapping=False)
+        is_image = self.k_to_irreducible != np.arange(n_k_points)
+        for operation in np.unique(self.k_operation[is_image]):
+            k_ids = np.argwhere(is_image & (self.k_operation == operation)).flatten()
+            index = self.operation_index[operation]
+            sign = self.operation_sign[operation]
+            rotated_k = sign * k_points[k_ids]
+            phase = np.exp(-2j * np.pi * rotated_k.dot(self.lattice_shift[index].T))
+            irreducible_eigenvectors = eigenvectors[self.k_to_irreducible[k_ids]].reshape((-1, n_atoms, 3, n_modes))
+            rotated_eigenvectors = np.zeros_like(irreducible_eigenvectors)
+            rotated_eigenvectors[:, self.atom_map[index]] = contract('ab,kibn,ki->kian', self.rotations[index],
+                                                                     irreducible_eigenvectors, phase)
+            if sign == -1:
+                rotated_eigenvectors = rotated_eigenvectors.conj()
+            eigenvectors[k_ids] = rotated_eigenvectors.reshape((-1, n_modes, n_modes))
+        return eigenvectors
@@ -0,0 +1,37 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+from kaldo.grid import wrap_coordinates
+import kaldo.controllers.harmonic as hmc
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope="session")
+def second():
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    return forceconstants.second
+
+
+def test_neighbor_table_dynmat(second):
+    distance_threshold = 4.
+    q_points = np.array([[0, 0, 0], [0.2, 0, 0.4], [0.5, 0.5, 0.]])
+    dynmat = second.dynmat.numpy()[0]
+    positions = second.atoms.positions
+    n_unit_cell = positions.shape[0]
+    replicated_positions = second.replicated_atoms.positions.reshape((second.n_replicas, n_unit_cell, 3))
+    phase = np.exp(2j * np.pi * second.list_of_replicas.dot(second.cell_inv).dot(q_points.T))
+    expected_dynmat = np.zeros((q_points.shape[0], n_unit_cell, 3, n_unit_cell, 3), dtype=np.complex)
+    for l in range(second.n_replicas):
+        distance = wrap_coordinates(positions[:, np.newaxis, :] - replicated_positions[np.newaxis, l, :, :],
+                                    second.replicated_atoms.cell, second.replicated_cell_inv)
+        for i, j in np.argwhere(np.linalg.norm(distance, axis=-1) < distance_threshold):
+            expected_dynmat[:, i, :, j, :] += phase[l][:, np.newaxis, np.newaxis] * dynmat[i, :, 0, j, :]
+    dynmat_fourier = hmc.calculate_dynmat_fourier(second, q_points, distance_threshold=distance_threshold)
+    np.testing.assert_array_almost_equal(dynmat_fourier, expected_dynmat.reshape(dynmat_fourier.shape))
+    assert distance_threshold in second._neighbor_tables
@@ -0,0 +1,95 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+import numpy as np
+from kaldo.phonons import Phonons
+import kaldo.controllers.harmonic as hmc
+import kaldo.observables.secondorder as secondorder
+import pytest
+import sparse
+
+
+def create_phonons(is_solving_frequency_window=False, min_frequency=0, is_using_sparse_dynmat=False):
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-amorphous',
+                                                format='eskm',
+                                                only_second=True)
+    phonons = Phonons(forceconstants=forceconstants,
+                      is_classic=False,
+                      temperature=300,
+                      min_frequency=min_frequency,
+                      max_frequency=5,
+                      is_solving_frequency_window=is_solving_frequency_window,
+                      is_using_sparse_dynmat=is_using_sparse_dynmat,
+                      storage='memory')
+    return phonons
+
+
+@pytest.fixture(scope="session")
+def phonons():
+    return create_phonons()
+
+
+@pytest.fixture(scope="session")
+def window_phonons():
+    return create_phonons(is_solving_frequency_window=True)
+
+
+def test_frequency_window(phonons, window_phonons):
+    frequency = phonons.frequency[0]
+    is_in_window = (frequency > 0) & (frequency <= 5)
+    assert window_phonons.n_modes == is_in_window.sum()
+    np.testing.assert_array_almost_equal(window_phonons.frequency[0], frequency[is_in_window], decimal=6)
+
+
+@pytest.mark.parametrize('min_frequency', [0, 2])
+def test_frequency_window_physical_mode(phonons, min_frequency):
+    # The acoustic modes are the first three of the full solve, but not of the window
+    window_phonons = create_phonons(is_solving_frequency_window=True, min_frequency=min_frequency)
+    frequency = phonons.frequency[0]
+    is_in_window = (frequency > min_frequency) & (frequency <= 5)
+    np.testing.assert_array_equal(window_phonons.physical_mode[0], phonons.physical_mode[0, is_in_window])
+
+
+def test_frequency_window_velocity(phonons, window_phonons):
+    is_in_window = (phonons.frequency[0] > 0) & (phonons.frequency[0] <= 5)
+    velocity = phonons.velocity[0, is_in_window]
+    np.testing.assert_array_almost_equal(window_phonons.velocity[0], velocity, decimal=4)
+
+
+def test_sparse_eigensystem(phonons):
+    second = phonons.forceconstants.second
+    sparse_dynmat = hmc.calculate_sparse_dynmat(second)
+    dynmat = hmc.calculate_dynmat_fourier(second, np.zeros((1, 3)))[0]
+    np.testing.assert_array_almost_equal(sparse_dynmat.toarray(), dynmat)
+
+    # Few modes per slice, to bisect the window
+    eigensystem = hmc.calculate_eigensystem_sparse(sparse_dynmat, min_frequency=1, max_frequency=8,
+                                                   n_modes_per_slice=32)
+    frequency = phonons.frequency[0]
+    is_in_window = (frequency > 1) & (frequency <= 8)
+    np.testing.assert_array_almost_equal(hmc.calculate_frequency(eigensystem[0]), frequency[is_in_window],
+                                         decimal=6)
+
+
+def test_sparse_table(phonons, monkeypatch):
+    second = phonons.forceconstants.second
+    table = second.calculate_sparse_table()
+    # One atom per chunk
+    monkeypatch.setattr(secondorder, 'SPARSE_TABLE_CHUNK_MEMORY_IN_MB', 1e-6)
+    chunked_table = second.calculate_sparse_table()
+    for key in table:
+        np.testing.assert_array_equal(chunked_table[key], table[key])
+    monkeypatch.setattr(second, 'value', sparse.COO.from_numpy(np.asarray(second.value)))
+    coo_table = second.calculate_sparse_table()
+    for key in table:
+        np.testing.assert_array_almost_equal(coo_table[key], table[key])
+
+
+def test_sparse_physical_mode(phonons):
+    sparse_phonons = create_phonons(is_using_sparse_dynmat=True, min_frequency=2)
+    frequency = phonons.frequency[0]
+    is_in_window = (frequency > 2) & (frequency <= 5)
+    np.testing.assert_array_equal(sparse_phonons.physical_mode[0], phonons.physical_mode[0, is_in_window])
@@ -0,0 +1,65 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+import numpy as np
+from kaldo.phonons import Phonons
+from kaldo.conductivity import Conductivity
+import kaldo.controllers.interpolation as interpolation
+import pytest
+
+
+def create_phonons(kpts, bandwidth_kpts=None):
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    phonons = Phonons(forceconstants=forceconstants,
+                      kpts=kpts,
+                      bandwidth_kpts=bandwidth_kpts,
+                      is_classic=False,
+                      temperature=300,
+                      storage='memory')
+    return phonons
+
+
+@pytest.fixture(scope="session")
+def coarse_phonons():
+    return create_phonons([3, 3, 3])
+
+
+@pytest.fixture(scope="session")
+def phonons():
+    return create_phonons([6, 6, 6], bandwidth_kpts=[3, 3, 3])
+
+
+def test_interpolation_on_coarse_mesh(coarse_phonons):
+    q_points = coarse_phonons._reciprocal_grid.unitary_grid(is_wrapping=False)
+    observable = coarse_phonons.frequency
+    np.testing.assert_array_almost_equal(
+        interpolation.interpolate_on_mesh(q_points, coarse_phonons.kpts, observable), observable)
+    np.testing.assert_array_almost_equal(
+        interpolation.interpolate_on_mesh(q_points, coarse_phonons.kpts, observable,
+                                          coarse_phonons.eigenvectors, coarse_phonons.eigenvectors),
+        observable)
+
+
+def test_interpolated_bandwidth(phonons, coarse_phonons):
+    bandwidth = phonons.bandwidth.reshape((6, 6, 6, phonons.n_modes))
+    coarse_bandwidth = coarse_phonons.bandwidth.reshape((3, 3, 3, phonons.n_modes))
+    np.testing.assert_array_almost_equal(bandwidth[::2, ::2, ::2], coarse_bandwidth, decimal=2)
+    assert (phonons.bandwidth[phonons.physical_mode] > 0).all()
+
+
+def test_interpolated_phase_space(phonons, coarse_phonons):
+    phase_space = phonons.phase_space.reshape((6, 6, 6, phonons.n_modes))
+    coarse_phase_space = coarse_phonons.phase_space.reshape((3, 3, 3, phonons.n_modes))
+    np.testing.assert_allclose(phase_space[::2, ::2, ::2], coarse_phase_space, rtol=1e-4)
+    assert not hasattr(phonons, '_lazy___ps_and_gamma')
+
+
+@pytest.mark.parametrize('method', ['sc', 'inverse', 'full'])
+def test_interpolated_bandwidth_scattering_tensor(phonons, method):
+    with pytest.raises(ValueError):
+        Conductivity(phonons=phonons, method=method, storage='memory')
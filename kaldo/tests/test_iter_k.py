@@ -0,0 +1,57 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+import numpy as np
+from kaldo.phonons import Phonons
+from kaldo.observables.harmonic_with_q import HarmonicWithQ
+import pytest
+
+
+@pytest.fixture(scope="session")
+def phonons():
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    phonons = Phonons(forceconstants=forceconstants,
+                      kpts=[3, 3, 3],
+                      is_classic=False,
+                      temperature=300,
+                      storage='memory')
+    return phonons
+
+
+def test_iter_k_covers_mesh(phonons):
+    k_index = np.concatenate([bundle['k_index'] for bundle in phonons.iter_k(properties=('frequency', ), chunk=5)])
+    np.testing.assert_array_equal(k_index, np.arange(phonons.n_k_points))
+
+
+def test_iter_k_frequency_and_velocity(phonons):
+    for bundle in phonons.iter_k(properties=('frequency', 'velocity'), chunk=5):
+        np.testing.assert_array_almost_equal(bundle['frequency'], phonons.frequency[bundle['k_index']])
+        np.testing.assert_array_almost_equal(bundle['velocity'], phonons.velocity[bundle['k_index']], decimal=3)
+
+
+def test_iter_k_heat_capacity(phonons):
+    for bundle in phonons.iter_k(properties=('physical_mode', 'heat_capacity'), chunk=5):
+        np.testing.assert_array_equal(bundle['physical_mode'], phonons.physical_mode[bundle['k_index']])
+        np.testing.assert_array_almost_equal(bundle['heat_capacity'], phonons.heat_capacity[bundle['k_index']])
+
+
+def test_evaluate_at_mesh(phonons):
+    q_points = phonons._reciprocal_grid.unitary_grid(is_wrapping=False)
+    harmonic = phonons.evaluate_at(q_points, properties=('frequency', 'velocity'), chunk=4)
+    np.testing.assert_array_almost_equal(harmonic['frequency'], phonons.frequency)
+    np.testing.assert_array_almost_equal(harmonic['velocity'], phonons.velocity, decimal=3)
+
+
+def test_evaluate_at_path(phonons):
+    q_points = np.linspace(0, 0.5, 7)[:, np.newaxis] * np.array([1, 0, 1])
+    harmonic = phonons.evaluate_at(q_points, properties=('frequency', ))
+    for q_point, frequency in zip(q_points, harmonic['frequency']):
+        expected = HarmonicWithQ(q_point, phonons.forceconstants.second,
+                                 distance_threshold=phonons.forceconstants.distance_threshold,
+                                 storage='memory').frequency[0]
+        np.testing.assert_array_almost_equal(frequency, expected)
@@ -0,0 +1,85 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+import numpy as np
+from kaldo.phonons import Phonons
+from kaldo.helpers.storage import LAZY_PREFIX
+import kaldo.controllers.harmonic as hmc
+import kaldo.controllers.kpm as kpm
+import scipy.linalg
+import pytest
+
+
+@pytest.fixture(scope="session")
+def phonons():
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-amorphous',
+                                                format='eskm',
+                                                only_second=True)
+    phonons = Phonons(forceconstants=forceconstants,
+                      is_classic=False,
+                      temperature=300,
+                      storage='memory')
+    # The reference eigensystem is calculated with scipy, so that it doesn't depend on the LAPACK build of numpy
+    eigenvalues, eigenvectors = scipy.linalg.eigh(hmc.calculate_sparse_dynmat(forceconstants.second).toarray())
+    eigensystem = np.vstack([eigenvalues[np.newaxis, :], eigenvectors])[np.newaxis, :, :]
+    setattr(phonons, LAZY_PREFIX + '_eigensystem', eigensystem)
+    return phonons
+
+
+def chebyshev_polynomials(phonons, bounds, n_moments):
+    x = kpm._rescale(phonons.eigenvalues[0], bounds)
+    return np.cos(np.arange(n_moments)[:, np.newaxis] * np.arccos(x)[np.newaxis, :])
+
+
+def test_kpm_dos_moments(phonons):
+    sparse_dynmat = hmc.calculate_sparse_dynmat(phonons.forceconstants.second)
+    bounds = kpm.calculate_spectral_bounds(sparse_dynmat)
+    moments = kpm.calculate_dos_moments(sparse_dynmat, bounds, n_moments=20, n_vectors=None)
+    expected_moments = chebyshev_polynomials(phonons, bounds, 20).sum(axis=-1)
+    np.testing.assert_array_almost_equal(moments, expected_moments, decimal=4)
+
+
+def test_kpm_diffusivity_moments(phonons):
+    second = phonons.forceconstants.second
+    sparse_dynmat = hmc.calculate_sparse_dynmat(second)
+    sparse_derivative = hmc.calculate_sparse_dynmat(second, direction=2)
+    bounds = kpm.calculate_spectral_bounds(sparse_dynmat)
+    moments = kpm.calculate_diffusivity_moments(sparse_dynmat, sparse_derivative, bounds, n_moments=10,
+                                                n_vectors=None)
+    eigenvectors = phonons.eigenvectors[0]
+    sij = np.einsum('in,im->nm', eigenvectors, sparse_derivative.dot(eigenvectors), optimize=False)
+    polynomials = chebyshev_polynomials(phonons, bounds, 10)
+    expected_moments = np.einsum('kn,nm,lm->kl', polynomials, sij ** 2, polynomials, optimize=False)
+    np.testing.assert_array_almost_equal(moments / expected_moments, np.ones_like(moments), decimal=6)
+
+
+def test_kpm_diffusivity(phonons):
+    # Exact trace, so that the only difference from the Allen-Feldman diffusivity is the Jackson broadening
+    n_moments = 32
+    frequency = np.linspace(2, 14, 13)
+    diffusivity = kpm.calculate_diffusivity(phonons, frequency, n_moments=n_moments, n_vectors=None)
+    second = phonons.forceconstants.second
+    sparse_dynmat = hmc.calculate_sparse_dynmat(second)
+    bounds = kpm.calculate_spectral_bounds(sparse_dynmat)
+    omega = 2 * np.pi * frequency
+    scale = (bounds[1] - bounds[0]) / 2
+    x = kpm._rescale(omega ** 2, bounds)
+    polynomials = np.cos(np.arange(n_moments)[:, np.newaxis] * np.arccos(x)[np.newaxis, :])
+    weights = 2. * np.ones(n_moments)
+    weights[0] = 1.
+    # Jackson broadened delta(omega - omega_n), from the scipy eigensystem of the fixture
+    delta = np.einsum('k,kp,kn->pn', weights * kpm.jackson_kernel(n_moments), polynomials,
+                      chebyshev_polynomials(phonons, bounds, n_moments), optimize=False)
+    delta = delta / (np.pi * np.sqrt(1 - x ** 2))[:, np.newaxis] * (2 * omega / scale)[:, np.newaxis]
+    eigenvectors = phonons.eigenvectors[0]
+    flux = np.zeros_like(omega)
+    for alpha in range(3):
+        sparse_derivative = hmc.calculate_sparse_dynmat(second, direction=alpha)
+        sij = np.einsum('in,im->nm', eigenvectors, sparse_derivative.dot(eigenvectors), optimize=False)
+        flux += np.einsum('pn,nm,pm->p', delta, sij ** 2, delta, optimize=False)
+    # Same units of Conductivity.diffusivity, averaged over the directions
+    expected_diffusivity = 1 / 3 * 1 / 100 * np.pi * flux / (4 * omega ** 2) / delta.sum(axis=-1)
+    np.testing.assert_allclose(diffusivity, expected_diffusivity, rtol=1e-6)
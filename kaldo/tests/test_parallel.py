@@ -0,0 +1,57 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+import numpy as np
+from kaldo.phonons import Phonons
+from kaldo.conductivity import Conductivity
+import pytest
+
+
+def create_phonons(n_workers=None):
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    phonons = Phonons(forceconstants=forceconstants,
+                      kpts=[3, 3, 3],
+                      is_classic=False,
+                      temperature=300,
+                      n_workers=n_workers,
+                      storage='memory')
+    return phonons
+
+
+@pytest.fixture(scope="session")
+def phonons():
+    return create_phonons()
+
+
+@pytest.fixture(scope="session")
+def parallel_phonons():
+    return create_phonons(n_workers=2)
+
+
+def test_parallel_frequency(phonons, parallel_phonons):
+    np.testing.assert_array_almost_equal(parallel_phonons.frequency, phonons.frequency, decimal=8)
+
+
+def test_parallel_velocity(phonons, parallel_phonons):
+    np.testing.assert_array_almost_equal(parallel_phonons.velocity, phonons.velocity, decimal=6)
+
+
+def test_parallel_qhgk_conductivity(phonons, parallel_phonons):
+    cond = Conductivity(phonons=phonons, method='qhgk', diffusivity_bandwidth=0.1,
+                        storage='memory').conductivity.sum(axis=0)
+    parallel_cond = Conductivity(phonons=parallel_phonons, method='qhgk', diffusivity_bandwidth=0.1,
+                                 storage='memory').conductivity.sum(axis=0)
+    np.testing.assert_array_almost_equal(parallel_cond, cond, decimal=6)
+
+
+def test_parallel_bandwidth(phonons, parallel_phonons):
+    np.testing.assert_array_almost_equal(parallel_phonons.bandwidth, phonons.bandwidth, decimal=6)
+
+
+def test_parallel_phase_space(phonons, parallel_phonons):
+    np.testing.assert_array_almost_equal(parallel_phonons.phase_space, phonons.phase_space, decimal=6)
@@ -0,0 +1,45 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+import numpy as np
+from kaldo.phonons import Phonons
+import pytest
+
+
+def create_phonons(precision='double'):
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    phonons = Phonons(forceconstants=forceconstants,
+                      kpts=[3, 3, 3],
+                      is_classic=False,
+                      temperature=300,
+                      precision=precision,
+                      storage='memory')
+    return phonons
+
+
+@pytest.fixture(scope="session")
+def phonons():
+    return create_phonons()
+
+
+@pytest.fixture(scope="session")
+def single_phonons():
+    return create_phonons(precision='single')
+
+
+def test_single_precision_eigenvectors(single_phonons):
+    assert single_phonons.eigenvectors.dtype == np.complex64
+    assert single_phonons.eigenvalues.dtype == np.float64
+
+
+def test_single_precision_frequency(phonons, single_phonons):
+    np.testing.assert_array_almost_equal(single_phonons.frequency, phonons.frequency, decimal=6)
+
+
+def test_single_precision_velocity(phonons, single_phonons):
+    np.testing.assert_array_almost_equal(single_phonons.velocity, phonons.velocity, decimal=4)
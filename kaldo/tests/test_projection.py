@@ -0,0 +1,30 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+import numpy as np
+from kaldo.phonons import Phonons
+import kaldo.controllers.anharmonic as aha
+import pytest
+
+
+@pytest.fixture(scope="session")
+def phonons():
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    phonons = Phonons(forceconstants=forceconstants,
+                      kpts=[3, 3, 3],
+                      is_classic=False,
+                      temperature=300,
+                      storage='memory')
+    return phonons
+
+
+def test_projection_mode_blocks(phonons, monkeypatch):
+    bandwidth = phonons.bandwidth
+    monkeypatch.setattr(aha, 'calculate_mode_block_size', lambda n_k_points, n_modes, n_replicas: 4)
+    ps_and_gamma = aha.project_crystal(phonons, is_gamma_tensor_enabled=False)
+    np.testing.assert_array_almost_equal(ps_and_gamma[:, 1].reshape(bandwidth.shape), bandwidth)
@@ -0,0 +1,100 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+import numpy as np
+from kaldo.phonons import Phonons
+import kaldo.controllers.anharmonic as aha
+import kaldo.helpers.shards as shards
+from kaldo.helpers.storage import get_folder_from_label
+import pytest
+
+
+def create_phonons(folder, storage='memory', is_using_sparse_gamma_tensor=False, **kwargs):
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    phonons = Phonons(forceconstants=forceconstants,
+                      kpts=[3, 3, 3],
+                      is_classic=False,
+                      temperature=300,
+                      folder=folder,
+                      is_using_sparse_gamma_tensor=is_using_sparse_gamma_tensor,
+                      storage=storage,
+                      **kwargs)
+    return phonons
+
+
+@pytest.fixture(scope="session")
+def phonons(tmp_path_factory):
+    return create_phonons(str(tmp_path_factory.mktemp('reference')))
+
+
+@pytest.fixture(scope="session")
+def sharded_phonons(tmp_path_factory):
+    folder = str(tmp_path_factory.mktemp('shards'))
+    phonons = create_phonons(folder, storage='numpy')
+    for start, stop in shards.split_phonons(phonons.n_phonons, 3):
+        phonons.project_shard(start, stop)
+    phonons.merge_shards()
+    return create_phonons(folder, storage='numpy')
+
+
+def test_shards_bandwidth(phonons, sharded_phonons):
+    np.testing.assert_array_almost_equal(sharded_phonons.bandwidth, phonons.bandwidth, decimal=6)
+
+
+def test_shards_gamma_tensor(phonons, sharded_phonons):
+    np.testing.assert_array_almost_equal(sharded_phonons._ps_gamma_and_gamma_tensor,
+                                         phonons._ps_gamma_and_gamma_tensor, decimal=6)
+
+
+def test_shards_restart(sharded_phonons, monkeypatch):
+    monkeypatch.setattr(aha, 'project_crystal', None)
+    start, stop = shards.split_phonons(sharded_phonons.n_phonons, 3)[0]
+    sharded_phonons.project_shard(start, stop)
+    assert sharded_phonons._ps_gamma_and_gamma_tensor.shape == (sharded_phonons.n_phonons,
+                                                                2 + sharded_phonons.n_phonons)
+
+
+def test_shards_missing(tmp_path):
+    phonons = create_phonons(str(tmp_path))
+    phonons.project_shard(0, 10, is_gamma_tensor_enabled=False)
+    with pytest.raises(ValueError):
+        phonons.merge_shards(is_gamma_tensor_enabled=False)
+
+
+def test_shards_overlapping(tmp_path):
+    phonons = create_phonons(str(tmp_path))
+    phonons.project_shard(0, 100, is_gamma_tensor_enabled=False)
+    phonons.project_shard(90, phonons.n_phonons, is_gamma_tensor_enabled=False)
+    with pytest.raises(ValueError):
+        phonons.merge_shards(is_gamma_tensor_enabled=False)
+
+
+def test_shards_gamma_tensor_flag(tmp_path):
+    phonons = create_phonons(str(tmp_path))
+    phonons.is_gamma_tensor_enabled = True
+    phonons.project_shard(0, 10, is_gamma_tensor_enabled=False)
+    assert phonons.is_gamma_tensor_enabled
+
+
+@pytest.mark.parametrize('settings', [{'min_frequency': 1.}, {'max_frequency': 10.}, {'is_nw': True},
+                                      {'grid_type': 'F'}, {'is_using_sparse_gamma_tensor': True}])
+def test_shards_metadata(tmp_path, settings):
+    phonons = create_phonons(str(tmp_path))
+    phonons.project_shard(0, 10, is_gamma_tensor_enabled=False)
+    folder = get_folder_from_label(phonons, '<temperature>/<statistics>/<third_bandwidth>')
+    assert shards.is_complete(folder, '_ps_and_gamma', 0, 10, create_phonons(str(tmp_path))._shard_metadata())
+    other_phonons = create_phonons(str(tmp_path), **settings)
+    assert not shards.is_complete(folder, '_ps_and_gamma', 0, 10, other_phonons._shard_metadata())
+
+
+def test_shards_sparse_gamma_tensor(phonons, tmp_path):
+    sharded_phonons = create_phonons(str(tmp_path), is_using_sparse_gamma_tensor=True)
+    for start, stop in shards.split_phonons(sharded_phonons.n_phonons, 2):
+        sharded_phonons.project_shard(start, stop)
+    gamma_tensor = sharded_phonons.merge_shards()
+    np.testing.assert_array_almost_equal(gamma_tensor.toarray(), phonons._ps_gamma_and_gamma_tensor, decimal=6)
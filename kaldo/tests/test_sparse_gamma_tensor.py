@@ -0,0 +1,86 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+import numpy as np
+from kaldo.phonons import Phonons
+from kaldo.conductivity import Conductivity
+from scipy.sparse import issparse
+from scipy.linalg import solve
+import pytest
+
+
+def create_phonons(is_using_sparse_gamma_tensor, storage='memory', folder='kaldo_data', **kwargs):
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    phonons = Phonons(forceconstants=forceconstants,
+                      kpts=[3, 3, 3],
+                      is_classic=False,
+                      temperature=300,
+                      is_using_sparse_gamma_tensor=is_using_sparse_gamma_tensor,
+                      folder=folder,
+                      storage=storage,
+                      **kwargs)
+    return phonons
+
+
+@pytest.fixture(scope="session")
+def phonons():
+    return create_phonons(is_using_sparse_gamma_tensor=False)
+
+
+@pytest.fixture(scope="session")
+def sparse_phonons():
+    return create_phonons(is_using_sparse_gamma_tensor=True)
+
+
+def test_sparse_gamma_tensor(phonons, sparse_phonons):
+    sparse_tensor = sparse_phonons._sparse_ps_gamma_and_gamma_tensor
+    assert issparse(sparse_tensor)
+    np.testing.assert_array_almost_equal(sparse_tensor.toarray(), phonons._ps_gamma_and_gamma_tensor, decimal=8)
+
+
+def test_sparse_sc_conductivity(phonons, sparse_phonons):
+    cond = Conductivity(phonons=phonons, method='sc', max_n_iterations=71,
+                        storage='memory').conductivity.sum(axis=0)
+    sparse_cond = Conductivity(phonons=sparse_phonons, method='sc', max_n_iterations=71,
+                               storage='memory').conductivity.sum(axis=0)
+    np.testing.assert_array_almost_equal(sparse_cond, cond, decimal=6)
+
+
+def test_sparse_inverse_conductivity(phonons, sparse_phonons):
+    # The reference solves the dense scattering matrix with scipy, instead of numpy.linalg.inv
+    conductivity = Conductivity(phonons=phonons, method='inverse', storage='memory')
+    physical_mode = phonons.physical_mode.reshape(phonons.n_phonons)
+    velocity = phonons.velocity.real.reshape((phonons.n_phonons, 3))
+    scattering_matrix = conductivity.calculate_scattering_matrix(is_including_diagonal=False,
+                                                                 is_rescaling_omega=True,
+                                                                 is_rescaling_population=False)
+    scattering_matrix += np.diag(phonons.bandwidth.reshape(phonons.n_phonons)[physical_mode])
+    mfp = np.zeros_like(velocity)
+    mfp[physical_mode] = solve(scattering_matrix, velocity[physical_mode])
+    sparse_mfp = Conductivity(phonons=sparse_phonons, method='inverse', storage='memory').mean_free_path
+    np.testing.assert_allclose(sparse_mfp, mfp, rtol=1e-6, atol=1e-6 * np.abs(mfp).max())
+
+
+@pytest.mark.parametrize('storage', ['numpy', 'hdf5'])
+def test_sparse_gamma_tensor_storage(sparse_phonons, storage, tmp_path, monkeypatch):
+    stored_phonons = create_phonons(is_using_sparse_gamma_tensor=True, storage=storage, folder='sparse_data')
+    loaded_phonons = create_phonons(is_using_sparse_gamma_tensor=True, storage=storage, folder='sparse_data')
+    # The hdf5 file is named after the first component of the folder, relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    stored_phonons._sparse_ps_gamma_and_gamma_tensor
+    assert issparse(loaded_phonons._sparse_ps_gamma_and_gamma_tensor)
+    np.testing.assert_array_almost_equal(loaded_phonons._sparse_ps_gamma_and_gamma_tensor.toarray(),
+                                         sparse_phonons._sparse_ps_gamma_and_gamma_tensor.toarray())
+    np.testing.assert_array_almost_equal(loaded_phonons.bandwidth, sparse_phonons.bandwidth)
+
+
+def test_sparse_gamma_tensor_symmetry():
+    phonons = create_phonons(is_using_sparse_gamma_tensor=False, is_using_symmetry=True, third_bandwidth=0.1)
+    sparse_phonons = create_phonons(is_using_sparse_gamma_tensor=True, is_using_symmetry=True, third_bandwidth=0.1)
+    np.testing.assert_array_almost_equal(sparse_phonons._sparse_ps_gamma_and_gamma_tensor.toarray(),
+                                         phonons._ps_gamma_and_gamma_tensor, decimal=8)
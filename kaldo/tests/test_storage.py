@@ -0,0 +1,36 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+import numpy as np
+from kaldo.phonons import Phonons
+import pytest
+
+
+@pytest.fixture(scope="session")
+def forceconstants():
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    return forceconstants
+
+
+def create_phonons(forceconstants, folder):
+    phonons = Phonons(forceconstants=forceconstants,
+                      kpts=[3, 3, 3],
+                      is_classic=False,
+                      temperature=300,
+                      folder=folder,
+                      storage='numpy')
+    return phonons
+
+
+def test_memory_mapped_eigensystem(forceconstants, tmpdir):
+    folder = str(tmpdir)
+    eigenvectors = create_phonons(forceconstants, folder)._rescaled_eigenvectors
+    phonons = create_phonons(forceconstants, folder)
+    assert isinstance(phonons._eigensystem, np.memmap)
+    k_index = np.array([4, 7])
+    np.testing.assert_array_almost_equal(phonons._rescaled_eigenvectors_at_k(k_index), eigenvectors[k_index])
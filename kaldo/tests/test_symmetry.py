@@ -0,0 +1,101 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+import numpy as np
+from kaldo.phonons import Phonons
+from kaldo.conductivity import Conductivity
+import pytest
+
+
+def create_phonons(is_using_symmetry=False, third_bandwidth=None):
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    phonons = Phonons(forceconstants=forceconstants,
+                      kpts=[5, 5, 5],
+                      is_classic=False,
+                      temperature=300,
+                      is_using_symmetry=is_using_symmetry,
+                      third_bandwidth=third_bandwidth,
+                      storage='memory')
+    return phonons
+
+
+@pytest.fixture(scope="session")
+def phonons():
+    return create_phonons()
+
+
+@pytest.fixture(scope="session")
+def symmetric_phonons():
+    return create_phonons(is_using_symmetry=True)
+
+
+@pytest.fixture(scope="session")
+def fixed_broadening_phonons():
+    return create_phonons(third_bandwidth=0.3)
+
+
+@pytest.fixture(scope="session")
+def symmetric_fixed_broadening_phonons():
+    return create_phonons(is_using_symmetry=True, third_bandwidth=0.3)
+
+
+def test_irreducible_k_points(symmetric_phonons):
+    assert symmetric_phonons._k_symmetry.n_irreducible_k_points == 10
+    assert symmetric_phonons._k_symmetry.weights.sum() == 125
+
+
+def test_symmetry_frequency(phonons, symmetric_phonons):
+    np.testing.assert_array_almost_equal(symmetric_phonons.frequency, phonons.frequency, decimal=6)
+
+
+def test_symmetry_eigenvectors(phonons, symmetric_phonons):
+    # The eigenvectors differ by a gauge in the degenerate subspaces, so compare the dynamical matrices
+    eigenvectors = symmetric_phonons.eigenvectors
+    dynmat = contract_dynmat(eigenvectors, symmetric_phonons.eigenvalues)
+    calculated_dynmat = contract_dynmat(phonons.eigenvectors, phonons.eigenvalues)
+    np.testing.assert_array_almost_equal(dynmat / 1000, calculated_dynmat / 1000, decimal=6)
+
+
+def test_symmetry_qhgk_conductivity(phonons, symmetric_phonons):
+    cond = Conductivity(phonons=phonons, method='qhgk', diffusivity_bandwidth=0.1,
+                        storage='memory').conductivity.sum(axis=0)
+    symmetric_cond = Conductivity(phonons=symmetric_phonons, method='qhgk', diffusivity_bandwidth=0.1,
+                                  storage='memory').conductivity.sum(axis=0)
+    np.testing.assert_array_almost_equal(symmetric_cond.diagonal(), cond.diagonal(), decimal=2)
+
+
+def test_symmetry_bandwidth(fixed_broadening_phonons, symmetric_fixed_broadening_phonons):
+    # The adaptive broadening depends on the orientation of the mesh, so the broadening is fixed here
+    np.testing.assert_array_almost_equal(symmetric_fixed_broadening_phonons.bandwidth,
+                                         fixed_broadening_phonons.bandwidth, decimal=4)
+
+
+def test_symmetry_adaptive_bandwidth(phonons, symmetric_phonons):
+    # With the adaptive broadening the projection is done on the full k mesh, only the velocities in the
+    # degenerate subspaces, used for the broadening, are in a different basis
+    np.testing.assert_allclose(symmetric_phonons.bandwidth.mean(axis=1), phonons.bandwidth.mean(axis=1),
+                               rtol=0.01)
+    cond = Conductivity(phonons=phonons, method='sc', storage='memory').conductivity.sum(axis=0)
+    symmetric_cond = Conductivity(phonons=symmetric_phonons, method='sc', storage='memory').conductivity.sum(axis=0)
+    np.testing.assert_allclose(symmetric_cond.diagonal(), cond.diagonal(), rtol=0.01)
+
+
+@pytest.mark.parametrize('method', ['rta', 'sc'])
+def test_symmetry_scattering_tensor_conductivity(fixed_broadening_phonons, symmetric_fixed_broadening_phonons,
+                                                 method):
+    # Velocities and bandwidths are paired in different bases inside the degenerate subspaces, which moves the
+    # conductivity of the single directions by less than one percent
+    cond = Conductivity(phonons=fixed_broadening_phonons, method=method,
+                        storage='memory').conductivity.sum(axis=0)
+    symmetric_cond = Conductivity(phonons=symmetric_fixed_broadening_phonons, method=method,
+                                  storage='memory').conductivity.sum(axis=0)
+    np.testing.assert_allclose(symmetric_cond.diagonal(), cond.diagonal(), rtol=0.015)
+
+
+def contract_dynmat(eigenvectors, eigenvalues):
+    return np.einsum('kin,kn,kjn->kij', eigenvectors, eigenvalues.real, eigenvectors.conj())
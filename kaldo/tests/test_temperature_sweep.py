@@ -0,0 +1,83 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+import numpy as np
+from kaldo.phonons import Phonons
+from kaldo.observables.harmonic_with_q_temp import HarmonicWithQTemp
+import pytest
+import weakref
+import gc
+
+
+@pytest.fixture(scope="session")
+def forceconstants():
+    return ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                      supercell=[3, 3, 3],
+                                      format='eskm')
+
+
+def create_phonons(forceconstants, temperature):
+    return Phonons(forceconstants=forceconstants,
+                   kpts=[3, 3, 3],
+                   is_classic=False,
+                   temperature=temperature,
+                   storage='memory')
+
+
+def test_at_temperature_shares_harmonic(forceconstants):
+    phonons = create_phonons(forceconstants, 300)
+    frequency = phonons.frequency
+    velocity = phonons.velocity
+    hot_phonons = phonons.at_temperature(600)
+    assert hot_phonons.frequency is frequency
+    assert hot_phonons.velocity is velocity
+    np.testing.assert_array_almost_equal(hot_phonons.heat_capacity,
+                                         create_phonons(forceconstants, 600).heat_capacity)
+
+
+def test_harmonic_with_q_temp_shares_harmonic(forceconstants):
+    q_point = np.array([0.1, 0.2, 0.3])
+    cold = HarmonicWithQTemp(100, False, q_point, forceconstants.second, storage='memory')
+    hot = HarmonicWithQTemp(600, False, q_point, forceconstants.second, storage='memory')
+    assert cold.harmonic is hot.harmonic
+    assert cold.frequency is hot.frequency
+    assert (hot.population > cold.population).all()
+
+
+def test_thermodynamics(forceconstants):
+    phonons = create_phonons(forceconstants, 300)
+    thermodynamics = phonons.thermodynamics([1, 300, 600])
+    np.testing.assert_array_almost_equal(thermodynamics['population'][1], phonons.population)
+    np.testing.assert_array_almost_equal(thermodynamics['heat_capacity'][2] / phonons.heat_capacity.max(),
+                                         create_phonons(forceconstants, 600).heat_capacity
+                                         / phonons.heat_capacity.max())
+    assert np.isfinite(thermodynamics['heat_capacity'][0]).all()
+
+
+def test_integrated_thermodynamics(forceconstants):
+    phonons = create_phonons(forceconstants, 300)
+    temperatures = np.linspace(290, 310, 201)
+    thermodynamics = phonons.thermodynamics(temperatures, is_integrated=True)
+    free_energy = thermodynamics['free_energy']
+    np.testing.assert_allclose(thermodynamics['internal_energy'],
+                               free_energy + temperatures * thermodynamics['entropy'])
+    np.testing.assert_allclose(-np.gradient(free_energy, temperatures)[1:-1], thermodynamics['entropy'][1:-1],
+                               rtol=1e-4)
+
+
+def test_harmonic_cache_is_released():
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    second = forceconstants.second
+    harmonic_with_q_temp = HarmonicWithQTemp(300, False, np.array([0.1, 0.2, 0.3]), second, storage='memory')
+    harmonic_with_q_temp.frequency
+    harmonic = weakref.ref(harmonic_with_q_temp.harmonic)
+    second_ref = weakref.ref(second)
+    del forceconstants, second, harmonic_with_q_temp
+    gc.collect()
+    assert second_ref() is None
+    assert harmonic() is None
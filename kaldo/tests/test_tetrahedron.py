@@ -0,0 +1,51 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+import numpy as np
+from kaldo.phonons import Phonons
+import kaldo.controllers.tetrahedron as tetrahedron
+import pytest
+
+
+@pytest.fixture(scope="session")
+def phonons():
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    phonons = Phonons(forceconstants=forceconstants,
+                      kpts=[5, 5, 5],
+                      is_classic=False,
+                      temperature=300,
+                      storage='memory')
+    return phonons
+
+
+def test_tetrahedra_cover_grid(phonons):
+    tetrahedra = phonons._reciprocal_grid.tetrahedra(reciprocal_cell=phonons.atoms.cell.reciprocal())
+    assert tetrahedra.shape == (6 * phonons.n_k_points, 4)
+    np.testing.assert_array_equal(np.bincount(tetrahedra.flatten()), 24 * np.ones(phonons.n_k_points))
+
+
+def test_tetrahedron_weights():
+    corner_frequency = np.array([[1., 1.5, 2.5, 3.]])
+    frequency = np.linspace(0.5, 3.5, 3001)
+    weights = np.array([tetrahedron.calculate_tetrahedron_weights(corner_frequency, nu)[0] for nu in frequency])
+    np.testing.assert_array_almost_equal(np.trapz(weights, frequency, axis=0), np.ones(4) / 4)
+
+
+def test_dos_normalization(phonons):
+    # Tetrahedra with the same frequency at all the corners add a delta, which the grid can't resolve
+    frequency = np.linspace(phonons.frequency.min() - 1, phonons.frequency.max() + 1, 2000)
+    dos = tetrahedron.calculate_dos(phonons, frequency)
+    np.testing.assert_approx_equal(np.trapz(dos, frequency), phonons.n_modes, significant=2)
+
+
+def test_projected_dos(phonons):
+    frequency = np.linspace(0, phonons.frequency.max() + 1, 50)
+    dos = tetrahedron.calculate_dos(phonons, frequency)
+    projected_dos = tetrahedron.calculate_dos(phonons, frequency, is_projected=True)
+    np.testing.assert_array_almost_equal(projected_dos.sum(axis=0), dos)
+    np.testing.assert_array_almost_equal(projected_dos[0], projected_dos[1])
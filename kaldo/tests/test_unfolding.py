@@ -0,0 +1,41 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+import numpy as np
+from kaldo.phonons import Phonons
+import pytest
+
+
+@pytest.fixture(scope="session")
+def forceconstants():
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    return forceconstants
+
+
+def test_unfolding_commensurate_frequency(forceconstants):
+    # On the k points commensurate with the supercell, unfolding doesn't change the frequencies
+    frequencies = []
+    for is_unfolding in [False, True]:
+        phonons = Phonons(forceconstants=forceconstants,
+                          kpts=[3, 3, 3],
+                          is_classic=False,
+                          temperature=300,
+                          is_unfolding=is_unfolding,
+                          storage='memory')
+        frequencies.append(phonons.frequency)
+    np.testing.assert_array_almost_equal(frequencies[1], frequencies[0], decimal=6)
+
+
+def test_unfolding_table_weights(forceconstants):
+    unfolding_table = forceconstants.second.unfolding_table
+    n_unit_cell = forceconstants.atoms.positions.shape[0]
+    n_replicas = np.prod(forceconstants.second.supercell)
+    # The weights of the equivalent replicas of each couple of atoms add up to one replica
+    weight = np.zeros((n_unit_cell, n_unit_cell))
+    np.add.at(weight, (unfolding_table['i'], unfolding_table['j']), unfolding_table['weight'])
+    np.testing.assert_array_almost_equal(weight, n_replicas * np.ones_like(weight))
@@ -0,0 +1,68 @@
+"""
+Unit and regression test for the kaldo package.
+"""
+
+# Import package, test suite, and other packages as needed
+from kaldo.forceconstants import ForceConstants
+import numpy as np
+from kaldo.phonons import Phonons
+import kaldo.controllers.harmonic as hmc
+import scipy.linalg
+import pytest
+
+
+@pytest.fixture(scope="session")
+def phonons():
+    forceconstants = ForceConstants.from_folder(folder='kaldo/tests/si-crystal',
+                                                supercell=[3, 3, 3],
+                                                format='eskm')
+    phonons = Phonons(forceconstants=forceconstants,
+                      kpts=[3, 3, 3],
+                      is_classic=False,
+                      temperature=300,
+                      storage='memory')
+    return phonons
+
+
+def test_velocity_from_full_sij(phonons):
+    q_points = phonons._reciprocal_grid.unitary_grid(is_wrapping=False)
+    sij = hmc.calculate_sij_at_q_points(phonons.forceconstants.second, q_points, phonons.eigenvectors)
+    velocity = hmc.calculate_velocity(phonons.frequency, sij)
+    np.testing.assert_array_almost_equal(phonons.velocity, velocity, decimal=8)
+
+
+def test_velocity_degenerate_subspaces(phonons):
+    q_points = phonons._reciprocal_grid.unitary_grid(is_wrapping=False)
+    dynmat_derivatives = hmc.calculate_dynmat_derivatives(phonons.forceconstants.second, q_points)
+    velocity = hmc.calculate_velocity_diagonal(phonons.frequency, phonons.eigenvectors, dynmat_derivatives,
+                                               degeneracy_threshold=1e-4)
+    # Rotating the basis of the degenerate subspaces changes only the sum of the velocities of each subspace
+    np.testing.assert_array_almost_equal(velocity.sum(axis=1), phonons.velocity.sum(axis=1), decimal=6)
+    assert not np.allclose(velocity, phonons.velocity)
+
+
+def test_velocity_degenerate_vectors(phonons):
+    q_points = phonons._reciprocal_grid.unitary_grid(is_wrapping=False)
+    frequency = phonons.frequency
+    dynmat_derivatives = hmc.calculate_dynmat_derivatives(phonons.forceconstants.second, q_points)
+    velocity = hmc.calculate_velocity_diagonal(frequency, phonons.eigenvectors, dynmat_derivatives,
+                                               degeneracy_threshold=1e-4)
+    sij = hmc.calculate_sij_at_q_points(phonons.forceconstants.second, q_points, phonons.eigenvectors)
+    operator = (sij - sij.conj().transpose((0, 1, 3, 2))) / 2j
+    n_degenerate = 0
+    for k_index in range(phonons.n_k_points):
+        is_new_subspace = np.diff(frequency[k_index]) > 1e-4
+        for subspace in np.split(np.arange(phonons.n_modes), np.argwhere(is_new_subspace).flatten() + 1):
+            if subspace.shape[0] == 1 or frequency[k_index, subspace[0]] < 1e-3:
+                continue
+            n_degenerate += 1
+            block = operator[k_index][:, subspace][:, :, subspace]
+            _, rotation = scipy.linalg.eigh(np.tensordot(hmc.DEGENERATE_SUBSPACE_DIRECTION, block, (0, 0)))
+            expected = np.einsum('mi,xmn,ni->ix', rotation.conj(), block, rotation).real
+            expected = expected / (4 * np.pi * frequency[k_index, subspace, np.newaxis])
+            # Each mode has the whole velocity vector of a single state, including the products of the components
+            np.testing.assert_array_almost_equal(velocity[k_index, subspace], expected, decimal=6)
+            np.testing.assert_array_almost_equal(np.einsum('ix,iy->xy', velocity[k_index, subspace],
+                                                           velocity[k_index, subspace]),
+                                                 np.einsum('ix,iy->xy', expected, expected), decimal=6)
+    assert n_degenerate > 0